@@ -23,6 +23,13 @@ parser.add_argument("-end", dest="end_date", help=f"End date to use for run. For
 parser.add_argument("-ago", dest="days_ago", help="Number of days before today or a given end_date (defined by the -end argument) over which to run the inventory. If provided, must be positive integer. If not provided, it will run the full extent of the inventory.", default=0, type=int)
 parser.add_argument("-n_jobs", dest="n_jobs", help="Number of parallel jobs to run.", default=18, type=int)
 parser.add_argument("-work_dir", dest="work_dir", help="Location of work directory for nceplibs calls. Defaults to the current directory.", default="./", type=str)
+parser.add_argument("-concurrent", dest="concurrent", help="Search the cycles of each variable in parallel. Limits per storage platform can be set with OBS_INV_MAX_WORKERS_<PLATFORM> environment variables.", action="store_true")
+parser.add_argument("-incremental", dest="incremental", help="Start the inventory search of each variable at the last cycle searched by a previous incremental run.", action="store_true")
+parser.add_argument("-lookback", dest="lookback_hours", help="Number of hours before the last searched cycle to search again with -incremental, picks up late arriving files.", default=0, type=int)
+parser.add_argument("-buffered", dest="buffered", help="Write the search results of each variable to the database in batches from a background thread.", action="store_true")
+parser.add_argument("-journal", dest="journal_path", help="Progress journal file shared by all jobs. Searched cycles and files processed by nceplibs are recorded in it, and skipped when a failed run is restarted with the same journal.", default=None, type=str)
+parser.add_argument("-ingest_socket", dest="ingest_socket", help="Start a single ingest writer listening on this Unix socket and send the database writes of all jobs to it.", default=None, type=str)
+parser.add_argument("-shard_dir", dest="shard_dir", help="Each job writes to its own sqlite shard in this directory, the shards are merged into the database once all jobs finish.", default=None, type=str)
 parser.add_argument("--list", dest="var_list", help="List of the variables to inventory with spaces between each, will only be used if -cat is list", type=str, nargs='+')
 args = parser.parse_args()
 
@@ -40,6 +47,14 @@ if args.days_ago < 0:
     print(f'Argument -ago value {args.days_ago} is not a positive value, please give a valid positive integer to use the -ago argument.')
     quit()
 
+if args.lookback_hours < 0:
+    print(f'Argument -lookback value {args.lookback_hours} is not a positive value, please give a valid positive integer to use the -lookback argument.')
+    quit()
+
+if args.shard_dir != None and (args.incremental or args.journal_path != None):
+    print('Argument -shard_dir can not be used with -incremental or -journal, the shards do not hold the progress of earlier runs.')
+    quit()
+
 #get category list
 # more categories to be added as they are written as dictionaries 
 # remember to add new categories to the argparser options and here
@@ -65,6 +80,8 @@ if args.category == 'list':
 
 #Import CLI here so that we only connect to the database if the arguments were valid 
 import obs_inv_utils.obs_inv_cli as cli
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils import connection_pools
 
 #function to determine the start and end time for inventory calls based on given info  
 def get_start_end_time(inventory_info):
@@ -95,7 +112,14 @@ def run_obs_inventory(inventory_info):
     start_time, end_time = get_start_end_time(inventory_info)
 
     yaml_file = yg.generate_obs_inv_config(inventory_info, start_time, end_time)
-    cli.get_obs_inventory_base(yaml_file)
+    cli.get_obs_inventory_base(
+        yaml_file,
+        args.concurrent,
+        args.incremental,
+        args.lookback_hours,
+        args.buffered,
+        args.journal_path
+    )
     os.remove(yaml_file)
 
 #call appropriate nceplibs cli command 
@@ -105,11 +129,11 @@ def run_nceplibs(inventory_info):
     #run correct command as given in dict 
     if inventory_info.nceplibs_cmd == au.NCEPLIBS_SINV:
         yaml_file = yg.generate_nceplibs_sinv_inventory_config(inventory_info, start_time, end_time, args.work_dir)
-        cli.get_obs_count_meta_sinv_base(yaml_file)
+        cli.get_obs_count_meta_sinv_base(yaml_file, args.journal_path)
         os.remove(yaml_file)
     elif inventory_info.nceplibs_cmd == au.NCEPLIBS_CMPBQM:
         yaml_file = yg.generate_nceplibs_cmpbqm_inventory_config(inventory_info, start_time, end_time, args.work_dir)
-        cli.get_obs_count_meta_cmpbqm_base(yaml_file)
+        cli.get_obs_count_meta_cmpbqm_base(yaml_file, args.journal_path)
         os.remove(yaml_file)
     else:
         print(f'No valid commmand found for nceplibs_cmd in {inventory_info.obs_name} inventory info with value: ' + inventory_info.nceplibs_cmd)
@@ -122,9 +146,40 @@ def run_full_inventory(inventory_info):
     run_nceplibs(inventory_info)
     print('NCEPlibs call complete for ' + inventory_info.obs_name)
 
+#the jobs inherit the shard directory and each write their own shard
+if args.shard_dir != None:
+    os.environ[itf.SHARD_DIR_ENV] = args.shard_dir
+
+#size the connection pool of each job for a single job, or for its search threads
+if os.getenv(connection_pools.POOL_PROFILE_ENV) == None:
+    if connection_pools.get_pool_host() != None:
+        os.environ[connection_pools.POOL_PROFILE_ENV] = connection_pools.SHARED_PROFILE
+    elif args.concurrent:
+        os.environ[connection_pools.POOL_PROFILE_ENV] = connection_pools.THREADED_PROFILE
+    else:
+        os.environ[connection_pools.POOL_PROFILE_ENV] = connection_pools.WORKER_PROFILE
+
+#start the ingest writer before the jobs so they inherit its socket
+ingest_writer = None
+if args.ingest_socket != None:
+    from obs_inv_utils import ingest_service
+    ingest_writer = ingest_service.start_ingest_writer(args.ingest_socket)
+    os.environ[ingest_service.INGEST_SOCKET_ENV] = args.ingest_socket
+
 #for each item in the category list run parallel
 #call the run obs inventory and run nceplibs from above
-Parallel(n_jobs=args.n_jobs)(delayed(run_full_inventory)(info) for info in to_inventory)
+try:
+    Parallel(n_jobs=args.n_jobs)(delayed(run_full_inventory)(info) for info in to_inventory)
+finally:
+    if ingest_writer != None:
+        ingest_service.stop_ingest_writer(ingest_writer)
+
+if args.shard_dir != None:
+    from obs_inv_utils import shard_merge
+    del os.environ[itf.SHARD_DIR_ENV]
+    #drop this process's shard connections if jobs ran in process
+    itf.dispose_engine()
+    shard_merge.merge_shards(args.shard_dir)
 
 print('Auto inventory script completed for ')
 for i in to_inventory: print(i.obs_name)
@@ -8,6 +8,8 @@ NCEPLIBS_SINV = 'sinv'
 NCEPLIBS_CMPBQM = 'cmpbqm'
 
 CLEAN_PLATFORM = 'aws_s3_clean'
+# clean bucket keys for a month share one directory, list it once per month
+CLEAN_PLATFORM_LISTING = 'prefix'
 REANALYSIS_BUCKET = 'noaa-reanlyses-pds'
 
 PRIVATE_EUMETSAT_PLATFORM = 'aws_s3_private'
@@ -12,7 +12,7 @@ cd $(dirname $0)
 source ../../obs_inv_utils_pw_inv_cluster.sh
 
 #run inventory 
-python3 auto_inventory.py -cat list -n_jobs 80 -work_dir $WORK_DIR --list airs_airsev airs_aqua amsua_1bamua amsua_nasa_aqua amsua_nasa_r21c \
+python3 auto_inventory.py -cat list -n_jobs 80 -incremental -lookback 72 -work_dir $WORK_DIR --list airs_airsev airs_aqua amsua_1bamua amsua_nasa_aqua amsua_nasa_r21c \
     amsub_1bamub amv_satwnd atms_atms avhrr_avcsam avhrr_avcspm cris_cris cris_crisf4 geo_ahicsr geo_geoimr \
     geo_goesfv geo_goesnd geo_gsrasr geo_gsrcsr gmi_nasa_gmiv7 gps_gpsro hirs_1bhrs3 hirs_1bhrs4 \
     iasi_mtiasi mhs_1bmhs ozone_nasa_sbuv_v87 ozone_ncep_gome ozone_ncep_mls ozone_ncep_omi ozone_ncep_ompslp \
@@ -22,6 +22,12 @@ def generate_obs_inv_config(inventory_info, start_time, end_time):
         end = end_time.strftime(au.DATESTR_FORMAT)
     else:
         end = end_time
+    search_info = {
+        'platform':inventory_info.platform,
+        'key':inventory_info.key 
+    }
+    if inventory_info.platform == au.CLEAN_PLATFORM:
+        search_info['listing'] = au.CLEAN_PLATFORM_LISTING
     body = {
         'cycling_interval': inventory_info.cycling_interval,
         'date_range': {
@@ -29,11 +35,7 @@ def generate_obs_inv_config(inventory_info, start_time, end_time):
             'start': start,
             'end': end
         },
-        'search_info':[{
-            'platform':inventory_info.platform,
-            'key':inventory_info.key 
-            }
-        ],
+        'search_info':[search_info],
     }
     outfile = open(yaml_file_path, 'w')
     yaml.dump(body, outfile)
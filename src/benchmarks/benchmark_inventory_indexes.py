@@ -0,0 +1,123 @@
+'''
+Benchmark of the inventory table indexes.
+Fills a scratch sqlite database with synthetic obs_inventory and
+obs_meta_nceplibs_bufr rows, drops the indexes managed by
+inventory_table_factory.INVENTORY_INDEXES, times the queries used by the
+nceplibs handlers and the plots, adds the indexes back with
+db_migrations.migrate and times the same queries again.
+'''
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+#argparse section
+parser = argparse.ArgumentParser()
+parser.add_argument("-days", dest="days", help="Number of days of synthetic observations.", default=365, type=int)
+parser.add_argument("-files", dest="files_per_day", help="Number of files per day, each gets one bufr meta row.", default=200, type=int)
+parser.add_argument("-repeat", dest="repeat", help="Number of times each query is run.", default=5, type=int)
+args = parser.parse_args()
+
+# point the table factory at a scratch database before its engine is
+# created
+scratch_dir = tempfile.mkdtemp(prefix='obs_inv_bench_')
+os.environ['DATABASE_TYPE'] = 'sqlite'
+os.environ['SQLITE_DATABASE'] = os.path.join(scratch_dir, 'benchmark.db')
+
+from sqlalchemy import text
+
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils import obs_inv_queries as oiq
+from obs_inv_utils import db_migrations
+from obs_inv_utils import search_engine as se
+from plotting import plot_utils
+
+START = datetime(2020, 1, 1)
+BUFR_FILES = ['gdas.t%z.1bamua.tm00.bufr_d']
+
+
+def fill_tables():
+    obs_rows = []
+    meta_rows = []
+    obs_id = 0
+    now = datetime.utcnow()
+    for day in range(args.days):
+        obs_day = START + timedelta(days=day)
+        for i in range(args.files_per_day):
+            obs_id += 1
+            filename = f'gdas.t{i % 4 * 6:02d}z.type{i}.tm00.bufr_d'
+            if i == 0:
+                filename = 'gdas.t00z.1bamua.tm00.bufr_d'
+            obs_rows.append({
+                'obs_id': obs_id, 'cmd_result_id': 1, 'filename': filename,
+                'generic_filename': se.get_generic_filename(filename),
+                'parent_dir': f'observations/type{i}/'
+                              f'{obs_day.strftime("%Y/%m/%d")}/',
+                'platform': 'aws_s3',
+                's3_bucket': 'noaa-reanalyses-pds', 'prefix': 'gdas',
+                'cycle_tag': 't00z', 'data_type': f'type{i}', 'cycle_time': 0,
+                'obs_day': obs_day, 'data_format': 'bufr_d',
+                'suffix': 'tm00.bufr_d', 'nr_tag': False, 'file_size': i,
+                'etag': '', 'permissions': '', 'last_modified': obs_day,
+                'unique_hash': str(obs_id), 'inserted_at': now,
+                'valid_at': now
+            })
+            meta_rows.append({
+                'obs_id': obs_id, 'cmd_result_id': 1, 'cmd_str': 'sinv',
+                'sat_id': i % 20, 'sat_id_name': f'sat{i % 20}',
+                'obs_count': i, 'sat_inst_id': i % 7,
+                'sat_inst_desc': f'inst{i % 7}', 'filename': filename,
+                'file_size': i, 'obs_day': obs_day, 'inserted_at': now
+            })
+
+    with itf.get_engine().begin() as connection:
+        connection.execute(
+            itf.ObsInventory.__table__.insert(), obs_rows)
+        connection.execute(
+            itf.ObsMetaNceplibsBufr.__table__.insert(), meta_rows)
+    itf.populate_latest_tables()
+    print(f'rows: {len(obs_rows)} obs_inventory, {len(meta_rows)} bufr meta')
+
+
+def drop_indexes():
+    with itf.get_engine().begin() as connection:
+        for spec in itf.INVENTORY_INDEXES:
+            connection.execute(text(f'DROP INDEX IF EXISTS {spec.name}'))
+        connection.execute(text('ANALYZE'))
+
+
+def time_query(name, query):
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - started)
+    return name, statistics.median(timings)
+
+
+def run_queries():
+    end = START + timedelta(days=args.days)
+    recent = end - timedelta(days=7)
+    return dict([
+        time_query('get_bufr_files_data, 7 days',
+                   lambda: oiq.get_bufr_files_data(BUFR_FILES, recent, end)),
+        time_query('get_bufr_files_data, all days',
+                   lambda: oiq.get_bufr_files_data(BUFR_FILES, START, end)),
+        time_query('plot_utils.get_distinct_bufr',
+                   plot_utils.get_distinct_bufr),
+    ])
+
+
+fill_tables()
+drop_indexes()
+before = run_queries()
+db_migrations.migrate()
+after = run_queries()
+
+print(f'database: {os.environ["SQLITE_DATABASE"]}')
+for name in before:
+    print(f'{name:>32}: before {1000*before[name]:9.2f} ms, '
+          f'after {1000*after[name]:9.2f} ms, '
+          f'speedup {before[name]/after[name]:6.1f}x')
@@ -0,0 +1,111 @@
+'''
+Benchmark of the obs_inventory upsert.
+Compares the previous statement, rebuilt with every row inlined as a
+multi-row VALUES list for each 1000 rows, with the cached statement run
+through executemany in adaptive chunks by
+inventory_table_factory.insert_obs_inv_rows.  Each is timed inserting new
+rows and upserting the same rows again.  Uses a scratch sqlite database,
+or with -mysql the MySQL database from the .env file, where the benchmark
+rows are deleted afterwards.
+'''
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime
+
+#argparse section
+parser = argparse.ArgumentParser()
+parser.add_argument("-rows", dest="rows", help="Number of obs_inventory rows per run.", default=50000, type=int)
+parser.add_argument("-mysql", dest="mysql", help="Use the MySQL database configured in the .env file.", action="store_true")
+args = parser.parse_args()
+
+if args.mysql:
+    os.environ['DATABASE_TYPE'] = 'mysql'
+else:
+    scratch_dir = tempfile.mkdtemp(prefix='obs_inv_bench_')
+    os.environ['DATABASE_TYPE'] = 'sqlite'
+    os.environ['SQLITE_DATABASE'] = os.path.join(scratch_dir, 'benchmark.db')
+
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+
+BENCHMARK_BUCKET = 'obs-inv-benchmark'
+PREVIOUS_CHUNK_SIZE = 1000
+
+
+def get_rows(run):
+    now = datetime.utcnow()
+    return itf.get_obs_inv_rows([
+        se.TarballFileMeta(
+            1, f'gdas.t00z.{run}.{i}.tm00.bufr_d', f'benchmark/{run}/',
+            platforms.AWS_S3, BENCHMARK_BUCKET, 'gdas', 't00z', run, 0,
+            datetime(2020, 1, 1), 'bufr_d', 'tm00.bufr_d', False, i, '',
+            now, now, 0.1, now, now, 'abc'
+        ) for i in range(args.rows)
+    ])
+
+
+def get_previous_statement(rows):
+    if itf.get_database_type() == 'mysql':
+        statement = mysql_insert(itf.ObsInventory).values(rows)
+        return statement.on_duplicate_key_update(
+            valid_at=statement.inserted.valid_at,
+            generic_filename=statement.inserted.generic_filename
+        )
+
+    statement = sqlite_insert(itf.ObsInventory).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=['unique_hash', 'obs_day', 'file_size',
+                        'last_modified', 'etag'],
+        set_={
+            'valid_at': statement.excluded.valid_at,
+            'generic_filename': statement.excluded.generic_filename
+        }
+    )
+
+
+def insert_previous(session, rows):
+    for i in range(0, len(rows), PREVIOUS_CHUNK_SIZE):
+        session.execute(get_previous_statement(rows[i:i + PREVIOUS_CHUNK_SIZE]))
+
+
+def time_insert(insert, rows):
+    session = itf.Session()
+    started = time.perf_counter()
+    insert(session, rows)
+    session.commit()
+    elapsed = time.perf_counter() - started
+    session.close()
+    return len(rows) / elapsed
+
+
+def delete_benchmark_rows():
+    session = itf.Session()
+    session.query(itf.ObsInventory).filter(
+        itf.ObsInventory.s3_bucket == BENCHMARK_BUCKET
+    ).delete(synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+results = {}
+try:
+    for name, insert in [
+        ('multi-row VALUES', insert_previous),
+        ('cached executemany', itf.insert_obs_inv_rows),
+    ]:
+        rows = get_rows(name.replace(' ', '_'))
+        results[name] = (time_insert(insert, rows), time_insert(insert, rows))
+finally:
+    if args.mysql:
+        delete_benchmark_rows()
+
+print(f'database: {itf.get_engine().url}, rows: {args.rows}')
+for name, (insert_rate, upsert_rate) in results.items():
+    print(f'{name:>20}: insert {insert_rate:9.0f} rows/s, '
+          f'upsert existing {upsert_rate:9.0f} rows/s')
@@ -0,0 +1,137 @@
+'''
+Benchmark of the memory used by the plot frames.
+Fills a scratch sqlite database with synthetic obs_inventory and latest
+bufr and prepbufr meta rows, then builds the frame of each plot query and
+prints its peak memory while it is built (tracemalloc) and the memory the
+finished frame holds (DataFrame.memory_usage with deep=True).  The
+previous get_distinct_bufr, a dict per row turned into a frame of objects,
+is measured next to the typed frames built by obs_inv_queries.read_frame.
+'''
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+#argparse section
+parser = argparse.ArgumentParser()
+parser.add_argument("-days", dest="days", help="Number of days of synthetic observations.", default=365, type=int)
+parser.add_argument("-files", dest="files_per_day", help="Number of files per day, each gets one bufr and one prepbufr meta row.", default=200, type=int)
+args = parser.parse_args()
+
+# point the table factory at a scratch database before its engine is
+# created
+scratch_dir = tempfile.mkdtemp(prefix='obs_inv_bench_')
+os.environ['DATABASE_TYPE'] = 'sqlite'
+os.environ['SQLITE_DATABASE'] = os.path.join(scratch_dir, 'benchmark.db')
+
+import pandas
+
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils import obs_inv_queries as oiq
+from obs_inv_utils import search_engine as se
+from plotting import plot_utils
+
+START = datetime(2020, 1, 1)
+
+
+def fill_tables():
+    obs_rows = []
+    bufr_rows = []
+    prepbufr_rows = []
+    obs_id = 0
+    now = datetime.utcnow()
+    for day in range(args.days):
+        obs_day = START + timedelta(days=day)
+        for i in range(args.files_per_day):
+            obs_id += 1
+            filename = f'gdas.t{i % 4 * 6:02d}z.type{i}.tm00.bufr_d'
+            parent_dir = f'observations/reanalysis/type{i % 40}/' \
+                         f'{obs_day.strftime("%Y/%m/%d")}/'
+            obs_rows.append({
+                'obs_id': obs_id, 'cmd_result_id': 1, 'filename': filename,
+                'generic_filename': se.get_generic_filename(filename),
+                'parent_dir': parent_dir,
+                'sensor': se.get_sensor(parent_dir),
+                'stream': se.get_stream(parent_dir),
+                'source_dir': se.get_source_dir(parent_dir),
+                'platform': 'aws_s3',
+                's3_bucket': oiq.REANALYSES_BUCKET, 'prefix': 'gdas',
+                'cycle_tag': 't00z', 'data_type': f'type{i}', 'cycle_time': 0,
+                'obs_day': obs_day, 'data_format': 'bufr_d',
+                'suffix': 'tm00.bufr_d', 'nr_tag': False, 'file_size': i,
+                'etag': '', 'permissions': '', 'last_modified': obs_day,
+                'unique_hash': str(obs_id), 'inserted_at': now,
+                'valid_at': now
+            })
+            bufr_rows.append({
+                'obs_id': obs_id, 'sat_id': i % 20,
+                'sat_id_name': f'sat{i % 20}', 'obs_count': i,
+                'sat_inst_id': i % 7, 'sat_inst_desc': f'inst{i % 7}',
+                'filename': filename, 'file_size': i, 'obs_day': obs_day,
+                'inserted_at': now
+            })
+            prepbufr_rows.append({
+                'obs_id': obs_id, 'variable': f'var{i % 8}',
+                'typ': 120 + i % 60, 'tot': i, 'qm0thru3': i,
+                'filename': filename, 'file_size': i, 'obs_day': obs_day,
+                'inserted_at': now
+            })
+
+    with itf.get_engine().begin() as connection:
+        connection.execute(itf.ObsInventory.__table__.insert(), obs_rows)
+        connection.execute(
+            itf.ObsMetaNceplibsBufrLatest.__table__.insert(), bufr_rows)
+        connection.execute(
+            itf.ObsMetaNceplibsPrepbufrLatest.__table__.insert(),
+            prepbufr_rows)
+    print(f'rows: {len(obs_rows)} obs_inventory, {len(bufr_rows)} bufr '
+          f'meta, {len(prepbufr_rows)} prepbufr meta')
+
+
+def get_distinct_bufr_dicts():
+    session = itf.Session()
+    omnbl = itf.ObsMetaNceplibsBufrLatest
+    oi = itf.ObsInventory
+    results = session.query(
+        omnbl.obs_id, omnbl.filename, omnbl.sat_id, omnbl.sat_id_name,
+        omnbl.obs_count, omnbl.obs_day, omnbl.file_size, oi.parent_dir,
+        oi.s3_bucket
+    ).join(
+        oi, omnbl.obs_id == oi.obs_id
+    ).filter(
+        oi.s3_bucket == oiq.REANALYSES_BUCKET
+    ).all()
+    df = pandas.DataFrame([result._asdict() for result in results])
+    session.close()
+    return df
+
+
+def measure(build_frame):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    df = build_frame()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(df), elapsed, peak, df.memory_usage(deep=True).sum()
+
+
+fill_tables()
+results = {
+    'get_distinct_bufr, dict rows': measure(get_distinct_bufr_dicts),
+    'plot_utils.get_distinct_bufr': measure(plot_utils.get_distinct_bufr),
+    'plot_utils.get_distinct_prepbufr':
+        measure(plot_utils.get_distinct_prepbufr),
+    'oiq.get_bufr_daily_counts': measure(oiq.get_bufr_daily_counts),
+    'oiq.get_prepbufr_daily_counts': measure(oiq.get_prepbufr_daily_counts),
+}
+
+print(f'database: {os.environ["SQLITE_DATABASE"]}')
+mib = 1024 * 1024
+for name, (rows, elapsed, peak, steady) in results.items():
+    print(f'{name:>34}: {rows:8d} rows, {1000*elapsed:8.1f} ms, '
+          f'peak {peak/mib:8.1f} MiB, frame {steady/mib:8.1f} MiB')
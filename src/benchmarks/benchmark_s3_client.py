@@ -0,0 +1,60 @@
+'''
+Benchmark of s3 client reuse for the aws s3 command handlers.
+Sends the same list_objects_v2 request repeatedly, once creating a new boto3
+client for every request (the old AwsS3CommandHandler behavior) and once
+using the process wide pooled client from aws_s3_interface.get_s3_client,
+then prints the client setup time and the per request latency of each.
+'''
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+from obs_inv_utils import aws_s3_interface as s3
+
+#argparse section
+parser = argparse.ArgumentParser()
+parser.add_argument("-prefix", dest="prefix", help="S3 prefix to list on every request.", default="observations/reanalysis/airs/airsev/2020/01/bufr/", type=str)
+parser.add_argument("-n", dest="n_requests", help="Number of requests to send for each client strategy.", default=50, type=int)
+parser.add_argument("-threads", dest="threads", help="Number of threads sending requests.", default=1, type=int)
+args = parser.parse_args()
+
+
+def new_client():
+    return boto3.client('s3', config=s3.bdp_config)
+
+
+def pooled_client():
+    return s3.get_s3_client(s3.AWS_BDP_BUCKET)
+
+
+def timed_request(get_client):
+    start = time.perf_counter()
+    client = get_client()
+    setup = time.perf_counter() - start
+    client.list_objects_v2(Bucket=s3.AWS_BDP_BUCKET, Prefix=args.prefix)
+    total = time.perf_counter() - start
+    return setup, total
+
+
+def run(name, get_client):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        timings = list(executor.map(
+            lambda _: timed_request(get_client), range(args.n_requests)))
+    elapsed = time.perf_counter() - started
+
+    setups = [setup for setup, _ in timings]
+    totals = sorted(total for _, total in timings)
+    p95 = totals[int(0.95 * (len(totals) - 1))]
+    print(f'{name:>8}: setup mean {1000*statistics.mean(setups):8.2f} ms, '
+          f'request median {1000*statistics.median(totals):8.2f} ms, '
+          f'p95 {1000*p95:8.2f} ms, wall {elapsed:6.2f} s')
+
+
+s3.clear_s3_clients()
+print(f'prefix: {args.prefix}, requests: {args.n_requests}, threads: {args.threads}')
+run('new', new_client)
+run('pooled', pooled_client)
@@ -0,0 +1,105 @@
+'''
+Benchmark of many processes writing to one sqlite inventory database.
+Starts -writers processes, like auto_inventory.py -n_jobs, that each write
+-batches search results of -rows files through
+inventory_table_factory.insert_cmd_results_with_obs_inv_items.  It runs once
+with the sqlite defaults (rollback journal, synchronous=FULL, 5 s busy
+timeout, no retries) and once with the sqlite_tuning settings from the
+environment, and prints the rows written per second and the batches that
+failed with "database is locked".
+'''
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime
+
+#argparse section
+parser = argparse.ArgumentParser()
+parser.add_argument("-writers", dest="writers", help="Number of writer processes.", default=32, type=int)
+parser.add_argument("-batches", dest="batches", help="Number of search results written by each process.", default=20, type=int)
+parser.add_argument("-rows", dest="rows", help="Number of files in each search result.", default=200, type=int)
+
+# environment of the writers for each profile, the tuned profile uses the
+# sqlite_tuning defaults and any overrides already in the environment
+PROFILES = {
+    'sqlite defaults': {
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_BUSY_TIMEOUT': '5000',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_SIZE': '-2000',
+        'SQLITE_BUSY_RETRIES': '0',
+    },
+    'tuned': {},
+}
+
+
+def write_results(writer, profile_env, database, batches, rows_per_batch):
+    os.environ.update(profile_env)
+    os.environ['DATABASE_TYPE'] = 'sqlite'
+    os.environ['SQLITE_DATABASE'] = database
+
+    from sqlalchemy.exc import OperationalError
+    from obs_inv_utils import inventory_table_factory as itf
+    from obs_inv_utils import search_engine as se
+
+    itf.get_engine()
+    now = datetime.utcnow()
+    obs_day = datetime(2020, 1, 1)
+    written = 0
+    failed = 0
+    for batch in range(batches):
+        cmd_result_data = itf.CmdResultData(
+            'list_objects', f'{writer}/{batch}', '{}', '', 200, obs_day,
+            now, 0.1, now)
+        files_meta = [
+            se.TarballFileMeta(
+                None, f'gdas.t00z.w{writer}b{batch}r{row}.tm00.bufr_d',
+                f'bench/{writer}/', 'aws_s3', 'bench-bucket', 'gdas', 't00z',
+                f'w{writer}', 0, obs_day, 'bufr_d', 'tm00.bufr_d', False,
+                row, '', now, now, 0.1, now, now, ''
+            ) for row in range(rows_per_batch)
+        ]
+        try:
+            itf.insert_cmd_results_with_obs_inv_items(
+                [(cmd_result_data, files_meta)])
+            written += rows_per_batch
+        except OperationalError as e:
+            print(f'writer {writer} batch {batch} failed, error: {e.orig}')
+            failed += 1
+
+    return written, failed
+
+
+def run_profile(name, profile_env, args):
+    scratch_dir = tempfile.mkdtemp(prefix='obs_inv_bench_')
+    database = os.path.join(scratch_dir, 'contention.db')
+
+    context = multiprocessing.get_context('spawn')
+    started = time.perf_counter()
+    with context.Pool(args.writers) as pool:
+        results = pool.starmap(write_results, [
+            (writer, profile_env, database, args.batches, args.rows)
+            for writer in range(args.writers)
+        ])
+    elapsed = time.perf_counter() - started
+
+    written = sum(result[0] for result in results)
+    failed = sum(result[1] for result in results)
+    return name, written, failed, elapsed
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    summary = [
+        run_profile(name, profile_env, args)
+        for name, profile_env in PROFILES.items()
+    ]
+
+    print(f'{args.writers} writers, {args.batches} batches of {args.rows} '
+          f'rows each')
+    for name, written, failed, elapsed in summary:
+        print(f'{name:>16}: {written:8d} rows in {elapsed:7.2f} s, '
+              f'{written/elapsed:9.0f} rows/s, failed batches: {failed}')
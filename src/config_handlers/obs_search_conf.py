@@ -9,6 +9,7 @@ import attr
 # local imports
 import obs_inv_utils
 from obs_inv_utils import config_base
+from obs_inv_utils import obs_storage_platforms as platforms
 from obs_inv_utils.config_base import ConfigInterface
 from obs_inv_utils.yaml_utils import YamlLoader
 from obs_inv_utils import time_utils
@@ -16,6 +17,14 @@ from obs_inv_utils.time_utils import DateRange
 
 
 SEARCH_PATH_KEY = 'key'
+LISTING_MODE_KEY = 'listing'
+
+# 'cycle' lists the fully qualified key of every cycle, 'prefix' lists the
+# directory holding the keys once and matches the cycles locally
+LISTING_CYCLE = 'cycle'
+LISTING_PREFIX = 'prefix'
+LISTING_MODES = [LISTING_CYCLE, LISTING_PREFIX]
+PREFIX_LISTING_PLATFORMS = [platforms.AWS_S3_CLEAN]
 
 
 @dataclass
@@ -35,9 +44,28 @@ class ObsSearchConfig(object):
         if not isinstance(self.date_range, DateRange):
             self.date_range = DateRange()
 
+        listing_mode = self.get_listing_mode()
+        if listing_mode not in LISTING_MODES:
+            msg = f'Invalid listing mode: {listing_mode}, must be one of ' \
+                  f'{LISTING_MODES}.'
+            raise ValueError(msg)
+
+        if (listing_mode == LISTING_PREFIX and
+                self.storage_platform not in PREFIX_LISTING_PLATFORMS):
+            msg = f'Listing mode {LISTING_PREFIX} is only supported for ' \
+                  f'platforms {PREFIX_LISTING_PLATFORMS}, not ' \
+                  f'{self.storage_platform}.'
+            raise ValueError(msg)
+
     def get_storage_platform(self):
         return self.storage_platform
 
+    def get_listing_mode(self):
+        return self.search_config.get(LISTING_MODE_KEY, LISTING_CYCLE)
+
+    def uses_prefix_listing(self):
+        return self.get_listing_mode() == LISTING_PREFIX
+
     def get_date_range(self):
         return self.date_range
 
@@ -45,9 +73,11 @@ class ObsSearchConfig(object):
         return self.cycle_intervals
 
     def get_current_search_path(self):
-        current = self.date_range.current
+        return self.get_search_path(self.date_range.current)
+
+    def get_search_path(self, cycle_time):
         path = time_utils.get_datetime_str(
-            current, self.search_config.get(SEARCH_PATH_KEY)
+            cycle_time, self.search_config.get(SEARCH_PATH_KEY)
         )
         print(f'path: {path}')
         return path
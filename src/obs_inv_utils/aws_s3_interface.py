@@ -1,5 +1,9 @@
 import re
 import os
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from collections import namedtuple, OrderedDict
 import attr
@@ -8,6 +12,8 @@ from datetime import datetime
 from botocore.config import Config
 from botocore import UNSIGNED
 
+from obs_inv_utils.env_utils import get_env_number
+
 session = boto3.Session()
 
 bdp_config = Config(
@@ -19,6 +25,32 @@ bdp_config = Config(
     }
 )
 
+# size of each client's urllib3 connection pool, should be at least the
+# number of threads sharing the client (see OBS_INV_MAX_WORKERS_AWS_S3)
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+MAX_POOL_CONNECTIONS_ENV = 'AWS_S3_MAX_POOL_CONNECTIONS'
+
+# downloads are split into ranged GETs of DOWNLOAD_PART_SIZE bytes with at
+# most DOWNLOAD_CONCURRENCY parts in flight (and held in memory) at once
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DOWNLOAD_PART_SIZE_ENV = 'AWS_S3_DOWNLOAD_PART_SIZE'
+DEFAULT_DOWNLOAD_CONCURRENCY = 8
+DOWNLOAD_CONCURRENCY_ENV = 'AWS_S3_DOWNLOAD_CONCURRENCY'
+PARTIAL_DOWNLOAD_SUFFIX = '.part'
+# etag of the object a partial download was taken from, kept next to it
+PARTIAL_ETAG_SUFFIX = '.etag'
+
+BDP_CLIENT_CONFIG = 'bdp'
+s3_client_configs = {
+    BDP_CLIENT_CONFIG: bdp_config
+}
+
+# boto3 clients are thread safe once created, so one client (and therefore
+# one connection pool) is shared per bucket and config for the life of the
+# process instead of being created for every command
+s3_clients = {}
+s3_clients_lock = threading.Lock()
+
 nl = '\n'
 
 AwsS3ObjectsListContents = namedtuple(
@@ -70,18 +102,175 @@ AwsS3Command = namedtuple(
 
 AWS_BDP_BUCKET = 'noaa-reanalyses-pds'
 CMD_GET_S3_OBJ_LIST = 'list_objects'
+CMD_GET_S3_OBJ_LIST_PAGES = 'list_objects_pages'
 CMD_DOWNLOAD_S3_OBJ = 'download_file'
 
-def get_bdp_s3_client():
-    try:
-        client = boto3.client('s3', config=bdp_config)
-    except Exception as e:
-        msg = f'Problem getting boto3 s3 client - error: {e}'
+# list_objects_v2 returns at most 1000 keys per call
+DEFAULT_LIST_PAGE_SIZE = 1000
+
+def get_max_pool_connections():
+    return get_env_number(
+        MAX_POOL_CONNECTIONS_ENV, DEFAULT_MAX_POOL_CONNECTIONS, int,
+        positive=True)
+
+
+def get_pooled_config(config_name):
+    config = s3_client_configs.get(config_name)
+    if config is None:
+        msg = f'Unknown s3 client config: {config_name}, must be one of ' \
+              f'{list(s3_client_configs.keys())}'
         raise ValueError(msg)
 
+    return config.merge(Config(
+        max_pool_connections=get_max_pool_connections(),
+        tcp_keepalive=True
+    ))
+
+
+def get_s3_client(bucket=AWS_BDP_BUCKET, config_name=BDP_CLIENT_CONFIG):
+    """
+    Return the process wide s3 client for the bucket and config, creating
+    it on first use.  Reusing the client keeps its pooled, kept alive
+    connections open across commands.
+    """
+    client_key = (bucket, config_name)
+    with s3_clients_lock:
+        client = s3_clients.get(client_key)
+        if client is None:
+            try:
+                client = session.client(
+                    's3', config=get_pooled_config(config_name))
+            except Exception as e:
+                msg = f'Problem getting boto3 s3 client - error: {e}'
+                raise ValueError(msg)
+            s3_clients[client_key] = client
+
     return client
 
 
+def clear_s3_clients():
+    with s3_clients_lock:
+        s3_clients.clear()
+
+
+def get_bdp_s3_client():
+    return get_s3_client(AWS_BDP_BUCKET, BDP_CLIENT_CONFIG)
+
+
+def get_object_range(client, bucket, s3_object_key, etag, start, end):
+    # IfMatch makes the request fail if the object changes mid download
+    response = client.get_object(
+        Bucket=bucket,
+        Key=s3_object_key,
+        Range=f'bytes={start}-{end}',
+        IfMatch=f'"{etag}"'
+    )
+    return response['Body'].read()
+
+
+def get_partial_etag_path(partial_path):
+    return partial_path + PARTIAL_ETAG_SUFFIX
+
+
+def remove_partial_download(partial_path):
+    for path in [partial_path, get_partial_etag_path(partial_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_partial_download(partial_path, object_size, etag):
+    """
+    Return the size and running md5 of a partially downloaded file so the
+    download can resume where it stopped.  The existing bytes are read once
+    to seed the md5.  A partial file larger than the object, or taken from
+    an object with a different etag, is discarded, and the etag of the
+    object being downloaded is recorded next to the partial file.
+    """
+    md5 = hashlib.md5()
+    etag_path = get_partial_etag_path(partial_path)
+    partial_etag = None
+    if os.path.exists(etag_path):
+        with open(etag_path) as etag_file:
+            partial_etag = etag_file.read().strip()
+
+    offset = 0
+    if os.path.exists(partial_path):
+        offset = Path(partial_path).stat().st_size
+        if offset > object_size or partial_etag != etag:
+            print(f'discarding partial download {partial_path}, etag: '
+                  f'{partial_etag}, object etag: {etag}')
+            remove_partial_download(partial_path)
+            offset = 0
+
+    if offset == 0:
+        with open(etag_path, 'w') as etag_file:
+            etag_file.write(etag)
+    else:
+        with open(partial_path, 'rb') as partial_file:
+            for chunk in iter(lambda: partial_file.read(1024 * 1024), b''):
+                md5.update(chunk)
+
+    return offset, md5
+
+
+def download_object_ranges(
+    client,
+    bucket,
+    s3_object_key,
+    etag,
+    partial_path,
+    offset,
+    object_size,
+    md5
+):
+    """
+    Download bytes [offset, object_size) with parallel ranged GETs,
+    appending the parts to 'partial_path' in order and updating 'md5' as
+    each part is written.  The parts are requested through a sliding window
+    so at most DOWNLOAD_CONCURRENCY parts are in memory at once.  If a part
+    fails, everything before it is already on disk for the next attempt to
+    resume from.
+    """
+    part_size = get_env_number(
+        DOWNLOAD_PART_SIZE_ENV, DEFAULT_DOWNLOAD_PART_SIZE, int, positive=True)
+    concurrency = get_env_number(
+        DOWNLOAD_CONCURRENCY_ENV, DEFAULT_DOWNLOAD_CONCURRENCY, int,
+        positive=True)
+
+    part_starts = iter(range(offset, object_size, part_size))
+    in_flight = deque()
+
+    def submit_next_part(executor):
+        part_start = next(part_starts, None)
+        if part_start is None:
+            return
+        part_end = min(part_start + part_size, object_size) - 1
+        in_flight.append(executor.submit(
+            get_object_range,
+            client,
+            bucket,
+            s3_object_key,
+            etag,
+            part_start,
+            part_end
+        ))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            open(partial_path, 'ab') as partial_file:
+        try:
+            for _ in range(concurrency):
+                submit_next_part(executor)
+
+            while len(in_flight) > 0:
+                part = in_flight.popleft().result()
+                partial_file.write(part)
+                md5.update(part)
+                submit_next_part(executor)
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
 def download_s3_object(
         client,
         bucket=None,
@@ -93,34 +282,62 @@ def download_s3_object(
         f'{s3_object_key}, dest_full_path: {dest_full_path}, ' \
         f'expected_size: {expected_size}')
 
-    # remove file if it exists
+    # remove file if it exists, partial downloads are kept separately
     try:
         if os.path.exists(dest_full_path):
             os.remove(dest_full_path)
     except Exception as e:
         print(f'Problem deleting file: {dest_full_path}, error: {e}')
         return None    
-    
-    try:
-        client.download_file(
-            Bucket=bucket, Key=s3_object_key, Filename=dest_full_path)
-    except Exception as e:
-        print(f'Problem downloading s3 file - key: {s3_object_key}, error: {e}')
 
+    partial_path = dest_full_path + PARTIAL_DOWNLOAD_SUFFIX
     statusCode = 404
     actual_size = 0
+    resumed_from = 0
+    md5_hex = None
     try:
-        actual_size = Path(dest_full_path).stat().st_size
+        head = client.head_object(Bucket=bucket, Key=s3_object_key)
+        object_size = head['ContentLength']
+        etag = head['ETag'][1:-1]
+
+        resumed_from, md5 = get_partial_download(
+            partial_path, object_size, etag)
+        print(f'downloading {s3_object_key}, object_size: {object_size}, '
+              f'resumed_from: {resumed_from}')
+        download_object_ranges(
+            client,
+            bucket,
+            s3_object_key,
+            etag,
+            partial_path,
+            resumed_from,
+            object_size,
+            md5
+        )
+        actual_size = Path(partial_path).stat().st_size
+        md5_hex = md5.hexdigest()
     except Exception as e:
-        msg = f'Problem getting actual file size for file: {dest_full_path}'
-        reason = msg
+        msg = f'Problem downloading s3 file - key: {s3_object_key}, ' \
+              f'error: {e}'
+        print(msg)
     else:
-        statusCode = 200
-        msg = f'Download succeeded.'
+        # multipart upload etags are not the md5 of the object
+        if actual_size != object_size:
+            msg = f'Incomplete download, object_size: {object_size}, ' \
+                  f'actual_size: {actual_size}'
+        elif '-' not in etag and md5_hex != etag:
+            msg = f'Corrupt download, md5: {md5_hex}, etag: {etag}'
+            remove_partial_download(partial_path)
+        else:
+            os.replace(partial_path, dest_full_path)
+            remove_partial_download(partial_path)
+            statusCode = 200
+            msg = f'Download succeeded.'
 
-    if actual_size != expected_size:
-        msg = f'Incomplete download or corrupt file, expected_size: ' \
-            f'{expected_size}, actual_size: {actual_size}'
+            if actual_size != expected_size:
+                msg = f'Downloaded file size differs from the inventory, ' \
+                      f'expected_size: {expected_size}, ' \
+                      f'actual_size: {actual_size}'
 
     response = {
         'ResponseMetadata': {
@@ -129,9 +346,11 @@ def download_s3_object(
             'Key': s3_object_key,
             'Filename': dest_full_path,
             'actual_size': actual_size,
-            'expected_size': expected_size
+            'expected_size': expected_size,
+            'resumed_from': resumed_from,
+            'md5': md5_hex
         },
-        'Contents': {'file_downloaded': True},
+        'Contents': {'file_downloaded': (statusCode == 200)},
         'success': (statusCode == 200),
         'message': msg
     }
@@ -147,7 +366,30 @@ def get_s3_objects_list(client, bucket=None, prefix=None):
         print(msg)
 
     return response
-        
+
+
+def get_s3_objects_pages(client, bucket=None, prefix=None, start_after=None):
+    """
+    Generator yielding every list_objects_v2 response page for the prefix.
+    The paginator follows IsTruncated/NextContinuationToken so prefixes
+    holding more than 1000 keys are listed completely, and only one page
+    is held in memory at a time.  If 'start_after' is given only keys
+    sorting after it are listed.
+    """
+    paginate_kwargs = {
+        'Bucket': bucket,
+        'Prefix': prefix,
+        'PaginationConfig': {'PageSize': DEFAULT_LIST_PAGE_SIZE}
+    }
+    if start_after is not None:
+        paginate_kwargs['StartAfter'] = start_after
+
+    paginator = client.get_paginator('list_objects_v2')
+    page_iterator = paginator.paginate(**paginate_kwargs)
+
+    for page in page_iterator:
+        yield page
+
 
 def get_objects_list_args_valid(args):
     if not isinstance(args, list):
@@ -173,6 +415,23 @@ def get_objects_list_args_valid(args):
     return {'bucket': AWS_BDP_BUCKET, 'prefix': args[0]}
 
 
+def get_objects_pages_args_valid(args):
+    """
+    Same as get_objects_list_args_valid with an optional second argument,
+    the key to start listing after.
+    """
+    if not isinstance(args, list):
+        msg = f'Args must be in the form of a list, args: {args}'
+        raise TypeError(msg)
+
+    if len(args) != 2:
+        return get_objects_list_args_valid(args)
+
+    kwargs = get_objects_list_args_valid(args[:1])
+    kwargs['start_after'] = args[1]
+    return kwargs
+
+
 def download_s3_obj_args_valid(args):
     print(f'inside download_s3_obj_args_valid - args: {args}')
     return {
@@ -196,7 +455,8 @@ def s3_object_list_v2_parser(obj_list_contents, obs_cycle_time):
 
     # print(f'obs_cycle_time: {obs_cycle_time}, contents: {obj_list_contents}')
 
-    object_list = obj_list_contents.output.get('Contents')
+    # a page with no matching keys has no 'Contents' entry at all
+    object_list = obj_list_contents.output.get('Contents', [])
     # print(f'object_list: {object_list}')
 
     files_meta = list()
@@ -234,6 +494,11 @@ aws_s3_cmds = {
         get_objects_list_args_valid,
         s3_object_list_v2_parser,
     ),
+    'list_objects_pages': AwsS3Command(
+        get_s3_objects_pages,
+        get_objects_pages_args_valid,
+        s3_object_list_v2_parser,
+    ),
     'download_file': AwsS3Command(
         download_s3_object,
         download_s3_obj_args_valid,
@@ -269,7 +534,8 @@ class AwsS3CommandHandler(object):
         # it will blow up here if the arguments are invalid
         self.kwargs = self.cmd_obj.arg_validator(self.args)
 
-        self.client = get_bdp_s3_client()
+        self.client = get_s3_client(
+            self.kwargs.get('bucket', AWS_BDP_BUCKET))
         print(f'kwargs: {self.kwargs}')
 
 
@@ -281,6 +547,34 @@ class AwsS3CommandHandler(object):
         except Exception as e:
             msg = f'Error after sending command {self.command}, error: {e}.'
             raise ValueError(msg)
+
+        return self.set_raw_response(response)
+
+
+    def send_pages(self):
+        """
+        Generator version of 'send' for paginated commands.  Before each
+        page's success flag is yielded, the page is stored as this handler's
+        raw response, so 'get_raw_response' and 'parse_response' work on the
+        current page just as they do after 'send'.
+        """
+        pages = iter(self.cmd_obj.command(self.client, **self.kwargs))
+        while True:
+            self.submitted_at = datetime.utcnow()
+            try:
+                response = next(pages)
+            except StopIteration:
+                return
+            except Exception as e:
+                msg = f'Error after sending command {self.command}, ' \
+                      f'error: {e}.'
+                raise ValueError(msg)
+            self.finished_at = datetime.utcnow()
+
+            yield self.set_raw_response(response)
+
+
+    def set_raw_response(self, response):
         response_type = type(response)
         print(f'type(response): {response_type}, response: {response}')
         resp_meta = response.get('ResponseMetadata')
@@ -0,0 +1,100 @@
+# Chunked executemany for the inventory and meta inserts.  The insert
+# statements are built once, without values, and run with a list of rows,
+# so SQLAlchemy compiles each of them once per process and the driver takes
+# its batch path: sqlite steps one prepared statement through the rows and
+# mysql-connector rewrites an executemany INSERT into multi-row INSERTs.
+# The rows sent per call adapt to the measured insert rate, aiming at a
+# fixed time per chunk, and are capped so a chunk never binds more values
+# than the backend allows in one statement.
+
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+
+from obs_inv_utils.env_utils import get_env_number
+
+
+# most bound values in one statement
+PARAMETER_LIMITS = {
+    'sqlite': 32766,
+    'mysql': 65535,
+}
+# sqlite before 3.32 and unknown backends
+DEFAULT_PARAMETER_LIMIT = 999
+MIN_CHUNK_ROWS = 50
+INITIAL_CHUNK_ROWS = 500
+CHUNK_SECONDS_ENV = 'OBS_INV_CHUNK_SECONDS'
+DEFAULT_CHUNK_SECONDS = 0.5
+
+_chunkers = {}
+_chunkers_lock = threading.Lock()
+
+
+def get_parameter_limit(dialect_name):
+    if dialect_name == 'sqlite' and sqlite3.sqlite_version_info < (3, 32, 0):
+        return DEFAULT_PARAMETER_LIMIT
+    return PARAMETER_LIMITS.get(dialect_name, DEFAULT_PARAMETER_LIMIT)
+
+
+def get_chunk_seconds():
+    return get_env_number(
+        CHUNK_SECONDS_ENV, DEFAULT_CHUNK_SECONDS, float, positive=True)
+
+
+@dataclass
+class AdaptiveChunker(object):
+    """
+    Number of rows to send per executemany call.  After each chunk the
+    size moves half way towards the rows that would have taken
+    'target_seconds' at the measured rate, within MIN_CHUNK_ROWS and
+    'max_rows'.
+    """
+
+    max_rows: int
+    target_seconds: float = field(default_factory=get_chunk_seconds)
+    rows: int = INITIAL_CHUNK_ROWS
+
+    def __post_init__(self):
+        self.max_rows = max(self.max_rows, 1)
+        self.rows = self.get_allowed_rows(self.rows)
+
+    def get_allowed_rows(self, rows):
+        return max(min(int(rows), self.max_rows),
+                   min(MIN_CHUNK_ROWS, self.max_rows))
+
+    def record(self, row_count, elapsed):
+        if row_count < self.rows or elapsed <= 0:
+            # a short last chunk says little about the rate
+            return
+
+        target_rows = row_count / elapsed * self.target_seconds
+        self.rows = self.get_allowed_rows((self.rows + target_rows) / 2)
+
+
+def get_chunker(table_name, dialect_name, column_count):
+    """
+    Return the process wide chunker of a table, so what is learned from
+    one insert sizes the chunks of the next.
+    """
+    key = (table_name, dialect_name)
+    with _chunkers_lock:
+        if key not in _chunkers:
+            _chunkers[key] = AdaptiveChunker(
+                get_parameter_limit(dialect_name) // max(column_count, 1))
+        return _chunkers[key]
+
+
+def execute_in_chunks(connection, statement, rows, chunker):
+    """
+    Run 'statement' with executemany over 'rows', a list of dicts, in the
+    chunks given by 'chunker'.  'connection' is a session or connection,
+    the chunks are part of its transaction.
+    """
+    start = 0
+    while start < len(rows):
+        chunk = rows[start:start + chunker.rows]
+        started = time.perf_counter()
+        connection.execute(statement, chunk)
+        chunker.record(len(chunk), time.perf_counter() - started)
+        start += len(chunk)
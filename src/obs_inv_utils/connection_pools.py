@@ -0,0 +1,290 @@
+# Connection pools of the inventory engine.  A process holds one engine, so
+# its pool is sized for how the process uses the database, its run mode: a
+# CLI command or a joblib worker runs one query at a time, the concurrent
+# search runs one per search thread and the plots read with one connection.
+# Every pooled connection is pinged before it is handed out and replaced
+# after OBS_INV_POOL_RECYCLE seconds, so connections the server or a
+# firewall dropped between jobs are not used.  The 'shared' profile keeps
+# no connections at all and can point short lived workers at a connection
+# pooler, such as ProxySQL or RDS Proxy, with MYSQL_POOL_HOST.
+# Checkouts, waits for a connection and overflow connections are counted
+# for the whole process and printed when it exits.
+
+import atexit
+import os
+import threading
+import time
+from collections import namedtuple
+from dataclasses import dataclass, field, fields
+
+import sqlalchemy as db
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils.env_utils import get_env_number
+
+
+CLI_PROFILE = 'cli'
+WORKER_PROFILE = 'worker'
+THREADED_PROFILE = 'threaded'
+PLOTTING_PROFILE = 'plotting'
+SHARED_PROFILE = 'shared'
+
+PoolProfile = namedtuple(
+    'PoolProfile',
+    [
+        'pool_size',
+        'max_overflow'
+    ],
+)
+
+# the threaded pool is sized from the search concurrency limits instead
+POOL_PROFILES = {
+    CLI_PROFILE: PoolProfile(2, 2),
+    WORKER_PROFILE: PoolProfile(1, 1),
+    PLOTTING_PROFILE: PoolProfile(1, 1),
+    SHARED_PROFILE: PoolProfile(0, 0),
+}
+POOL_PROFILE_NAMES = [
+    CLI_PROFILE,
+    WORKER_PROFILE,
+    THREADED_PROFILE,
+    PLOTTING_PROFILE,
+    SHARED_PROFILE
+]
+
+POOL_PROFILE_ENV = 'OBS_INV_POOL_PROFILE'
+POOL_SIZE_ENV = 'OBS_INV_POOL_SIZE'
+POOL_MAX_OVERFLOW_ENV = 'OBS_INV_POOL_MAX_OVERFLOW'
+POOL_TIMEOUT_ENV = 'OBS_INV_POOL_TIMEOUT'
+POOL_RECYCLE_ENV = 'OBS_INV_POOL_RECYCLE'
+POOL_HOST_ENV = 'MYSQL_POOL_HOST'
+DEFAULT_POOL_TIMEOUT = 30.0
+# below the MySQL wait_timeout and the idle timeouts of AWS load balancers
+DEFAULT_POOL_RECYCLE = 1800
+MYSQL_PORT = 3306
+
+_run_mode = CLI_PROFILE
+
+
+def set_run_mode(profile):
+    """
+    Set the pool profile of this process, used when OBS_INV_POOL_PROFILE
+    is not set.  Only engines created afterwards use it.
+    """
+    global _run_mode
+    _run_mode = validate_profile(profile, 'run mode')
+
+
+def validate_profile(profile, source):
+    if profile not in POOL_PROFILE_NAMES:
+        msg = f'Invalid connection pool {source}: {profile}, valid ' \
+              f'profiles: {POOL_PROFILE_NAMES}'
+        raise ValueError(msg)
+    return profile
+
+
+def get_pool_profile_name():
+    profile = os.getenv(POOL_PROFILE_ENV)
+    if profile is None:
+        return _run_mode
+    return validate_profile(profile, POOL_PROFILE_ENV)
+
+
+def get_threaded_profile():
+    """
+    One pooled connection per thread of the busiest platform, overflow
+    connections for the threads of the other platforms.
+    """
+    limits = [platforms.get_concurrency_limit(platform)
+              for platform in platforms.PLATFORMS]
+    return PoolProfile(max(limits), sum(limits) - max(limits))
+
+
+def get_pool_profile(name):
+    if name == THREADED_PROFILE:
+        profile = get_threaded_profile()
+    else:
+        profile = POOL_PROFILES[name]
+
+    return PoolProfile(
+        get_env_number(POOL_SIZE_ENV, profile.pool_size, int),
+        get_env_number(POOL_MAX_OVERFLOW_ENV, profile.max_overflow, int)
+    )
+
+
+def get_pool_options(name):
+    """
+    create_engine keyword arguments of the pool profile 'name'.
+    """
+    if name == SHARED_PROFILE:
+        return {'poolclass': NullPool, 'pool_pre_ping': True}
+
+    profile = get_pool_profile(name)
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': max(profile.pool_size, 1),
+        'max_overflow': profile.max_overflow,
+        'pool_timeout': get_env_number(
+            POOL_TIMEOUT_ENV, DEFAULT_POOL_TIMEOUT, float),
+        'pool_recycle': get_env_number(
+            POOL_RECYCLE_ENV, DEFAULT_POOL_RECYCLE, int),
+        'pool_pre_ping': True,
+    }
+
+
+def get_pool_host():
+    """
+    Connection pooler endpoint, or None when MYSQL_POOL_HOST is unset or
+    empty.
+    """
+    return os.getenv(POOL_HOST_ENV) or None
+
+
+def get_mysql_url(username, password, host, database):
+    if ':' not in host:
+        host = f'{host}:{MYSQL_PORT}'
+    return f'mysql+mysqlconnector://{username}:{password}@{host}/{database}'
+
+
+def create_mysql_engine(username, password, host, database):
+    """
+    Create the MySQL engine with the pool of the current profile.  The
+    'shared' profile connects through MYSQL_POOL_HOST when it is set.
+    """
+    profile_name = get_pool_profile_name()
+    if profile_name == SHARED_PROFILE:
+        host = get_pool_host() or host
+
+    options = get_pool_options(profile_name)
+    print(f'connection pool: {profile_name}, size: '
+          f'{options.get("pool_size", 0)}, max overflow: '
+          f'{options.get("max_overflow", 0)}')
+    engine = db.create_engine(
+        get_mysql_url(username, password, host, database), **options)
+    watch_pool(engine, profile_name)
+    return engine
+
+
+@dataclass
+class PoolMetrics(object):
+    profile: str = CLI_PROFILE
+    connects: int = 0
+    checkouts: int = 0
+    checked_out: int = 0
+    max_checked_out: int = 0
+    waits: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    overflows: int = 0
+    invalidations: int = 0
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False)
+
+    def record_checkout(self):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def record_checkin(self):
+        with self.lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def increment(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self):
+        with self.lock:
+            return {f.name: getattr(self, f.name)
+                    for f in fields(self) if f.name != 'lock'}
+
+
+pool_metrics = PoolMetrics()
+_report_registered = False
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    QueuePool that records in pool_metrics how long a checkout waits when
+    every connection it may open is already checked out.
+    """
+
+    def __init__(self, creator, max_overflow=10, **kw):
+        super().__init__(creator, max_overflow=max_overflow, **kw)
+        self.overflow_limit = max_overflow
+
+    def is_exhausted(self):
+        if self.overflow_limit < 0:
+            return False
+        return self.checkedout() >= self.size() + self.overflow_limit
+
+    def connect(self):
+        if not self.is_exhausted():
+            return super().connect()
+
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            pool_metrics.record_wait(time.perf_counter() - started)
+
+
+def watch_pool(engine, pool_name):
+    """
+    Count the connections 'engine' opens, checks out and invalidates in
+    pool_metrics, which is printed when the process exits.
+    """
+    global _report_registered
+    pool_metrics.profile = pool_name
+
+    @event.listens_for(engine, 'connect')
+    def count_connect(dbapi_connection, connection_record):
+        pool_metrics.increment('connects')
+        # a connection opened beyond pool_size is an overflow connection
+        pool = engine.pool
+        if isinstance(pool, QueuePool) and pool.overflow() > 0:
+            pool_metrics.increment('overflows')
+
+    @event.listens_for(engine, 'checkout')
+    def count_checkout(dbapi_connection, connection_record, proxy):
+        pool_metrics.record_checkout()
+
+    @event.listens_for(engine, 'checkin')
+    def count_checkin(dbapi_connection, connection_record):
+        pool_metrics.record_checkin()
+
+    @event.listens_for(engine, 'invalidate')
+    def count_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.increment('invalidations')
+
+    if not _report_registered:
+        atexit.register(report_pool_metrics)
+        _report_registered = True
+
+
+def get_pool_metrics():
+    return pool_metrics.as_dict()
+
+
+def report_pool_metrics():
+    metrics = get_pool_metrics()
+    if metrics['checkouts'] == 0:
+        return
+    print(f'connection pool {metrics["profile"]}: '
+          f'checkouts: {metrics["checkouts"]}, '
+          f'connects: {metrics["connects"]}, '
+          f'max checked out: {metrics["max_checked_out"]}, '
+          f'overflows: {metrics["overflows"]}, '
+          f'waits: {metrics["waits"]} '
+          f'({metrics["wait_seconds"]:.3f} s, max '
+          f'{metrics["max_wait_seconds"]:.3f} s), '
+          f'invalidations: {metrics["invalidations"]}')
@@ -0,0 +1,200 @@
+# Schema migrations for existing inventory databases.  Tables created by
+# inventory_table_factory already have every index in INVENTORY_INDEXES,
+# 'migrate' adds the ones missing from databases created before an index
+# was added.  On MySQL the indexes are built with online DDL so searches and
+# ingest keep running during the migration.  SQLite blocks writers, but not
+# readers, while each index is built.  Columns added to existing tables are
+# filled in by the backfill functions.
+
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam, inspect, text
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import search_engine as se
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def get_missing_indexes(engine=None):
+    """
+    Return the IndexSpecs in INVENTORY_INDEXES whose table exists but does
+    not have the index yet.
+    """
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    insp = inspect(engine)
+    existing_indexes = {}
+    missing_indexes = []
+    for spec in tbl_factory.INVENTORY_INDEXES:
+        if not insp.has_table(spec.table):
+            continue
+
+        if spec.table not in existing_indexes:
+            existing_indexes[spec.table] = {
+                index['name'] for index in insp.get_indexes(spec.table)
+            }
+
+        if spec.name not in existing_indexes[spec.table]:
+            missing_indexes.append(spec)
+
+    return missing_indexes
+
+
+def get_create_index_sql(spec, dialect_name):
+    columns = ', '.join(spec.columns)
+    if dialect_name == 'mysql':
+        return f'CREATE INDEX {spec.name} ON {spec.table} ({columns}) ' \
+               f'ALGORITHM=INPLACE, LOCK=NONE'
+
+    return f'CREATE INDEX IF NOT EXISTS {spec.name} ON {spec.table} ' \
+           f'({columns})'
+
+
+def migrate(engine=None, dry_run=False):
+    """
+    Create the missing inventory indexes one at a time, each in its own
+    transaction, then refresh the planner statistics of the tables that
+    changed.  Returns the names of the indexes created, or that would be
+    created if 'dry_run' is set.
+    """
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    dialect_name = engine.dialect.name
+    if not dry_run:
+        # indexes may be on columns added since the table was created
+        tbl_factory.add_missing_columns(engine)
+
+    missing_indexes = get_missing_indexes(engine)
+    if len(missing_indexes) == 0:
+        print('All inventory indexes exist, nothing to migrate.')
+        return []
+
+    for spec in missing_indexes:
+        sql = get_create_index_sql(spec, dialect_name)
+        print(f'{"Would run" if dry_run else "Running"}: {sql}')
+        if dry_run:
+            continue
+
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(text(sql))
+        print(f'Created index {spec.name} in '
+              f'{time.perf_counter() - started:.2f} s')
+
+    if not dry_run:
+        tables = sorted({spec.table for spec in missing_indexes})
+        with engine.begin() as connection:
+            if dialect_name == 'mysql':
+                connection.execute(text(f'ANALYZE TABLE {", ".join(tables)}'))
+            else:
+                for table in tables:
+                    connection.execute(text(f'ANALYZE {table}'))
+
+    return [spec.name for spec in missing_indexes]
+
+
+def backfill_column(
+    engine, missing_column, source_column, get_values, batch_size
+):
+    """
+    Fill in the obs_inventory columns returned by get_values(source value)
+    on the rows where 'missing_column' is null, one committed batch at a
+    time so it can be stopped and restarted.  Rows without a value in
+    'source_column' have nothing to fill in and are skipped, so a second
+    run finds no rows.  Returns the number of rows updated.
+    """
+    tbl_factory.add_missing_columns(engine)
+    obs_inv = tbl_factory.ObsInventory.__table__
+
+    updated_count = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                obs_inv.select().with_only_columns(
+                    [obs_inv.c.obs_id, obs_inv.c[source_column]]
+                ).where(
+                    obs_inv.c[missing_column] == None
+                ).where(
+                    obs_inv.c[source_column] != None
+                ).where(
+                    obs_inv.c.obs_id > last_id
+                ).order_by(
+                    obs_inv.c.obs_id
+                ).limit(batch_size)
+            ).fetchall()
+
+            if len(rows) == 0:
+                break
+            last_id = rows[-1].obs_id
+
+            updated_at = datetime.now()
+            params = []
+            for row in rows:
+                param = {
+                    f'b_{column_name}': value
+                    for column_name, value in get_values(row[1]).items()
+                }
+                param['b_obs_id'] = row.obs_id
+                param['b_updated_at'] = updated_at
+                params.append(param)
+
+            connection.execute(
+                obs_inv.update().where(
+                    obs_inv.c.obs_id == bindparam('b_obs_id')
+                ).values({
+                    key[len('b_'):]: bindparam(key)
+                    for key in params[0] if key != 'b_obs_id'
+                }),
+                params
+            )
+            updated_count += len(rows)
+
+        print(f'Backfilled {missing_column} on {updated_count} rows.')
+
+    return updated_count
+
+
+def backfill_generic_filenames(engine=None, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Fill in obs_inventory.generic_filename for rows inserted before the
+    column was added.  Returns the number of rows updated.
+    """
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    return backfill_column(
+        engine,
+        'generic_filename',
+        'filename',
+        lambda filename: {
+            'generic_filename': se.get_generic_filename(filename)
+        },
+        batch_size
+    )
+
+
+def backfill_parent_dir_columns(engine=None, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Fill in obs_inventory.sensor, stream and source_dir, derived from
+    parent_dir, for rows inserted before the columns were added.  Returns
+    the number of rows updated.
+    """
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    return backfill_column(
+        engine,
+        'source_dir',
+        'parent_dir',
+        lambda parent_dir: {
+            'sensor': se.get_sensor(parent_dir),
+            'stream': se.get_stream(parent_dir),
+            'source_dir': se.get_source_dir(parent_dir)
+        },
+        batch_size
+    )
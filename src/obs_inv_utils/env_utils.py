@@ -0,0 +1,26 @@
+# Helpers for reading settings from the environment (.env file).
+
+import os
+
+
+def get_env_number(name, default, number_type, positive=False):
+    """
+    Value of the environment variable 'name' as a 'number_type', or
+    'default' when it is not set.  The value must not be negative, and must
+    be greater than zero if 'positive' is set.
+    """
+    value = os.getenv(name)
+    if value is None:
+        return default
+
+    try:
+        number = number_type(value)
+    except ValueError:
+        number = -1
+
+    if number < 0 or (positive and number == 0):
+        kind = 'positive' if positive else 'non-negative'
+        msg = f'{name} must be a {kind} number, actually: {value}'
+        raise ValueError(msg)
+
+    return number
@@ -0,0 +1,159 @@
+# Write-behind buffer for search results.  Command results and the
+# observation inventory items found by each command are queued by the search
+# threads and written in large batches by a single background writer thread,
+# so the threads listing storage never wait on database commits.
+
+import atexit
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils.env_utils import get_env_number
+
+
+# command results written per transaction
+DEFAULT_BATCH_SIZE = 500
+BATCH_SIZE_ENV = 'OBS_INV_INGEST_BATCH_SIZE'
+# longest time, in seconds, a queued command result waits to be written
+DEFAULT_FLUSH_INTERVAL = 5.0
+# batches that can be queued before 'add' blocks until the writer catches up
+QUEUED_BATCHES = 4
+
+_CLOSE = object()
+
+
+def get_batch_size():
+    return get_env_number(
+        BATCH_SIZE_ENV, DEFAULT_BATCH_SIZE, int, positive=True)
+
+
+@dataclass
+class IngestBuffer(object):
+    """
+    Queue of (CmdResultData, list of TarballFileMeta) tuples flushed by a
+    background thread through
+    inventory_table_factory.insert_cmd_results_with_obs_inv_items, which
+    assigns the cmd_result_ids in bulk.  Callbacks queued with 'after_flush'
+    run once the results queued before them are committed.  The buffer is
+    drained by 'close', which is also registered to run at interpreter exit.
+    If a flush fails the writer stops, and the error is raised by the next
+    'add' and by 'close'.  At most QUEUED_BATCHES batches are queued, once
+    the queue is full 'add' waits for the writer so searches that outpace
+    it do not hold their results in memory.
+    """
+
+    batch_size: int = field(default_factory=get_batch_size)
+    flush_interval: float = DEFAULT_FLUSH_INTERVAL
+    flushed_count: int = field(default=0, init=False)
+    error: Exception = field(default=None, init=False)
+    closed: bool = field(default=False, init=False)
+    pending: queue.Queue = field(default=None, init=False)
+    writer: threading.Thread = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.pending = queue.Queue(maxsize=QUEUED_BATCHES * self.batch_size)
+        self.writer = threading.Thread(
+            target=self.write_batches,
+            name='obs_inv_ingest_writer',
+            daemon=True
+        )
+        self.writer.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a writer error does not replace the error raised in the block
+        self.close(raise_error=exc_type is None)
+
+    def add(self, cmd_result_data, obs_inv_items):
+        if self.error is not None:
+            msg = f'Ingest writer failed, error: {self.error}'
+            raise ValueError(msg) from self.error
+
+        if self.closed:
+            msg = 'Can not add search results to a closed ingest buffer.'
+            raise ValueError(msg)
+
+        self.pending.put((cmd_result_data, list(obs_inv_items)))
+
+    def after_flush(self, callback):
+        """
+        Call 'callback' from the writer thread once everything added before
+        it has been committed.  It is not called if a flush fails.
+        """
+        if self.closed:
+            msg = 'Can not add callbacks to a closed ingest buffer.'
+            raise ValueError(msg)
+
+        self.pending.put(callback)
+
+    def get_batch(self):
+        """
+        Wait up to 'flush_interval' seconds for the first item, then take
+        whatever else is already queued up to 'batch_size' items.  Returns
+        the batch and whether the buffer was closed.
+        """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if len(batch) == 0 and timeout > 0:
+                    item = self.pending.get(timeout=timeout)
+                else:
+                    item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is _CLOSE:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def write_batches(self):
+        closing = False
+        while not closing:
+            batch, closing = self.get_batch()
+            if len(batch) == 0 or self.error is not None:
+                continue
+
+            cmd_results = [item for item in batch if not callable(item)]
+            callbacks = [item for item in batch if callable(item)]
+            try:
+                if len(cmd_results) > 0:
+                    tbl_factory.insert_cmd_results_with_obs_inv_items(
+                        cmd_results)
+                for callback in callbacks:
+                    callback()
+            except Exception as e:
+                print(f'Problem writing {len(cmd_results)} search results, '
+                      f'error: {e}')
+                self.error = e
+            else:
+                self.flushed_count += len(cmd_results)
+                print(f'Ingest writer flushed {len(cmd_results)} search '
+                      f'results, total: {self.flushed_count}')
+
+    def close(self, raise_error=True):
+        """
+        Write everything still queued and stop the writer thread.  A writer
+        error is raised, or only printed if 'raise_error' is False.  Safe
+        to call more than once.
+        """
+        if not self.closed:
+            self.closed = True
+            self.pending.put(_CLOSE)
+            self.writer.join()
+            atexit.unregister(self.close)
+
+        if self.error is not None:
+            msg = f'Ingest writer failed, error: {self.error}'
+            if not raise_error:
+                print(msg)
+                return
+            raise ValueError(msg) from self.error
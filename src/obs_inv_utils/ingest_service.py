@@ -0,0 +1,434 @@
+# Single database writer for parallel inventory jobs.  'serve' runs a
+# writer that listens on a Unix socket.  When OBS_INV_INGEST_SOCKET is set,
+# the inventory_table_factory insert functions decorated with
+# 'forward_to_ingest_writer' send their argument to the writer instead of
+# writing it themselves, and get back the same result, e.g. the assigned
+# cmd_result_ids.  The writer merges the requests waiting from all jobs
+# into one transaction per insert function, so the database sees a steady
+# stream of large commits from one connection instead of many small ones.
+# Messages are pickled, the socket is created readable only by its owner.
+
+import functools
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+from obs_inv_utils import ingest_buffer
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils.env_utils import get_env_number
+
+
+INGEST_SOCKET_ENV = 'OBS_INV_INGEST_SOCKET'
+# seconds the writer waits for more requests after the first of a batch
+DEFAULT_LINGER = 0.05
+LINGER_ENV = 'OBS_INV_INGEST_LINGER'
+# seconds to wait for a started writer to listen on its socket
+WRITER_START_TIMEOUT = 60
+
+MESSAGE_LENGTH = struct.Struct('!Q')
+REPLY_OK = 'ok'
+REPLY_ERROR = 'error'
+
+# names of the functions that can be forwarded to the writer
+FORWARDED_FUNCTIONS = set()
+# the command results of insert_cmd_result and
+# insert_cmd_results_with_obs_inv_items are written first, then the rows
+# that reference them
+CMD_RESULTS_GROUP = 'cmd_results'
+WRITE_ORDER = [
+    CMD_RESULTS_GROUP,
+    'insert_obs_inv_items',
+    'insert_obs_meta_nceplibs_bufr_item',
+    'insert_obs_meta_nceplibs_prepbufr_item',
+    'insert_obs_meta_nceplibs_prepbufr_agg_item',
+]
+
+_CLOSE = object()
+_local = threading.local()
+
+
+def get_linger():
+    return get_env_number(LINGER_ENV, DEFAULT_LINGER, float)
+
+
+def send_message(sock, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(MESSAGE_LENGTH.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            if len(data) == 0:
+                return None
+            msg = f'Ingest connection closed in the middle of a message, ' \
+                  f'received {len(data)} of {size} bytes.'
+            raise ConnectionError(msg)
+        data.extend(chunk)
+    return bytes(data)
+
+
+def recv_message(sock):
+    """
+    Return the next message on 'sock', or None if the other end closed the
+    connection.
+    """
+    header = recv_exactly(sock, MESSAGE_LENGTH.size)
+    if header is None:
+        return None
+
+    (length,) = MESSAGE_LENGTH.unpack(header)
+    data = recv_exactly(sock, length)
+    if data is None:
+        msg = 'Ingest connection closed before the message body.'
+        raise ConnectionError(msg)
+    return pickle.loads(data)
+
+
+@dataclass
+class IngestClient(object):
+    """
+    Connection to an ingest writer.  A connection carries one request at a
+    time, get_ingest_client keeps one per thread.
+    """
+
+    socket_path: str
+    sock: socket.socket = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+    def call(self, name, arg):
+        send_message(self.sock, (name, arg))
+        reply = recv_message(self.sock)
+        if reply is None:
+            msg = f'Ingest writer at {self.socket_path} closed the ' \
+                  f'connection while running {name}.'
+            raise ValueError(msg)
+
+        status, result = reply
+        if status == REPLY_ERROR:
+            msg = f'Ingest writer failed to run {name}, error: {result}'
+            raise ValueError(msg)
+
+        return result
+
+    def close(self):
+        self.sock.close()
+
+
+def get_ingest_socket():
+    """
+    Return the socket of the ingest writer to forward inserts to, None
+    when they are written directly, including by the writer itself.
+    """
+    if getattr(_local, 'serving', False):
+        return None
+
+    socket_path = os.getenv(INGEST_SOCKET_ENV)
+    if socket_path is None or len(socket_path) == 0:
+        return None
+    return socket_path
+
+
+def get_ingest_client(socket_path):
+    clients = getattr(_local, 'clients', None)
+    if clients is None:
+        clients = _local.clients = {}
+
+    if socket_path not in clients:
+        clients[socket_path] = IngestClient(socket_path)
+    return clients[socket_path]
+
+
+def forward_to_ingest_writer(func):
+    """
+    Decorator for the single argument insert functions of
+    inventory_table_factory, sends the argument to the ingest writer when
+    OBS_INV_INGEST_SOCKET is set.
+    """
+    FORWARDED_FUNCTIONS.add(func.__name__)
+
+    @functools.wraps(func)
+    def forward(arg):
+        socket_path = get_ingest_socket()
+        if socket_path is None:
+            return func(arg)
+
+        return get_ingest_client(socket_path).call(func.__name__, arg)
+
+    return forward
+
+
+@dataclass
+class IngestRequest(object):
+    name: str
+    arg: object
+    result: Future = field(default_factory=Future)
+
+
+@dataclass
+class IngestWriter(object):
+    """
+    Writes the requests submitted by the connection threads from a single
+    thread.  Each batch takes the requests already waiting, up to
+    'batch_size', and any arriving within 'linger' seconds of the first.
+    """
+
+    batch_size: int = field(default_factory=ingest_buffer.get_batch_size)
+    linger: float = field(default_factory=get_linger)
+    request_count: int = field(default=0, init=False)
+    batch_count: int = field(default=0, init=False)
+    pending: queue.Queue = field(default_factory=queue.Queue, init=False)
+    writer: threading.Thread = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.writer = threading.Thread(
+            target=self.write_batches,
+            name='obs_inv_ingest_service',
+            daemon=True
+        )
+        self.writer.start()
+
+    def submit(self, name, arg):
+        if name not in FORWARDED_FUNCTIONS:
+            msg = f'{name} can not be run by the ingest writer, valid ' \
+                  f'functions: {sorted(FORWARDED_FUNCTIONS)}'
+            raise ValueError(msg)
+
+        request = IngestRequest(name, arg)
+        self.pending.put(request)
+        return request.result.result()
+
+    def get_batch(self):
+        item = self.pending.get()
+        if item is _CLOSE:
+            return [], True
+
+        batch = [item]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.pending.get(timeout=timeout)
+                else:
+                    item = self.pending.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is _CLOSE:
+                self.pending.put(_CLOSE)
+                break
+            batch.append(item)
+
+        return batch, False
+
+    def write_batches(self):
+        _local.serving = True
+        closing = False
+        while not closing:
+            batch, closing = self.get_batch()
+            if len(batch) == 0:
+                continue
+
+            groups = {}
+            for request in batch:
+                group = request.name
+                if group in ['insert_cmd_result',
+                             'insert_cmd_results_with_obs_inv_items']:
+                    group = CMD_RESULTS_GROUP
+                groups.setdefault(group, []).append(request)
+
+            for group in sorted(groups, key=get_write_order):
+                self.write_group(group, groups[group])
+
+            self.request_count += len(batch)
+            self.batch_count += 1
+            print(f'Ingest writer wrote {len(batch)} requests, total: '
+                  f'{self.request_count} in {self.batch_count} batches')
+
+    def write_group(self, group, requests):
+        """
+        Write the requests of one group in a single call.  If it fails, the
+        requests are written one at a time so the error is only returned
+        to the requests that caused it.
+        """
+        try:
+            if len(requests) > 1:
+                results = write_merged(group, requests)
+            else:
+                results = [write_request(requests[0])]
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].result.set_exception(e)
+                return
+
+            print(f'Merged write of {len(requests)} {group} requests failed, '
+                  f'writing them one at a time, error: {e}')
+            for request in requests:
+                self.write_group(group, [request])
+            return
+
+        for request, result in zip(requests, results):
+            request.result.set_result(result)
+
+    def close(self):
+        self.pending.put(_CLOSE)
+        self.writer.join()
+
+
+def get_write_order(group):
+    if group in WRITE_ORDER:
+        return WRITE_ORDER.index(group)
+    return len(WRITE_ORDER)
+
+
+def write_request(request):
+    return getattr(tbl_factory, request.name)(request.arg)
+
+
+def write_merged(group, requests):
+    """
+    Write several requests of one group with one call of its insert
+    function.  Returns the result of each request.
+    """
+    if group == CMD_RESULTS_GROUP:
+        cmd_results = []
+        for request in requests:
+            if request.name == 'insert_cmd_result':
+                cmd_results.append((request.arg, []))
+            else:
+                cmd_results.extend(request.arg)
+
+        cmd_ids = tbl_factory.insert_cmd_results_with_obs_inv_items(
+            cmd_results)
+
+        results = []
+        for request in requests:
+            if request.name == 'insert_cmd_result':
+                results.append(cmd_ids.pop(0))
+            else:
+                results.append(cmd_ids[:len(request.arg)])
+                del cmd_ids[:len(request.arg)]
+        return results
+
+    items = []
+    for request in requests:
+        if not isinstance(request.arg, list):
+            msg = f'{group} items must be in the form of a list. ' \
+                  f'Received type: {type(request.arg)}'
+            raise TypeError(msg)
+        items.extend(request.arg)
+
+    getattr(tbl_factory, group)(items)
+    return [None] * len(requests)
+
+
+class IngestRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            message = recv_message(self.request)
+            if message is None:
+                return
+
+            name, arg = message
+            try:
+                reply = (REPLY_OK, self.server.writer.submit(name, arg))
+            except Exception as e:
+                reply = (REPLY_ERROR, f'{type(e).__name__}: {e}')
+            send_message(self.request, reply)
+
+
+def remove_stale_socket(socket_path):
+    # left behind by a writer that did not shut down
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            msg = f'Ingest socket path exists and is not a socket: ' \
+                  f'{socket_path}'
+            raise ValueError(msg)
+        os.remove(socket_path)
+
+
+class IngestServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, writer):
+        self.writer = writer
+        remove_stale_socket(socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, IngestRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        self.writer.close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def stop_serving(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(socket_path):
+    """
+    Run an ingest writer on 'socket_path' until interrupted or terminated.
+    """
+    # connect, and bootstrap the schema, before accepting requests
+    tbl_factory.get_engine()
+    server = IngestServer(socket_path, IngestWriter())
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop_serving)
+
+    print(f'Ingest writer listening on {socket_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Ingest writer on {socket_path} stopped, requests written: '
+              f'{server.writer.request_count}')
+
+
+def start_ingest_writer(socket_path):
+    """
+    Start 'serve' in a new process and wait until it is listening.  Returns
+    the process, stop it with stop_ingest_writer.
+    """
+    remove_stale_socket(socket_path)
+    process = multiprocessing.get_context('spawn').Process(
+        target=serve, args=(socket_path,), name='obs_inv_ingest_writer')
+    process.start()
+
+    deadline = time.monotonic() + WRITER_START_TIMEOUT
+    while not os.path.exists(socket_path):
+        if not process.is_alive() or time.monotonic() > deadline:
+            process.terminate()
+            msg = f'Ingest writer did not start listening on {socket_path}'
+            raise ValueError(msg)
+        time.sleep(0.1)
+
+    return process
+
+
+def stop_ingest_writer(process):
+    process.terminate()
+    process.join()
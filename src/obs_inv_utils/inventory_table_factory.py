@@ -1,11 +1,17 @@
+import fcntl
+import functools
 import os
+import socket
+import threading
 import sqlalchemy as db
+from contextlib import contextmanager
 from datetime import datetime
 from collections import namedtuple
 from obs_inv_utils import search_engine as se
 from sqlalchemy import Table, Column, MetaData, text
 from sqlalchemy import Integer, String, ForeignKey, Boolean, DateTime, Float
-from sqlalchemy import inspect, UniqueConstraint
+from sqlalchemy import LargeBinary
+from sqlalchemy import inspect, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -13,6 +19,12 @@ from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import hashlib
 from dotenv import load_dotenv
+from obs_inv_utils import bulk_insert
+from obs_inv_utils import connection_pools
+from obs_inv_utils import query_profiler
+from obs_inv_utils import sqlite_tuning
+from obs_inv_utils.sqlite_tuning import retry_when_busy
+from obs_inv_utils.ingest_service import forward_to_ingest_writer
 
 load_dotenv()
 
@@ -21,14 +33,102 @@ CMD_RESULTS_TABLE = 'cmd_results'
 OBS_META_NCEPLIBS_BUFR_TABLE = 'obs_meta_nceplibs_bufr'
 OBS_META_NCEPLIBS_PREPBUFR_TABLE = 'obs_meta_nceplibs_prepbufr'
 OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE = 'obs_meta_nceplibs_prepbufr_aggregate'
+OBS_META_NCEPLIBS_BUFR_LATEST_TABLE = 'obs_meta_nceplibs_bufr_latest'
+OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE = 'obs_meta_nceplibs_prepbufr_latest'
+INVENTORY_WATERMARKS_TABLE = 'inventory_watermarks'
+CMD_RESULT_PAYLOADS_TABLE = 'cmd_result_payloads'
 OBS_DATABASE = ''
 OBS_SQLITE_DEFAULT = 'observations_inventory.db'
+# columns the plots deduplicate the meta tables on, the latest tables hold
+# one row, with the latest inserted_at, per distinct value of these
+BUFR_LATEST_KEY = [
+    'obs_id',
+    'sat_id',
+    'sat_id_name',
+    'obs_count',
+    'sat_inst_id',
+    'sat_inst_desc',
+    'filename',
+    'file_size',
+    'obs_day'
+]
+PREPBUFR_LATEST_KEY = [
+    'obs_id',
+    'variable',
+    'typ',
+    'tot',
+    'qm0thru3',
+    'filename',
+    'file_size',
+    'obs_day'
+]
+# the engine is created, and the schema checked, on first use by
+# get_engine so importing this module does not touch the database
+_engine = None
+_schema_ready = False
+_engine_lock = threading.RLock()
+SCHEMA_LOCK_NAME = 'obs_inv_schema_bootstrap'
+# seconds to wait for another process to finish bootstrapping the schema
+SCHEMA_LOCK_TIMEOUT = 600
 
-database_type = os.getenv('DATABASE_TYPE', 'sqlite')
-print('database type: ' + database_type)
+# when set, every process writes to its own sqlite shard in this directory
+# instead of the database, see shard_merge
+SHARD_DIR_ENV = 'OBS_INV_SHARD_DIR'
+SHARD_PREFIX = 'shard-'
 
-def get_engine():
-    if(database_type.lower() == 'mysql'):
+def get_shard_path():
+    shard_dir = os.getenv(SHARD_DIR_ENV)
+    if shard_dir is None or len(shard_dir) == 0:
+        return None
+
+    return os.path.join(
+        shard_dir, f'{SHARD_PREFIX}{socket.gethostname()}-{os.getpid()}.db')
+
+def require_unsharded(option):
+    """
+    Raise if this process writes to a shard.  A shard only holds what the
+    process itself wrote, so options resuming from the progress of earlier
+    runs, the incremental watermarks and the progress journal, can not be
+    used with shards.
+    """
+    if get_shard_path() is not None:
+        msg = f'{option} can not be used with {SHARD_DIR_ENV}, a shard ' \
+              f'does not hold the progress of earlier runs.'
+        raise ValueError(msg)
+
+def get_database_type():
+    # shards are sqlite whatever the database they are merged into
+    if get_shard_path() is not None:
+        return 'sqlite'
+    return os.getenv('DATABASE_TYPE', 'sqlite').lower()
+
+def get_database_name():
+    """
+    Name of the database get_engine connects to, from the environment
+    without creating the engine.
+    """
+    shard_path = get_shard_path()
+    if shard_path is not None:
+        return f'sqlite:///{shard_path}'
+    if get_database_type() == 'mysql':
+        return f'mysql://{os.getenv("MYSQL_USERNAME")}@' \
+               f'{os.getenv("MYSQL_HOST")}/{os.getenv("MYSQL_DATABASE")}'
+
+    sqlite_database = os.getenv('SQLITE_DATABASE', OBS_SQLITE_DEFAULT)
+    return f'sqlite:///{os.path.abspath(sqlite_database)}'
+
+def create_database_engine():
+    database_type = get_database_type()
+    print('database type: ' + database_type)
+    shard_path = get_shard_path()
+    if shard_path is not None:
+        print('sqlite shard: ' + shard_path)
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        engine = db.create_engine(f'sqlite:///{shard_path}')
+        sqlite_tuning.apply_sqlite_pragmas(engine)
+        connection_pools.watch_pool(engine, 'sqlite')
+        return engine
+    elif(database_type == 'mysql'):
         try: 
             mysql_username = os.getenv('MYSQL_USERNAME')
             mysql_password = os.getenv('MYSQL_PASSWORD')
@@ -41,8 +141,8 @@ def get_engine():
             print('There was an error pulling the required values for the MySQL database from the .env file.')
             print('Required values for MySQL database: MYSQL_USERNAME, MYSQL_PASSWORD, MYSQL_HOST, MYSQL_DATABASE.')
 
-        OBS_DATABASE = f'mysql+mysqlconnector://{mysql_username}:{mysql_password}@{mysql_host}:3306/{mysql_database}'
-        return db.create_engine(OBS_DATABASE, pool_size=150, max_overflow=0)
+        return connection_pools.create_mysql_engine(
+            mysql_username, mysql_password, mysql_host, mysql_database)
     else:
         sqlite_database = OBS_SQLITE_DEFAULT
         try: 
@@ -56,12 +156,114 @@ def get_engine():
 
         OBS_DATABASE = f"sqlite:///{sqlite_database}"
         print('sqlite database: ' + OBS_DATABASE)
-        return db.create_engine(OBS_DATABASE)   
-    
-engine = get_engine()
+        engine = db.create_engine(OBS_DATABASE)
+        sqlite_tuning.apply_sqlite_pragmas(engine)
+        # sqlite opens a connection per checkout, there is no pool to size
+        connection_pools.watch_pool(engine, 'sqlite')
+        return engine
+
+
+class LazySessionmaker(sessionmaker):
+    """
+    sessionmaker that creates the engine, through get_engine, the first time
+    a session is made.
+    """
+
+    def __call__(self, **local_kw):
+        get_engine()
+        return super().__call__(**local_kw)
+
+
 Base = declarative_base()
-metadata = MetaData(engine)
-Session = sessionmaker(bind=engine)
+metadata = MetaData()
+Session = LazySessionmaker()
+
+
+@contextmanager
+def schema_lock(engine):
+    """
+    Serialize the schema bootstrap between processes sharing a database,
+    such as the parallel jobs started by auto_inventory.py.
+    """
+    if engine.dialect.name == 'mysql':
+        with engine.connect() as connection:
+            # 1 when locked, 0 on timeout and NULL on error
+            locked = connection.execute(
+                text('SELECT GET_LOCK(:name, :timeout)'),
+                {'name': SCHEMA_LOCK_NAME, 'timeout': SCHEMA_LOCK_TIMEOUT}
+            ).scalar()
+            if locked != 1:
+                msg = f'Could not get the schema lock {SCHEMA_LOCK_NAME} ' \
+                      f'within {SCHEMA_LOCK_TIMEOUT} s, GET_LOCK returned: ' \
+                      f'{locked}'
+                raise ValueError(msg)
+            try:
+                yield
+            finally:
+                connection.execute(
+                    text('SELECT RELEASE_LOCK(:name)'),
+                    {'name': SCHEMA_LOCK_NAME}
+                )
+        return
+
+    database = engine.url.database
+    if not database or database == ':memory:':
+        yield
+        return
+
+    with open(f'{database}.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_engine():
+    """
+    Return the process wide engine.  The first call creates it and
+    bootstraps the schema, later calls only return it.  Safe to call from
+    several threads.
+    """
+    global _engine, _schema_ready
+    if _schema_ready:
+        return _engine
+
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_database_engine()
+            query_profiler.watch_queries(_engine)
+            Session.configure(bind=_engine)
+        if not _schema_ready:
+            with schema_lock(_engine):
+                init_schema(_engine)
+            _schema_ready = True
+
+    return _engine
+
+
+def dispose_engine():
+    """
+    Close the connections of the process wide engine and forget it, the
+    next get_engine call creates a new one from the current environment.
+    """
+    global _engine, _schema_ready
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+        _schema_ready = False
+
+
+def __getattr__(name):
+    # 'engine' and 'database_type' used to be created at import
+    if name == 'engine':
+        return get_engine()
+    if name == 'database_type':
+        return get_database_type()
+
+    msg = f'module {__name__!r} has no attribute {name!r}'
+    raise AttributeError(msg)
 
 CmdResultData = namedtuple(
     'CmdResultData',
@@ -78,7 +280,111 @@ CmdResultData = namedtuple(
     ],
 )
 
-def create_obs_inventory_table():
+IndexSpec = namedtuple(
+    'IndexSpec',
+    [
+        'name',
+        'table',
+        'columns'
+    ],
+)
+
+# secondary indexes for the filters and joins used by obs_inv_queries and
+# plotting/plot_utils.  Tables created here get them at creation, existing
+# databases get them from db_migrations.migrate.
+INVENTORY_INDEXES = [
+    # get_bufr_files_data: obs_day range, filename patterns checked in the
+    # index
+    IndexSpec(
+        'ix_obs_inventory_obs_day_filename',
+        OBS_INVENTORY_TABLE,
+        ['obs_day', 'filename']
+    ),
+    # filename lookups without a date range
+    IndexSpec(
+        'ix_obs_inventory_filename_obs_day',
+        OBS_INVENTORY_TABLE,
+        ['filename', 'obs_day']
+    ),
+    # get_bufr_files_data, get_family_fs_data: generic filename IN list with
+    # an obs_day range
+    IndexSpec(
+        'ix_obs_inventory_generic_filename_obs_day',
+        OBS_INVENTORY_TABLE,
+        ['generic_filename', 'obs_day']
+    ),
+    # plot_utils: s3_bucket filter joined to the meta tables on obs_id
+    IndexSpec(
+        'ix_obs_inventory_s3_bucket_obs_id',
+        OBS_INVENTORY_TABLE,
+        ['s3_bucket', 'obs_id']
+    ),
+    # obs_inv_queries.get_daily_counts: the files of a bucket and sensor
+    # joined to the meta tables on obs_id
+    IndexSpec(
+        'ix_obs_inventory_s3_bucket_sensor_obs_id',
+        OBS_INVENTORY_TABLE,
+        ['s3_bucket', 'sensor', 'obs_id']
+    ),
+    # get_filesize_timeline_data: grouped and joined on data_type, suffix
+    IndexSpec(
+        'ix_obs_inventory_data_type_suffix',
+        OBS_INVENTORY_TABLE,
+        ['data_type', 'suffix']
+    ),
+    # plot_utils: latest meta rows per obs_id joined to obs_inventory
+    IndexSpec(
+        'ix_obs_meta_bufr_obs_id_inserted_at',
+        OBS_META_NCEPLIBS_BUFR_TABLE,
+        ['obs_id', 'inserted_at']
+    ),
+    IndexSpec(
+        'ix_obs_meta_bufr_obs_day_filename',
+        OBS_META_NCEPLIBS_BUFR_TABLE,
+        ['obs_day', 'filename']
+    ),
+    IndexSpec(
+        'ix_obs_meta_prepbufr_obs_id_inserted_at',
+        OBS_META_NCEPLIBS_PREPBUFR_TABLE,
+        ['obs_id', 'inserted_at']
+    ),
+    IndexSpec(
+        'ix_obs_meta_prepbufr_obs_day_filename',
+        OBS_META_NCEPLIBS_PREPBUFR_TABLE,
+        ['obs_day', 'filename']
+    ),
+    # plot_utils: latest rows joined to obs_inventory
+    IndexSpec(
+        'ix_obs_meta_bufr_latest_obs_id',
+        OBS_META_NCEPLIBS_BUFR_LATEST_TABLE,
+        ['obs_id']
+    ),
+    IndexSpec(
+        'ix_obs_meta_prepbufr_latest_obs_id',
+        OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE,
+        ['obs_id']
+    ),
+    IndexSpec(
+        'ix_obs_meta_prepbufr_agg_obs_id_inserted_at',
+        OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE,
+        ['obs_id', 'inserted_at']
+    ),
+    IndexSpec(
+        'ix_obs_meta_prepbufr_agg_obs_day_filename',
+        OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE,
+        ['obs_day', 'filename']
+    ),
+]
+
+
+def get_table_indexes(table_name):
+    return [
+        Index(spec.name, *spec.columns)
+        for spec in INVENTORY_INDEXES if spec.table == table_name
+    ]
+
+
+def create_obs_inventory_table(engine):
     insp = inspect(engine)
     table_exists = insp.has_table(OBS_INVENTORY_TABLE)
     print(f'obs_inventory table exists: {table_exists}')
@@ -93,7 +399,11 @@ def create_obs_inventory_table():
               ),
               Column('obs_id', Integer, primary_key=True),
               Column('filename', String),
+              Column('generic_filename', String),
               Column('parent_dir', String),
+              Column('sensor', String),
+              Column('stream', String),
+              Column('source_dir', String),
               Column('platform', String),
               Column('s3_bucket', String),
               Column('prefix', String),
@@ -111,18 +421,20 @@ def create_obs_inventory_table():
               Column('unique_hash', String),
               Column('inserted_at', DateTime),
               Column('valid_at', DateTime),
+              Column('updated_at', DateTime),
               UniqueConstraint(
                 'unique_hash',
                 'obs_day',
                 'file_size',
                 'last_modified',
                 'etag',
-                name='unique_obs_inventory' )
+                name='unique_obs_inventory' ),
+              *get_table_indexes(OBS_INVENTORY_TABLE)
         )
 
 
 
-def create_cmd_results_table():
+def create_cmd_results_table(engine):
     insp = inspect(engine)
     table_exists = insp.has_table(CMD_RESULTS_TABLE)
     print(f'cmd_results table exists: {table_exists}')
@@ -143,7 +455,7 @@ def create_cmd_results_table():
 
 
 
-def create_obs_meta_nceplibs_bufr_table():
+def create_obs_meta_nceplibs_bufr_table(engine):
     insp = inspect(engine)
     table_exists = insp.has_table(OBS_META_NCEPLIBS_BUFR_TABLE)
     print(f'obs_meta_nceplibs_bufr table exists: {table_exists}')
@@ -181,10 +493,11 @@ def create_obs_meta_nceplibs_bufr_table():
                 'sat_id',
                 'sat_inst_id',
                 name='unique_bufr_meta'
-            )
+            ),
+              *get_table_indexes(OBS_META_NCEPLIBS_BUFR_TABLE)
         )
 
-def create_obs_meta_nceplibs_prepbufr_table():
+def create_obs_meta_nceplibs_prepbufr_table(engine):
     insp = inspect(engine)
     table_exists = insp.has_table(OBS_META_NCEPLIBS_PREPBUFR_TABLE)
     print(f'{OBS_META_NCEPLIBS_PREPBUFR_TABLE} table exists: {table_exists}')
@@ -233,10 +546,11 @@ def create_obs_meta_nceplibs_prepbufr_table():
                 'typ',
                 'tot',
                 name='unqiue_prepbufr_meta'
-            )
+            ),
+              *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_TABLE)
         )
 
-def create_obs_meta_nceplibs_prepbufr_agg_table():
+def create_obs_meta_nceplibs_prepbufr_agg_table(engine):
     insp = inspect(engine)
     table_exists = insp.has_table(OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE)
     print(f'{OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE} table exists: {table_exists}')
@@ -283,9 +597,103 @@ def create_obs_meta_nceplibs_prepbufr_agg_table():
                 'file_size',
                 'obs_day',
                 name='unique_prebufr_agg_meta'
+            ),
+              *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE)
+        )
+
+def create_obs_meta_nceplibs_bufr_latest_table(engine):
+    insp = inspect(engine)
+    table_exists = insp.has_table(OBS_META_NCEPLIBS_BUFR_LATEST_TABLE)
+    print(f'{OBS_META_NCEPLIBS_BUFR_LATEST_TABLE} table exists: {table_exists}')
+    if not insp.has_table(OBS_META_NCEPLIBS_BUFR_LATEST_TABLE):
+
+        Table(OBS_META_NCEPLIBS_BUFR_LATEST_TABLE, metadata,
+              Column('latest_id', Integer, primary_key=True),
+              Column(
+                  'obs_id',
+                  Integer,
+                  ForeignKey('obs_inventory.obs_id'),
+                  nullable=False
+              ),
+              Column('sat_id', Integer),
+              Column('sat_id_name', String),
+              Column('obs_count', Integer),
+              Column('sat_inst_id', Integer),
+              Column('sat_inst_desc', String),
+              Column('filename', String),
+              Column('file_size', Integer),
+              Column('obs_day', DateTime),
+              Column('inserted_at', DateTime),
+              UniqueConstraint(
+                *BUFR_LATEST_KEY,
+                name='unique_bufr_meta_latest'
+            ),
+              *get_table_indexes(OBS_META_NCEPLIBS_BUFR_LATEST_TABLE)
+        )
+
+def create_obs_meta_nceplibs_prepbufr_latest_table(engine):
+    insp = inspect(engine)
+    table_exists = insp.has_table(OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE)
+    print(f'{OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE} table exists: {table_exists}')
+    if not insp.has_table(OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE):
+
+        Table(OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE, metadata,
+              Column('latest_id', Integer, primary_key=True),
+              Column(
+                  'obs_id',
+                  Integer,
+                  ForeignKey('obs_inventory.obs_id'),
+                  nullable=False
+              ),
+              Column('variable', String),
+              Column('typ', Integer),
+              Column('tot', Integer),
+              Column('qm0thru3', Integer),
+              Column('filename', String),
+              Column('file_size', Integer),
+              Column('obs_day', DateTime),
+              Column('inserted_at', DateTime),
+              UniqueConstraint(
+                *PREPBUFR_LATEST_KEY,
+                name='unique_prepbufr_meta_latest'
+            ),
+              *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE)
+        )
+
+def create_inventory_watermarks_table(engine):
+    insp = inspect(engine)
+    table_exists = insp.has_table(INVENTORY_WATERMARKS_TABLE)
+    print(f'{INVENTORY_WATERMARKS_TABLE} table exists: {table_exists}')
+    if not insp.has_table(INVENTORY_WATERMARKS_TABLE):
+
+        Table(INVENTORY_WATERMARKS_TABLE, metadata,
+              Column('watermark_id', Integer, primary_key=True),
+              Column('watermark_hash', String),
+              Column('platform', String),
+              Column('search_key', String),
+              Column('last_cycle', DateTime),
+              Column('updated_at', DateTime),
+              UniqueConstraint(
+                'watermark_hash',
+                name='unique_inventory_watermark'
             )
         )
 
+def create_cmd_result_payloads_table(engine):
+    insp = inspect(engine)
+    table_exists = insp.has_table(CMD_RESULT_PAYLOADS_TABLE)
+    print(f'{CMD_RESULT_PAYLOADS_TABLE} table exists: {table_exists}')
+    if not insp.has_table(CMD_RESULT_PAYLOADS_TABLE):
+
+        Table(CMD_RESULT_PAYLOADS_TABLE, metadata,
+              Column('payload_hash', String, primary_key=True),
+              Column('codec', String),
+              Column('payload', LargeBinary),
+              Column('raw_size', Integer),
+              Column('archive_path', String),
+              Column('created_at', DateTime),
+        )
+
 class CmdResult(Base):
     __tablename__ = CMD_RESULTS_TABLE
 
@@ -314,12 +722,17 @@ class ObsInventory(Base):
             'etag',
             name='unique_obs_inventory'
         ),
+        *get_table_indexes(OBS_INVENTORY_TABLE)
     )
 
     obs_id = Column(Integer, primary_key=True)
     cmd_result_id = Column(Integer, ForeignKey('cmd_results.cmd_result_id'))
     filename = Column(String(255))
+    generic_filename = Column(String(255))
     parent_dir = Column(String(1023))
+    sensor = Column(String(63))
+    stream = Column(String(63))
+    source_dir = Column(String(1023))
     platform = Column(String(63))
     s3_bucket = Column(String(63))
     prefix = Column(String(63))
@@ -337,6 +750,8 @@ class ObsInventory(Base):
     unique_hash = Column(String(64))
     inserted_at = Column(DateTime())
     valid_at = Column(DateTime())
+    # last written, inserted_at is when the file was found by a search
+    updated_at = Column(DateTime())
 
     cmd_result = relationship("CmdResult", foreign_keys=[cmd_result_id])
 
@@ -353,6 +768,7 @@ class ObsMetaNceplibsBufr(Base):
             'sat_inst_id',
             name='unique_bufr_meta'
         ),
+        *get_table_indexes(OBS_META_NCEPLIBS_BUFR_TABLE)
     )
 
     meta_id = Column(Integer, primary_key=True)
@@ -385,6 +801,7 @@ class ObsMetaNceplibsPrepbufr(Base):
             'tot',
             name='unqiue_prepbufr_meta'
         ),
+        *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_TABLE)
     )
 
     meta_id = Column(Integer, primary_key=True)
@@ -425,6 +842,7 @@ class ObsMetaNceplibsPrepbufrAggregate(Base):
             'obs_day',
             name='unique_prebufr_agg_meta'
         ),
+        *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE)
     )
 
     meta_id = Column(Integer, primary_key=True)
@@ -452,17 +870,93 @@ class ObsMetaNceplibsPrepbufrAggregate(Base):
 
     cmd_result = relationship("CmdResult", foreign_keys=[cmd_result_id])
 
+class ObsMetaNceplibsBufrLatest(Base):
+    __tablename__ = OBS_META_NCEPLIBS_BUFR_LATEST_TABLE
+    __table_args__ = (
+        UniqueConstraint(
+            *BUFR_LATEST_KEY,
+            name='unique_bufr_meta_latest'
+        ),
+        *get_table_indexes(OBS_META_NCEPLIBS_BUFR_LATEST_TABLE)
+    )
+
+    latest_id = Column(Integer, primary_key=True)
+    obs_id = Column(Integer, ForeignKey('obs_inventory.obs_id'))
+    sat_id = Column(Integer(), default=-1)
+    sat_id_name = Column(String(31))
+    obs_count = Column(Integer(), default=-1)
+    sat_inst_id = Column(Integer, default=-1)
+    sat_inst_desc = Column(String(127))
+    filename = Column(String(63))
+    file_size = Column(Integer(), default=-1)
+    obs_day = Column(DateTime())
+    inserted_at = Column(DateTime())
+
+class ObsMetaNceplibsPrepbufrLatest(Base):
+    __tablename__ = OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE
+    __table_args__ = (
+        UniqueConstraint(
+            *PREPBUFR_LATEST_KEY,
+            name='unique_prepbufr_meta_latest'
+        ),
+        *get_table_indexes(OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE)
+    )
+
+    latest_id = Column(Integer, primary_key=True)
+    obs_id = Column(Integer, ForeignKey('obs_inventory.obs_id'))
+    variable = Column(String(63))
+    typ = Column(Integer())
+    tot = Column(Integer())
+    qm0thru3 = Column(Integer())
+    filename = Column(String(63))
+    file_size = Column(Integer(), default=-1)
+    obs_day = Column(DateTime())
+    inserted_at = Column(DateTime())
+
+class InventoryWatermark(Base):
+    __tablename__ = INVENTORY_WATERMARKS_TABLE
+    # search keys are too long for a unique index on MySQL, their md5 is
+    # unique instead, as unique_hash is for obs_inventory
+    __table_args__ = (
+        UniqueConstraint(
+            'watermark_hash',
+            name='unique_inventory_watermark'
+        ),
+    )
+
+    watermark_id = Column(Integer, primary_key=True)
+    watermark_hash = Column(String(64))
+    platform = Column(String(63))
+    search_key = Column(String(1023))
+    last_cycle = Column(DateTime())
+    updated_at = Column(DateTime())
+
+class CmdResultPayload(Base):
+    __tablename__ = CMD_RESULT_PAYLOADS_TABLE
+
+    payload_hash = Column(String(64), primary_key=True)
+    codec = Column(String(15))
+    payload = Column(LargeBinary())
+    raw_size = Column(Integer())
+    archive_path = Column(String(1023))
+    created_at = Column(DateTime())
+
+def generate_watermark_hash(platform, search_key):
+    hash_input = f"{platform}{search_key}"
+    return hashlib.md5(hash_input.encode('utf-8')).hexdigest()
+
 def generate_obs_inventory_hash(filename, parent_dir, platform, s3_bucket):
     hash_input = f"{filename}{parent_dir}{platform}{s3_bucket}"
     return hashlib.md5(hash_input.encode('utf-8')).hexdigest()
 
-def insert_obs_inv_items(obs_inv_items):
+def get_obs_inv_rows(obs_inv_items):
     if not isinstance(obs_inv_items, list):
         msg = 'Inserted observation inventory items must be in the form' \
               f' of a list.  Received type: {type(obs_inv_items)}'
         raise TypeError(msg)
 
     rows = []
+    updated_at = datetime.now()
     for obs_item in obs_inv_items:
         if not isinstance(obs_item, se.TarballFileMeta):
             msg = 'Each observation inventory item must be in the form' \
@@ -475,7 +969,11 @@ def insert_obs_inv_items(obs_inv_items):
         row = {
             'cmd_result_id': obs_item.cmd_result_id,
             'filename': obs_item.filename,
+            'generic_filename': se.get_generic_filename(obs_item.filename),
             'parent_dir': obs_item.parent_dir,
+            'sensor': se.get_sensor(obs_item.parent_dir),
+            'stream': se.get_stream(obs_item.parent_dir),
+            'source_dir': se.get_source_dir(obs_item.parent_dir),
             'platform': obs_item.platform,
             's3_bucket': obs_item.s3_bucket,
             'prefix': obs_item.prefix,
@@ -493,41 +991,101 @@ def insert_obs_inv_items(obs_inv_items):
             'unique_hash': hash_value,
             'inserted_at': obs_item.inserted_at,
             'valid_at': obs_item.valid_at,
+            'updated_at': updated_at,
         }
         rows.append(row)
 
+    return rows
+
+
+@functools.lru_cache(maxsize=None)
+def get_obs_inv_upsert_statement(database_type):
+    """
+    Upsert of obs_inventory rows.  Built once per database type without
+    values, it is run with executemany by insert_obs_inv_rows.
+    """
     #handle the best way available for each database type
-    if(database_type.lower() == 'mysql'):
-        statement = mysql_insert(ObsInventory).values(rows)
+    if(database_type == 'mysql'):
+        statement = mysql_insert(ObsInventory)
         statement = statement.on_duplicate_key_update(
-            valid_at=statement.inserted.valid_at
+            valid_at=statement.inserted.valid_at,
+            generic_filename=statement.inserted.generic_filename,
+            sensor=statement.inserted.sensor,
+            stream=statement.inserted.stream,
+            source_dir=statement.inserted.source_dir,
+            updated_at=statement.inserted.updated_at
         )
     else:
         #sqlite specific
-        statement = sqlite_insert(ObsInventory).values(rows)
+        statement = sqlite_insert(ObsInventory)
         statement = statement.on_conflict_do_update(
             index_elements=['unique_hash',
             'obs_day',
             'file_size',
             'last_modified',
             'etag'],
-            set_={'valid_at': statement.excluded.valid_at}
+            set_={
+                'valid_at': statement.excluded.valid_at,
+                'generic_filename': statement.excluded.generic_filename,
+                'sensor': statement.excluded.sensor,
+                'stream': statement.excluded.stream,
+                'source_dir': statement.excluded.source_dir,
+                'updated_at': statement.excluded.updated_at
+            }
         )
 
+    return statement
+
+
+@functools.lru_cache(maxsize=None)
+def get_text_statement(sql):
+    return text(sql)
+
+
+def insert_rows(session, table_name, statement, rows):
+    """
+    Run an insert statement with executemany over 'rows' in adaptive
+    chunks, see bulk_insert.
+    """
+    if len(rows) == 0:
+        return
+
+    database_type = get_database_type()
+    chunker = bulk_insert.get_chunker(
+        table_name, database_type, len(rows[0]))
+    bulk_insert.execute_in_chunks(session, statement, rows, chunker)
+
+
+def insert_obs_inv_rows(session, rows):
+    insert_rows(
+        session,
+        OBS_INVENTORY_TABLE,
+        get_obs_inv_upsert_statement(get_database_type()),
+        rows
+    )
+
+
+@forward_to_ingest_writer
+@retry_when_busy
+def insert_obs_inv_items(obs_inv_items):
+    rows = get_obs_inv_rows(obs_inv_items)
+
     session = Session()
-    session.execute(statement)
-    session.commit()
-    session.close()
+    try:
+        insert_obs_inv_rows(session, rows)
+        session.commit()
+    finally:
+        session.close()
 
 
-def insert_cmd_result(cmd_result_data):
+def get_cmd_result_item(cmd_result_data):
     if not isinstance(cmd_result_data, CmdResultData):
         msg = 'Inserted command result item must be in the form' \
               f' of type: CmdResultData.  Received type: ' \
               f'{type(cmd_result_data)}'
         raise TypeError(msg)
 
-    tbl_item = CmdResult(
+    return CmdResult(
         command=cmd_result_data.command,
         arg0=cmd_result_data.arg0,
         raw_output=cmd_result_data.raw_output,
@@ -539,15 +1097,192 @@ def insert_cmd_result(cmd_result_data):
         inserted_at=datetime.utcnow()
     )
 
+
+def get_cmd_result_payload(payload_hash):
     session = Session()
-    session.add(tbl_item)
-    session.commit()
-    print(f'cmd_result id: {tbl_item.cmd_result_id}')
-    cmd_id = tbl_item.cmd_result_id
+    payload = session.query(
+        CmdResultPayload.codec,
+        CmdResultPayload.payload,
+        CmdResultPayload.archive_path
+    ).filter(
+        CmdResultPayload.payload_hash == payload_hash
+    ).first()
     session.close()
+    return payload
+
+
+def insert_cmd_result_payloads(payload_rows, session):
+    """
+    Insert payload rows in the given session, payloads that are already
+    stored are skipped.
+    """
+    if len(payload_rows) == 0:
+        return
+
+    if(get_database_type() == 'mysql'):
+        sql = """
+            INSERT IGNORE INTO cmd_result_payloads
+            (payload_hash, codec, payload, raw_size, archive_path, created_at)
+            VALUES (:payload_hash, :codec, :payload, :raw_size, :archive_path, :created_at)
+            """
+    else:
+        sql = """
+            INSERT OR IGNORE INTO cmd_result_payloads
+            (payload_hash, codec, payload, raw_size, archive_path, created_at)
+            VALUES (:payload_hash, :codec, :payload, :raw_size, :archive_path, :created_at)
+            """
+
+    session.execute(get_text_statement(sql), payload_rows)
+
+
+def store_cmd_result_payloads(cmd_results_data):
+    """
+    Apply the cmd_results.raw_output storage mode (see payload_store) to
+    each CmdResultData.  Returns the CmdResultData to insert and the
+    distinct payload rows to insert with them.
+    """
+    # payload_store reads and writes its tables through this module
+    from obs_inv_utils import payload_store
+
+    stored_results = []
+    payload_rows = {}
+    for cmd_result_data in cmd_results_data:
+        if not isinstance(cmd_result_data, CmdResultData):
+            msg = 'Inserted command result item must be in the form' \
+                  f' of type: CmdResultData.  Received type: ' \
+                  f'{type(cmd_result_data)}'
+            raise TypeError(msg)
+
+        raw_output, payload_row = payload_store.store_raw_output(
+            cmd_result_data.raw_output)
+        if payload_row is not None:
+            payload_rows[payload_row['payload_hash']] = payload_row
+        stored_results.append(cmd_result_data._replace(raw_output=raw_output))
+
+    return stored_results, list(payload_rows.values())
+
+
+@forward_to_ingest_writer
+@retry_when_busy
+def insert_cmd_result(cmd_result_data):
+    [cmd_result_data], payload_rows = store_cmd_result_payloads(
+        [cmd_result_data])
+    tbl_item = get_cmd_result_item(cmd_result_data)
+
+    session = Session()
+    try:
+        insert_cmd_result_payloads(payload_rows, session)
+        session.add(tbl_item)
+        session.commit()
+        print(f'cmd_result id: {tbl_item.cmd_result_id}')
+        cmd_id = tbl_item.cmd_result_id
+    finally:
+        session.close()
     return cmd_id
 
 
+@forward_to_ingest_writer
+@retry_when_busy
+def insert_cmd_results_with_obs_inv_items(cmd_results):
+    """
+    Insert a batch of command results and the observation inventory items
+    found by each of them in a single transaction.  'cmd_results' is a list
+    of (CmdResultData, list of TarballFileMeta) tuples; the cmd_result_id of
+    each item is replaced by the id assigned to its command result.
+    Returns the assigned cmd_result_ids in the order given.
+    """
+    cmd_results_data, payload_rows = store_cmd_result_payloads([
+        cmd_result_data for cmd_result_data, obs_inv_items in cmd_results
+    ])
+    tbl_items = [
+        get_cmd_result_item(cmd_result_data)
+        for cmd_result_data in cmd_results_data
+    ]
+
+    session = Session()
+    try:
+        insert_cmd_result_payloads(payload_rows, session)
+        session.add_all(tbl_items)
+        # assigns the cmd_result_ids without committing
+        session.flush()
+        cmd_ids = [tbl_item.cmd_result_id for tbl_item in tbl_items]
+
+        obs_inv_items = []
+        for cmd_id, (cmd_result_data, items) in zip(cmd_ids, cmd_results):
+            obs_inv_items.extend(
+                item._replace(cmd_result_id=cmd_id) for item in items)
+
+        insert_obs_inv_rows(session, get_obs_inv_rows(obs_inv_items))
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return cmd_ids
+
+
+def get_insert_ignore_sql():
+    if(get_database_type() == 'mysql'):
+        return 'INSERT IGNORE INTO'
+    return 'INSERT OR IGNORE INTO'
+
+
+def get_latest_insert_sql(latest_table, key_columns):
+    """
+    Statement adding meta rows to a latest table.  Like the meta tables,
+    the first row inserted for a key is kept, so the latest table holds
+    exactly the rows the plots used to deduplicate out of the meta table.
+    """
+    columns = key_columns + ['inserted_at']
+    return f"""
+        {get_insert_ignore_sql()} {latest_table}
+        ({', '.join(columns)})
+        VALUES ({', '.join(':' + column for column in columns)})
+        """
+
+
+@retry_when_busy
+def populate_latest_table(latest_table, meta_table, key_columns, engine=None):
+    """
+    Fill a latest table from every row already in its meta table.  Safe to
+    run again, rows already in the latest table are kept.
+    """
+    if engine is None:
+        engine = get_engine()
+
+    key = ', '.join(key_columns)
+    sql = f"""
+        {get_insert_ignore_sql()} {latest_table}
+        ({key}, inserted_at)
+        SELECT {key}, MAX(inserted_at) FROM {meta_table}
+        GROUP BY {key}
+        """
+    with engine.begin() as connection:
+        result = connection.execute(text(sql))
+    print(f'Populated {latest_table} from {meta_table}, rows added: '
+          f'{result.rowcount}')
+    return result.rowcount
+
+
+def populate_latest_tables(engine=None):
+    return populate_latest_table(
+        OBS_META_NCEPLIBS_BUFR_LATEST_TABLE,
+        OBS_META_NCEPLIBS_BUFR_TABLE,
+        BUFR_LATEST_KEY,
+        engine
+    ) + populate_latest_table(
+        OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE,
+        OBS_META_NCEPLIBS_PREPBUFR_TABLE,
+        PREPBUFR_LATEST_KEY,
+        engine
+    )
+
+
+@forward_to_ingest_writer
+@retry_when_busy
 def insert_obs_meta_nceplibs_bufr_item(obs_meta_items):
     if not isinstance(obs_meta_items, list):
         msg = 'Inserted obs nceplibs bufr meta items must be in the form' \
@@ -573,7 +1308,7 @@ def insert_obs_meta_nceplibs_bufr_item(obs_meta_items):
         rows.append(row)
 
     #This has to be raw SQL to use the INSERT/IGNORE call
-    if(database_type.lower() == 'mysql'):
+    if(get_database_type() == 'mysql'):
         #mysql compatible
         sql = """
             INSERT IGNORE INTO obs_meta_nceplibs_bufr
@@ -590,12 +1325,21 @@ def insert_obs_meta_nceplibs_bufr_item(obs_meta_items):
 
     if len(rows) > 0:
         session = Session()
-        session.execute(text(sql), rows)
-        session.commit()
-        session.close()
+        try:
+            insert_rows(session, OBS_META_NCEPLIBS_BUFR_TABLE,
+                        get_text_statement(sql), rows)
+            insert_rows(session, OBS_META_NCEPLIBS_BUFR_LATEST_TABLE,
+                        get_text_statement(get_latest_insert_sql(
+                            OBS_META_NCEPLIBS_BUFR_LATEST_TABLE,
+                            BUFR_LATEST_KEY)), rows)
+            session.commit()
+        finally:
+            session.close()
     else:
         print("NO DATA PROVIDED TO INSERT. No data inserted into the bufr meta table.")
 
+@forward_to_ingest_writer
+@retry_when_busy
 def insert_obs_meta_nceplibs_prepbufr_item(obs_meta_items):
     if not isinstance(obs_meta_items, list):
         msg = 'Inserted obs nceplibs prepbufr meta items must be in the form' \
@@ -631,7 +1375,7 @@ def insert_obs_meta_nceplibs_prepbufr_item(obs_meta_items):
         rows.append(row)
 
     # SQL statement with INSERT/IGNORE
-    if(database_type.lower() == 'mysql'):
+    if(get_database_type() == 'mysql'):
         sql = """
             INSERT IGNORE INTO obs_meta_nceplibs_prepbufr
             (obs_id, cmd_result_id, cmd_str, variable, typ, tot, qm0thru3, qm4thru7, qm8, qm9, qm10, qm11, qm12, qm13, qm14, qm15, cka, ckb, filename, file_size, obs_day, inserted_at)
@@ -645,12 +1389,21 @@ def insert_obs_meta_nceplibs_prepbufr_item(obs_meta_items):
             """
     if len(rows) > 0:
         session = Session()
-        session.execute(text(sql), rows)
-        session.commit()
-        session.close()
+        try:
+            insert_rows(session, OBS_META_NCEPLIBS_PREPBUFR_TABLE,
+                        get_text_statement(sql), rows)
+            insert_rows(session, OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE,
+                        get_text_statement(get_latest_insert_sql(
+                            OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE,
+                            PREPBUFR_LATEST_KEY)), rows)
+            session.commit()
+        finally:
+            session.close()
     else:
         print("NO DATA PROVIDED TO INSERT. No data inserted into the prepbufr meta table.")
 
+@forward_to_ingest_writer
+@retry_when_busy
 def insert_obs_meta_nceplibs_prepbufr_agg_item(obs_meta_items):
     if not isinstance(obs_meta_items, list):
         msg = 'Inserted obs nceplibs prepbufr aggregate meta items must be in the form' \
@@ -685,7 +1438,7 @@ def insert_obs_meta_nceplibs_prepbufr_agg_item(obs_meta_items):
         rows.append(row)
 
     # SQL statement with INSERT IGNORE
-    if(database_type.lower() == 'mysql'):
+    if(get_database_type() == 'mysql'):
         sql = """
             INSERT IGNORE INTO obs_meta_nceplibs_prepbufr_aggregate
             (obs_id, cmd_result_id, cmd_str, variable, tot, qm0thru3, qm4thru7, qm8, qm9, qm10, qm11, qm12, qm13, qm14, qm15, cka, ckb, filename, file_size, obs_day, inserted_at)
@@ -700,18 +1453,125 @@ def insert_obs_meta_nceplibs_prepbufr_agg_item(obs_meta_items):
 
     if len(rows) > 0:
         session = Session()
-        session.execute(text(sql), rows)
-        session.commit()
-        session.close()
+        try:
+            insert_rows(session, OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE,
+                        get_text_statement(sql), rows)
+            session.commit()
+        finally:
+            session.close()
     else:
         print("NO DATA PROVIDED TO INSERT. No data inserted into the prepbufr agggregate meta table.")
 
-if(database_type.lower() == 'mysql'):
-    Base.metadata.create_all(engine)
-else:
-    create_obs_inventory_table()
-    create_cmd_results_table()
-    create_obs_meta_nceplibs_bufr_table()
-    create_obs_meta_nceplibs_prepbufr_table()
-    create_obs_meta_nceplibs_prepbufr_agg_table()
-    metadata.create_all(engine)
+def get_inventory_watermark(platform, search_key):
+    """
+    Return the last cycle searched for the platform and search key
+    template, or None if it has never been searched incrementally.
+    """
+    session = Session()
+    watermark = session.query(InventoryWatermark.last_cycle).filter(
+        InventoryWatermark.watermark_hash ==
+            generate_watermark_hash(platform, search_key)
+    ).first()
+    session.close()
+
+    if watermark is None:
+        return None
+    return watermark.last_cycle
+
+
+@retry_when_busy
+def upsert_inventory_watermark(platform, search_key, last_cycle):
+    row = {
+        'watermark_hash': generate_watermark_hash(platform, search_key),
+        'platform': platform,
+        'search_key': search_key,
+        'last_cycle': last_cycle,
+        'updated_at': datetime.utcnow()
+    }
+
+    if(get_database_type() == 'mysql'):
+        statement = mysql_insert(InventoryWatermark).values(row)
+        statement = statement.on_duplicate_key_update(
+            last_cycle=statement.inserted.last_cycle,
+            updated_at=statement.inserted.updated_at
+        )
+    else:
+        statement = sqlite_insert(InventoryWatermark).values(row)
+        statement = statement.on_conflict_do_update(
+            index_elements=['watermark_hash'],
+            set_={
+                'last_cycle': statement.excluded.last_cycle,
+                'updated_at': statement.excluded.updated_at
+            }
+        )
+
+    session = Session()
+    try:
+        session.execute(statement)
+        session.commit()
+    finally:
+        session.close()
+
+def get_missing_columns(engine):
+    """
+    Return (table name, Column) for each ORM column missing from an
+    existing table, columns added after the table was created.
+    """
+    insp = inspect(engine)
+    missing_columns = []
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+
+        existing = {column['name'] for column in insp.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                missing_columns.append((table.name, column))
+
+    return missing_columns
+
+
+def add_missing_columns(engine):
+    """
+    Add the columns returned by get_missing_columns.  New columns are
+    nullable so adding them only changes the table definition, the rows
+    are filled in later by the db backfill command.
+    """
+    added = []
+    for table_name, column in get_missing_columns(engine):
+        column_type = column.type.compile(dialect=engine.dialect)
+        sql = f'ALTER TABLE {table_name} ADD COLUMN {column.name} ' \
+              f'{column_type}'
+        print(f'Adding column: {sql}')
+        with engine.begin() as connection:
+            connection.execute(text(sql))
+        added.append(f'{table_name}.{column.name}')
+
+    return added
+
+def init_schema(engine):
+    """
+    Create the missing tables and columns.  Latest tables created here are
+    filled from the rows already in their meta tables.
+    """
+    new_latest_tables = not inspect(engine).has_table(
+        OBS_META_NCEPLIBS_BUFR_LATEST_TABLE)
+
+    if(get_database_type() == 'mysql'):
+        Base.metadata.create_all(engine)
+    else:
+        # only holds the tables missing from the database being set up
+        metadata.clear()
+        create_obs_inventory_table(engine)
+        create_cmd_results_table(engine)
+        create_obs_meta_nceplibs_bufr_table(engine)
+        create_obs_meta_nceplibs_prepbufr_table(engine)
+        create_obs_meta_nceplibs_prepbufr_agg_table(engine)
+        create_obs_meta_nceplibs_bufr_latest_table(engine)
+        create_obs_meta_nceplibs_prepbufr_latest_table(engine)
+        create_inventory_watermarks_table(engine)
+        create_cmd_result_payloads_table(engine)
+        metadata.create_all(engine)
+    add_missing_columns(engine)
+    if new_latest_tables:
+        populate_latest_tables(engine)
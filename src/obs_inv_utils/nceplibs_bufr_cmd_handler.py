@@ -22,6 +22,8 @@ from obs_inv_utils import inventory_table_factory as itf
 from obs_inv_utils import subprocess_cmd_handler as sch
 from obs_inv_utils.subprocess_cmd_handler import SubprocessCmd
 from obs_inv_utils import nceplibs_cmds as nc_cmds
+from obs_inv_utils.progress_journal import ProgressJournal
+from obs_inv_utils.progress_journal import SINV_UNIT, CMPBQM_UNIT
 
 
 CALLING_DIR = pathlib.Path(__file__).parent.resolve()
@@ -53,6 +55,34 @@ def post_aws_s3_cmd_result(raw_response, obs_cycle_time):
     itf.insert_cmd_result(cmd_result_data)
 
 
+def get_file_unit(unit_type, bufr_file):
+    return (unit_type, bufr_file['full_path'], bufr_file['obs_day'])
+
+
+def file_is_complete(journal, unit):
+    if journal is None or not journal.is_complete(unit):
+        return False
+
+    print(f'Skipping completed file: {unit[1]}, obs_day: {unit[2]}')
+    return True
+
+
+def mark_file_complete(journal, unit):
+    if journal is not None:
+        journal.mark_complete([unit])
+
+
+def iter_inventory_files(filenames, date_range):
+    """
+    Index and row of each inventory file matching 'filenames' in
+    'date_range', read from the database one chunk at a time.
+    """
+    for files in oiq.iter_bufr_files_data(
+            filenames, date_range.start, date_range.end):
+        for idx, bufr_file in files.iterrows():
+            yield idx, bufr_file
+
+
 def download_bufr_file_from_s3(work_dir, bufr_file):
     object_key = bufr_file['full_path']
 
@@ -106,7 +136,7 @@ class ObsBufrFileMetaHandler(object):
     s3_bucket: str = field(default_factory=str, init=False)
     s3_prefix: str = field(default_factory=str, init=False)
     platform:  str = field(default_factory=str, init=False)
-
+    journal: ProgressJournal = None
 
     def __post_init__(self):
         self.date_range = self.meta_config.get_date_range()
@@ -123,10 +153,9 @@ class ObsBufrFileMetaHandler(object):
 
     def get_bufr_file_meta(self, cmd_type):
 
-        inventory_bufr_files = oiq.get_bufr_files_data(
+        inventory_bufr_files = iter_inventory_files(
             self.bufr_files,
-            self.date_range.start,
-            self.date_range.end
+            self.date_range
         )
 
         # Delete?
@@ -143,19 +172,25 @@ class ObsBufrFileMetaHandler(object):
 
             work_dir = os.path.join(self.meta_config.work_dir, temp_uuid)
 
-            print(f'inventory_bufr_files: {inventory_bufr_files}')
+            print(f'inventory files: {self.bufr_files}')
             print(f'scrub_files: {self.meta_config.scrub_files}')
-            for idx, bufr_file in inventory_bufr_files.iterrows():
+            for idx, bufr_file in inventory_bufr_files:
                 file_downloaded = False
                 print(
                    f'bufr_file: {bufr_file}')
 
+                unit = get_file_unit(SINV_UNIT, bufr_file)
+                if file_is_complete(self.journal, unit):
+                    continue
+
                 saved_filename = download_bufr_file_from_s3(work_dir, bufr_file)
 
                 if saved_filename is None:
                     continue
 
-                self.get_obs_counts_with_sinv(saved_filename, bufr_file)
+                if self.get_obs_counts_with_sinv(
+                        saved_filename, bufr_file) is not False:
+                    mark_file_complete(self.journal, unit)
 
                 # clean up files
                 if self.meta_config.scrub_files:
@@ -167,11 +202,15 @@ class ObsBufrFileMetaHandler(object):
 
             work_dir = os.path.join(self.meta_config.work_dir)
 
-            for idx, bufr_file in inventory_bufr_files.iterrows():
+            for idx, bufr_file in inventory_bufr_files:
                 file_downloaded = False
                 print(
                    f'bufr_file: {bufr_file}')
 
+                unit = get_file_unit(SINV_UNIT, bufr_file)
+                if file_is_complete(self.journal, unit):
+                    continue
+
                 try:
                     saved_filename = bufr_file['full_path'] 
                 except Exception as err:
@@ -181,7 +220,9 @@ class ObsBufrFileMetaHandler(object):
                 if saved_filename is None:
                     continue
 
-                self.get_obs_counts_with_sinv(saved_filename, bufr_file)
+                if self.get_obs_counts_with_sinv(
+                        saved_filename, bufr_file) is not False:
+                    mark_file_complete(self.journal, unit)
 
 
 
@@ -218,7 +259,7 @@ class ObsPrepBufrFileMetaHandler(object):
     s3_bucket: str = field(default_factory=str, init=False)
     s3_prefix: str = field(default_factory=str, init=False)
     platform:  str = field(default_factory=str, init=False)
-
+    journal: ProgressJournal = None
 
     def __post_init__(self):
         self.date_range = self.meta_config.get_date_range()
@@ -235,10 +276,9 @@ class ObsPrepBufrFileMetaHandler(object):
 
     def get_prepbufr_file_meta(self, cmd_type):
 
-        inventory_prepbufr_files = oiq.get_bufr_files_data(
+        inventory_prepbufr_files = iter_inventory_files(
             self.prepbufr_files,
-            self.date_range.start,
-            self.date_range.end
+            self.date_range
         )
 
         # Delete?
@@ -254,19 +294,25 @@ class ObsPrepBufrFileMetaHandler(object):
 
             work_dir = os.path.join(self.meta_config.work_dir, temp_uuid)
 
-            print(f'inventory_prepbufr_files: {inventory_prepbufr_files}')
+            print(f'inventory files: {self.prepbufr_files}')
             print(f'scrub_files: {self.meta_config.scrub_files}')
-            for idx, prepbufr_file in inventory_prepbufr_files.iterrows():
+            for idx, prepbufr_file in inventory_prepbufr_files:
                 file_downloaded = False
                 print(
                    f'bufr_file: {prepbufr_file}')
                 
+                unit = get_file_unit(CMPBQM_UNIT, prepbufr_file)
+                if file_is_complete(self.journal, unit):
+                    continue
+
                 saved_filename = download_bufr_file_from_s3(work_dir, prepbufr_file)
   
                 if saved_filename is None:
                     continue
 
-                self.get_obs_counts_with_cmpbqm(saved_filename, prepbufr_file)
+                if self.get_obs_counts_with_cmpbqm(
+                        saved_filename, prepbufr_file) is not False:
+                    mark_file_complete(self.journal, unit)
 
                 # clean up files
                 if self.meta_config.scrub_files:
@@ -277,13 +323,17 @@ class ObsPrepBufrFileMetaHandler(object):
 
             work_dir = os.path.join(self.meta_config.work_dir)
 
-            print(f'inventory_prepbufr_files: {inventory_prepbufr_files}')
+            print(f'inventory files: {self.prepbufr_files}')
             print(f'scrub_files: {self.meta_config.scrub_files}')
-            for idx, prepbufr_file in inventory_prepbufr_files.iterrows():
+            for idx, prepbufr_file in inventory_prepbufr_files:
                 file_downloaded = False
                 print(
                    f'bufr_file: {prepbufr_file}')
  
+                unit = get_file_unit(CMPBQM_UNIT, prepbufr_file)
+                if file_is_complete(self.journal, unit):
+                    continue
+
                 try:
                     saved_filename = prepbufr_file['full_path'] 
                     print(f'saved_filename: {saved_filename}')
@@ -294,7 +344,9 @@ class ObsPrepBufrFileMetaHandler(object):
                 if saved_filename is None:
                     continue
 
-                self.get_obs_counts_with_cmpbqm(saved_filename, prepbufr_file)
+                if self.get_obs_counts_with_cmpbqm(
+                        saved_filename, prepbufr_file) is not False:
+                    mark_file_complete(self.journal, unit)
 
 
     
@@ -26,64 +26,227 @@ from obs_inv_utils.nceplibs_bufr_cmd_handler import ObsBufrFileMetaHandler, ObsP
 
 from obs_inv_utils import plot_generator as pg
 from obs_inv_utils import search_engine as se
+from obs_inv_utils import payload_store
+from obs_inv_utils import query_cache
+from obs_inv_utils import db_migrations
+from obs_inv_utils import connection_pools
+from obs_inv_utils import ingest_service
+from obs_inv_utils import shard_merge
+from obs_inv_utils import snapshots
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils.progress_journal import ProgressJournal
 
 @click.group()
 def cli():
     """Cli for observations Inventory."""
 
 
-def get_obs_inventory_base(config_yaml):
+JOURNAL_HELP = 'Progress journal file, completed work listed in it is skipped.'
+
+
+def get_progress_journal(journal_path):
+    if journal_path is None:
+        return None
+    itf.require_unsharded('The progress journal')
+    return ProgressJournal(journal_path)
+
+
+def get_obs_inventory_base(
+    config_yaml,
+    concurrent=False,
+    incremental=False,
+    lookback_hours=0,
+    buffered=False,
+    journal_path=None
+):
     print(f'Inventory config to use: {config_yaml}')
+    if concurrent:
+        connection_pools.set_run_mode(connection_pools.THREADED_PROFILE)
     cf = ObservationsConfig(config_yaml)
     cf.load()
-    inv_search = se.ObsInventorySearchEngine(cf)
+    inv_search = se.ObsInventorySearchEngine(
+        cf,
+        concurrent=concurrent,
+        incremental=incremental,
+        lookback_hours=lookback_hours,
+        buffered=buffered,
+        journal=get_progress_journal(journal_path)
+    )
     inv_search.get_obs_file_info()
 
 @cli.command()
 @click.option('-c', '--config-yaml', 'config_yaml', required=True, type=str)
-def get_obs_inventory(config_yaml):
-    return get_obs_inventory_base(config_yaml)
+@click.option('--concurrent', 'concurrent', is_flag=True, default=False,
+              help='Search cycles in parallel, bounded per storage platform.')
+@click.option('--incremental', 'incremental', is_flag=True, default=False,
+              help='Start each search at its stored watermark.')
+@click.option('--lookback-hours', 'lookback_hours', default=0, type=int,
+              help='Hours before the watermark to search again.')
+@click.option('--buffered', 'buffered', is_flag=True, default=False,
+              help='Write search results in batches from a background thread.')
+@click.option('--journal', 'journal_path', default=None, type=str,
+              help=JOURNAL_HELP)
+def get_obs_inventory(
+    config_yaml,
+    concurrent,
+    incremental,
+    lookback_hours,
+    buffered,
+    journal_path
+):
+    return get_obs_inventory_base(
+        config_yaml,
+        concurrent,
+        incremental,
+        lookback_hours,
+        buffered,
+        journal_path
+    )
 
 @cli.command()
 @click.option('-m', '--min-instances', 'min_instances', required=True, type=int)
 def plot_files_filesize_vs_time(min_instances):
+    connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
     size_timeline = pg.ObsInvFilesizeTimeline(min_instances)
     size_timeline.plot_timeline()
 
 
 @cli.command()
 @click.option('-c', '--config-yaml', 'config_yaml', required=True, type=str)
-def plot_groups_filesize_timeseries(config_yaml):
+@click.option('-s', '--snapshot-dir', 'snapshot_dir', default=None, type=str,
+              help='Read obs_inventory from this Parquet snapshot instead '
+                   'of the database. It only holds the rows up to its last '
+                   'export.')
+def plot_groups_filesize_timeseries(config_yaml, snapshot_dir):
+    connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
     config = ObsGroupFileSizePlotConfig(config_yaml)
     config.load()
     # print(repr(config))
-    obgr = pg.ObsGroupFilesizeTimeline(config)
+    obgr = pg.ObsGroupFilesizeTimeline(config, snapshot_dir)
     obgr.plot_obsgroups_fs_timeline()
 
-def get_obs_count_meta_sinv_base(config_yaml):
+def get_obs_count_meta_sinv_base(config_yaml, journal_path=None):
     config = ObsMetaSinvConfig(config_yaml)
     config.load()
     print(repr(config))
-    mh = ObsBufrFileMetaHandler(config)
+    mh = ObsBufrFileMetaHandler(
+        config, journal=get_progress_journal(journal_path))
     mh.get_bufr_file_meta(obs_meta_sinv.NCEPLIBS_BUFR_SINV)
 
 @cli.command()
 @click.option('-c', '--config-yaml', 'config_yaml', required=True, type=str)
-def get_obs_count_meta_sinv(config_yaml):
-    return get_obs_count_meta_sinv_base(config_yaml)
+@click.option('--journal', 'journal_path', default=None, type=str,
+              help=JOURNAL_HELP)
+def get_obs_count_meta_sinv(config_yaml, journal_path):
+    return get_obs_count_meta_sinv_base(config_yaml, journal_path)
 
-def get_obs_count_meta_cmpbqm_base(config_yaml):
+def get_obs_count_meta_cmpbqm_base(config_yaml, journal_path=None):
     config = ObsMetaCMPBQMConfig(config_yaml)
     config.load()
     print(repr(config))
-    mh = ObsPrepBufrFileMetaHandler(config)
+    mh = ObsPrepBufrFileMetaHandler(
+        config, journal=get_progress_journal(journal_path))
     mh.get_prepbufr_file_meta(obs_meta_cmpbqm.NCEPLIBS_PREPBUFR_CMPBQM)
 
 @cli.command()
 @click.option('-c', '--config-yaml', 'config_yaml', required=True, type=str)
-def get_obs_count_meta_cmpbqm(config_yaml):
-    return get_obs_count_meta_cmpbqm_base(config_yaml)
-    
+@click.option('--journal', 'journal_path', default=None, type=str,
+              help=JOURNAL_HELP)
+def get_obs_count_meta_cmpbqm(config_yaml, journal_path):
+    return get_obs_count_meta_cmpbqm_base(config_yaml, journal_path)
+
+
+@cli.command()
+@click.option('-s', '--socket', 'socket_path', required=True, type=str,
+              envvar=ingest_service.INGEST_SOCKET_ENV,
+              help='Unix socket to listen on, defaults to $OBS_INV_INGEST_SOCKET.')
+def ingest_writer(socket_path):
+    """Write the inserts of inventory jobs sent to a Unix socket."""
+    ingest_service.serve(socket_path)
+
+
+@cli.group()
+def db():
+    """Inventory database maintenance."""
+
+
+@db.command()
+@click.option('--dry-run', 'dry_run', is_flag=True, default=False,
+              help='Print the statements without running them.')
+def migrate(dry_run):
+    """Add missing inventory indexes to an existing database."""
+    created = db_migrations.migrate(dry_run=dry_run)
+    print(f'Indexes {"missing" if dry_run else "created"}: {created}')
+
+
+@db.command()
+def backfill():
+    """Fill in columns and summary tables added to an existing database."""
+    updated_count = db_migrations.backfill_generic_filenames()
+    print(f'Rows backfilled with generic_filename: {updated_count}')
+    updated_count = db_migrations.backfill_parent_dir_columns()
+    print(f'Rows backfilled with sensor, stream and source_dir: '
+          f'{updated_count}')
+    latest_count = itf.populate_latest_tables()
+    print(f'Rows added to the latest meta tables: {latest_count}')
+    # the backfilled columns change query results without new rows
+    removed_count = query_cache.clear_cache()
+    print(f'Query cache entries removed: {removed_count}')
+
+
+@db.command()
+def clear_query_cache():
+    """Remove the cached query results in OBS_INV_QUERY_CACHE_DIR."""
+    removed_count = query_cache.clear_cache()
+    print(f'Query cache entries removed: {removed_count}')
+
+
+@db.command()
+@click.option('-n', '--older-than-days', 'older_than_days', default=0,
+              type=int, help='Only move outputs inserted before this many days ago.')
+def compress_payloads(older_than_days):
+    """Move inline cmd_results raw outputs into compressed payloads."""
+    updated_count = payload_store.store_inline_raw_outputs(older_than_days)
+    print(f'Raw outputs moved to cmd_result_payloads: {updated_count}')
+
+
+@db.command()
+@click.option('-d', '--archive-dir', 'archive_dir', required=True, type=str)
+@click.option('-n', '--older-than-days', 'older_than_days', default=30,
+              type=int, help='Only archive payloads stored before this many days ago.')
+def archive_payloads(archive_dir, older_than_days):
+    """Move old cmd_results payloads to zip archives."""
+    archive_paths = payload_store.archive_payloads(
+        archive_dir, older_than_days)
+    print(f'Payload archives written: {archive_paths}')
+
+
+@db.command()
+@click.option('-d', '--shard-dir', 'shard_dir', required=True, type=str)
+@click.option('--keep', 'keep', is_flag=True, default=False,
+              help='Keep the shard files after they are merged.')
+def merge_shards(shard_dir, keep):
+    """Merge the sqlite shards written with OBS_INV_SHARD_DIR."""
+    totals = shard_merge.merge_shards(shard_dir, keep=keep)
+    print(f'Rows merged: {totals}')
+
+
+@cli.group()
+def export():
+    """Export inventory tables for analysis."""
+
+
+@export.command()
+@click.option('-d', '--snapshot-dir', 'snapshot_dir', required=True, type=str,
+              envvar=snapshots.SNAPSHOT_DIR_ENV)
+@click.option('-t', '--table', 'table_names', multiple=True,
+              type=click.Choice(snapshots.SNAPSHOT_TABLES),
+              help='Table to export, may be repeated. Defaults to all.')
+def snapshot(snapshot_dir, table_names):
+    """Append new inventory rows to Parquet snapshots."""
+    counts = snapshots.export_snapshot(snapshot_dir, list(table_names) or None)
+    print(f'Rows exported: {counts}')
+
 
 if __name__ == '__main__':
     print(f'in cli - input arguments: {sys.argv[1:]}')
@@ -1,43 +1,184 @@
+import os
 from datetime import datetime
+from itertools import islice
 
+import pandas
 from pandas import DataFrame
 import sqlalchemy as db
 from sqlalchemy import Table, Column, MetaData
 from sqlalchemy import Integer, String, Boolean, DateTime, Float
 from sqlalchemy import inspect
-from sqlalchemy import func, select, column
+from sqlalchemy import func, select, column, bindparam
 from sqlalchemy import and_, or_, not_
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
 
 from obs_inv_utils import inventory_table_factory as itf
 from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+from obs_inv_utils import snapshots
+from obs_inv_utils.env_utils import get_env_number
+from obs_inv_utils.query_cache import cached_query
 
-engine = itf.engine
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+Session = itf.Session
 
+QUERY_CHUNK_ROWS_ENV = 'OBS_INV_QUERY_CHUNK_ROWS'
+DEFAULT_QUERY_CHUNK_ROWS = 50000
 
-def get_family_fs_data(obs_family):
-    insp = inspect(engine)
-    table_exists = insp.has_table(itf.OBS_INVENTORY_TABLE)
+# dtypes of the plot frames: categoricals for the strings repeated on many
+# rows, 32 bit integers for the meta ids and counts, nullable as the meta
+# columns are
+COMPACT_DTYPES = {
+    'filename': 'category',
+    'parent_dir': 'category',
+    's3_bucket': 'category',
+    'sat_id_name': 'category',
+    'variable': 'category',
+    'sat_id': 'Int32',
+    'typ': 'Int32',
+    'obs_count': 'Int32',
+    'tot': 'Int32',
+    'qm0thru3': 'Int32',
+    'obs_day': 'datetime64[ns]',
+}
 
-    if not table_exists:
-        msg = f'Table \'{itf.OBS_INVENTORY_TABLE}\' does not ' \
-              f'exist in database: \'{itf.OBS_DATABASE}\'.'
-        raise ValueError(msg)
 
+def get_generic_filenames(filenames):
+    """
+    Split the LIKE patterns in 'filenames' into the set of their generic
+    filenames (see se.get_generic_filename) and the list of patterns that
+    have none.
+    """
+    generic_filenames = set()
+    like_patterns = []
+    for filename in filenames:
+        generic_filename = se.get_generic_filename(filename)
+        if generic_filename is None:
+            like_patterns.append(filename)
+        else:
+            generic_filenames.add(generic_filename)
+
+    return generic_filenames, like_patterns
+
+
+def get_filename_filter(oi, filenames):
+    """
+    Filter matching any of the LIKE patterns in 'filenames'.  The generic
+    filenames of the patterns are looked up with an IN on the
+    generic_filename index, and only the rows found are checked against the
+    patterns, which can be narrower than their generic filename.  Rows are
+    only found once their generic_filename is set, so rows inserted before
+    the column existed need `db backfill`.  Patterns without a generic
+    filename fall back to a plain LIKE.
+    """
+    generic_filenames, like_patterns = get_generic_filenames(filenames)
+    generic_patterns = [
+        filename for filename in filenames if filename not in like_patterns]
+
+    conditions = []
+    if len(generic_filenames) > 0:
+        conditions.append(and_(
+            oi.generic_filename.in_(sorted(generic_filenames)),
+            or_(*[oi.filename.like(fn) for fn in generic_patterns])
+        ))
+    conditions.extend(oi.filename.like(fn) for fn in like_patterns)
+
+    return or_(*conditions)
+
+
+SNAPSHOT_FILES_COLUMNS = [
+    'prefix',
+    'filename',
+    'cycle_tag',
+    'cycle_time',
+    'data_type',
+    'file_size',
+    'obs_day',
+    'inserted_at',
+    'suffix',
+    'platform'
+]
+
+
+def get_filenames_regex(filenames):
+    return '|'.join(
+        snapshots.get_like_regex(filename) for filename in filenames)
+
+
+def get_snapshot_files_data(
+    snapshot_dir, filenames, columns, start=None, end=None
+):
+    """
+    Snapshot version of the obs_inventory file queries: the latest row of
+    each parent_dir and filename matching any of the LIKE patterns in
+    'filenames', with 'columns', full_path and latest_record.  Only the
+    columns needed are read, and the obs_day range, the platform and, when
+    every pattern has a generic filename, the generic filenames are filtered
+    on while reading.  Rows are matched the same way as by
+    get_filename_filter.
+    """
+    generic_filenames, like_patterns = get_generic_filenames(filenames)
+
+    conditions = [
+        snapshots.get_obs_day_filter(start, end),
+        snapshots.ds.field('platform').is_valid()
+    ]
+    if len(like_patterns) == 0:
+        conditions.append(snapshots.ds.field('generic_filename').isin(
+            sorted(generic_filenames)))
+
+    read_columns = list(dict.fromkeys(
+        columns + ['parent_dir', 'filename', 'generic_filename',
+                   'inserted_at']))
+    df = snapshots.read_snapshot(
+        snapshot_dir,
+        itf.OBS_INVENTORY_TABLE,
+        columns=read_columns,
+        filter=snapshots.combine_filters(conditions)
+    )
+
+    matched = df['generic_filename'].isin(generic_filenames) & \
+        df['filename'].str.match(get_filenames_regex(
+            filename for filename in filenames
+            if filename not in like_patterns))
+    if len(like_patterns) > 0:
+        matched |= df['filename'].str.match(get_filenames_regex(like_patterns))
+    df = df[matched]
+    df = df.sort_values('inserted_at', na_position='first').drop_duplicates(
+        subset=['parent_dir', 'filename'], keep='last')
+    df['full_path'] = df['parent_dir'] + df['filename']
+    df['latest_record'] = df['inserted_at']
+
+    return df[columns + ['full_path', 'latest_record']].reset_index(drop=True)
+
+
+def get_family_fs_data(obs_family, snapshot_dir=None):
+    """
+    Latest inventory row of each file of 'obs_family'.  With
+    'snapshot_dir' the rows are read from its Parquet snapshot, which holds
+    the rows up to its last export, instead of the database.
+    """
+    if snapshot_dir is not None:
+        print(f'Reading obs_family: {obs_family} from snapshot: '
+              f'{snapshot_dir}')
+        return get_snapshot_files_data(
+            snapshot_dir,
+            get_family_filenames(obs_family),
+            SNAPSHOT_FILES_COLUMNS
+        )
+
+    print(f'Here in sql query - obs_family: {obs_family}')
+    return query_family_fs_data(get_family_filenames(obs_family))
+
+
+# the table is checked on a cache miss, a hit does not connect
+@cached_query([itf.OBS_INVENTORY_TABLE])
+def query_family_fs_data(filenames):
+    require_obs_inventory_table()
     session = Session()
     oi = itf.ObsInventory
-    print(
-        f'Here in sql query - table_exists: {table_exists}, obs_family: {obs_family}')
-    filenames = set()
-    members = obs_family.get_members()
-    for member in members:
-        filename = member.get('prefix') + '.%.' + member.get('cycle_tag') + member.get('data_type') + member.get('suffix')
-        filenames.add(filename)
 
     fn_fs = session.query(
         oi.prefix,
@@ -57,12 +198,11 @@ def get_family_fs_data(obs_family):
     ).filter(
         and_(
             oi.platform != None,
-            or_(
-                oi.filename.like(fn) for fn in filenames
-            )
+            get_filename_filter(oi, filenames)
         )
     ).group_by(
-        'full_path'
+        oi.parent_dir,
+        oi.filename
         # ).order_by(
         #     oi.filename, oi.obs_day, oi.cycle_time, oi.inserted_at
     ).all()
@@ -71,17 +211,105 @@ def get_family_fs_data(obs_family):
     return df
 
 
-def get_filesize_timeline_data(min_instances):
+def get_family_filenames(obs_family):
+    filenames = set()
+    members = obs_family.get_members()
+    for member in members:
+        filename = member.get('prefix') + '.%.' + member.get('cycle_tag') + member.get('data_type') + member.get('suffix')
+        filenames.add(filename)
+    return filenames
 
-    insp = inspect(engine)
-    table_exists = insp.has_table(itf.OBS_INVENTORY_TABLE)
 
-    if not table_exists:
+def require_obs_inventory_table():
+    insp = inspect(itf.get_engine())
+    if not insp.has_table(itf.OBS_INVENTORY_TABLE):
         msg = f'Table \'{itf.OBS_INVENTORY_TABLE}\' does not ' \
               f'exist in database: \'{itf.OBS_DATABASE}\'.'
         raise ValueError(msg)
 
-    session = Session()
+
+def get_query_chunk_rows():
+    return get_env_number(
+        QUERY_CHUNK_ROWS_ENV, DEFAULT_QUERY_CHUNK_ROWS, int, positive=True)
+
+
+def get_frame_dtype(column_type):
+    if isinstance(column_type, Boolean):
+        return 'boolean'
+    if isinstance(column_type, Integer):
+        return 'Int64'
+    if isinstance(column_type, Float):
+        return 'float64'
+    if isinstance(column_type, DateTime):
+        return 'datetime64[ns]'
+    return 'object'
+
+
+def get_compact_dtypes(column_names):
+    return {
+        column_name: COMPACT_DTYPES[column_name]
+        for column_name in column_names if column_name in COMPACT_DTYPES
+    }
+
+
+def get_frame(rows, column_descriptions, dtypes=None):
+    """
+    DataFrame of 'rows' with dtypes from the column types of the query, or
+    from 'dtypes' by column name, so chunks of the same query have the same
+    dtypes whatever they hold.  Each column is built straight from the row
+    values, without an intermediate frame of objects.
+    """
+    names = [description['name'] for description in column_descriptions]
+    frame_dtypes = {
+        description['name']: get_frame_dtype(description['type'])
+        for description in column_descriptions
+    }
+    if dtypes is not None:
+        frame_dtypes.update(dtypes)
+
+    columns = zip(*rows) if len(rows) > 0 else [() for _ in names]
+    return DataFrame({
+        name: pandas.Series(values, dtype=frame_dtypes[name])
+        for name, values in zip(names, columns)
+    }, columns=names)
+
+
+def read_frame(statement, dtypes=None):
+    """
+    Run the select 'statement' and build its DataFrame from the fetched
+    rows with get_frame.
+    """
+    column_descriptions = [
+        {'name': selected.name, 'type': selected.type}
+        for selected in statement.selected_columns
+    ]
+    with itf.get_engine().connect() as connection:
+        rows = connection.execute(statement).fetchall()
+    return get_frame(rows, column_descriptions, dtypes)
+
+
+def iter_query_frames(query, chunk_rows=None):
+    """
+    Run 'query' with yield_per and yield its rows as DataFrames of at most
+    'chunk_rows' rows, the result is never held in memory all at once.
+    The query's session is closed when the rows run out.
+    """
+    if chunk_rows is None:
+        chunk_rows = get_query_chunk_rows()
+
+    column_descriptions = query.column_descriptions
+    try:
+        rows = iter(query.yield_per(chunk_rows))
+        while True:
+            chunk = list(islice(rows, chunk_rows))
+            if len(chunk) == 0:
+                break
+            yield get_frame(chunk, column_descriptions)
+    finally:
+        query.session.close()
+
+
+def get_filesize_timeline_query(session, min_instances):
     oi = itf.ObsInventory
 
     unique_names = session.query(
@@ -98,7 +326,7 @@ def get_filesize_timeline_data(min_instances):
 
     print(f'subquery unique_names: {unique_names}')
 
-    fn_fs = session.query(
+    query = session.query(
         oi.prefix,
         oi.filename,
         oi.cycle_tag,
@@ -132,7 +360,22 @@ def get_filesize_timeline_data(min_instances):
                 )
             )
         )
-    ).order_by(
+    )
+
+    return query, unique_names
+
+
+def get_filesize_timeline_data(min_instances):
+    return query_filesize_timeline_data(min_instances)
+
+
+@cached_query([itf.OBS_INVENTORY_TABLE])
+def query_filesize_timeline_data(min_instances):
+    require_obs_inventory_table()
+    session = Session()
+    oi = itf.ObsInventory
+    query, unique_names = get_filesize_timeline_query(session, min_instances)
+    fn_fs = query.order_by(
         unique_names.c.instances, oi.filename, oi.obs_day
     ).all()
 
@@ -141,26 +384,47 @@ def get_filesize_timeline_data(min_instances):
     return df
 
 
-def get_bufr_files_data(filenames, start, end):
+def iter_filesize_timeline_data(min_instances, chunk_rows=None):
+    """
+    Streaming get_filesize_timeline_data.  Yields DataFrame chunks ordered
+    by instances, descending, then by prefix and un, so the rows of each
+    generic filename (prefix, data type and suffix) follow each other.
+    """
+    require_obs_inventory_table()
 
-    insp = inspect(engine)
-    table_exists = insp.has_table(itf.OBS_INVENTORY_TABLE)
+    session = Session()
+    oi = itf.ObsInventory
+    query, unique_names = get_filesize_timeline_query(session, min_instances)
+    query = query.order_by(
+        unique_names.c.instances.desc(),
+        unique_names.c.un,
+        oi.prefix,
+        oi.filename,
+        oi.obs_day
+    )
+    return iter_query_frames(query, chunk_rows)
 
-    if not table_exists:
-        msg = f'Table \'{itf.OBS_INVENTORY_TABLE}\' does not ' \
-              f'exist in database: \'{itf.OBS_DATABASE}\'.'
-        raise ValueError(msg)
+
+def get_filesize_timeline_generic_count(min_instances):
+    """
+    Number of generic filenames iter_filesize_timeline_data yields rows of.
+    """
+    require_obs_inventory_table()
 
     session = Session()
-    oi = itf.ObsInventory
+    try:
+        query, unique_names = get_filesize_timeline_query(
+            session, min_instances)
+        generic_names = query.with_entities(
+            itf.ObsInventory.prefix, unique_names.c.un
+        ).distinct().subquery()
+        return session.query(func.count()).select_from(generic_names).scalar()
+    finally:
+        session.close()
 
-    print(
-        f'Here in sql query - bufr_filenames: {filenames}, {start}, {end}')
-    unique_filenames = set()
-    for filename in filenames:
-        unique_filenames.add(filename)
-    
-    fn_fs = session.query(
+
+def get_bufr_files_columns(oi):
+    return [
         oi.obs_id,
         oi.prefix,
         oi.filename,
@@ -172,24 +436,61 @@ def get_bufr_files_data(filenames, start, end):
         oi.inserted_at,
         oi.suffix,
         oi.platform,
-        oi.parent_dir.concat(oi.filename).label('full_path'),
+        oi.parent_dir.concat(oi.filename).label('full_path')
+    ]
+
+
+def get_bufr_files_query(session, filenames, start, end):
+    oi = itf.ObsInventory
+
+    print(
+        f'Here in sql query - bufr_filenames: {filenames}, {start}, {end}')
+    unique_filenames = set()
+    for filename in filenames:
+        unique_filenames.add(filename)
+
+    return session.query(
+        *get_bufr_files_columns(oi),
         func.max(oi.inserted_at).label('latest_record')
     ).select_from(
         oi
     ).filter(
         and_(
             oi.platform != None,
-            or_(
-                oi.filename.like(fn) for fn in unique_filenames
-            ),
+            get_filename_filter(oi, unique_filenames),
             oi.obs_day >= start,
             oi.obs_day <= end
         )
     ).group_by(
-        'full_path'
+        oi.parent_dir,
+        oi.filename
         # ).order_by(
         #     oi.filename, oi.obs_day, oi.cycle_time, oi.inserted_at
-    ).order_by(
+    )
+
+
+def get_bufr_files_data(filenames, start, end, snapshot_dir=None):
+    """
+    Latest inventory row of each file matching 'filenames' with an obs_day
+    from 'start' to 'end'.  With 'snapshot_dir' the rows are read from its
+    Parquet snapshot, which holds the rows up to its last export, instead
+    of the database.
+    """
+    if snapshot_dir is not None:
+        df = get_snapshot_files_data(
+            snapshot_dir, set(filenames), ['obs_id'] + SNAPSHOT_FILES_COLUMNS,
+            start, end)
+        return df.sort_values(['obs_day', 'filename']).reset_index(drop=True)
+
+    return query_bufr_files_data(filenames, start, end)
+
+
+@cached_query([itf.OBS_INVENTORY_TABLE])
+def query_bufr_files_data(filenames, start, end):
+    require_obs_inventory_table()
+    session = Session()
+    oi = itf.ObsInventory
+    fn_fs = get_bufr_files_query(session, filenames, start, end).order_by(
         oi.obs_day,
         oi.filename
     ).all()
@@ -201,3 +502,137 @@ def get_bufr_files_data(filenames, start, end):
     print(f'df: {df}')
 
     return df
+
+
+def get_bufr_files_obs_ids(filenames, start, end):
+    """
+    obs_id of the row of each file get_bufr_files_data returns, in order.
+    """
+    session = Session()
+    try:
+        files = get_bufr_files_query(session, filenames, start, end).subquery()
+        rows = session.query(files.c.obs_id).order_by(files.c.obs_id).all()
+    finally:
+        session.close()
+
+    return [row[0] for row in rows]
+
+
+def iter_bufr_files_data(filenames, start, end, chunk_rows=None):
+    """
+    Chunked get_bufr_files_data, ordered by obs_id.  The callers run sinv
+    or cmpbqm and write their results between chunks, so instead of keeping
+    a cursor open, which would block those writes on a sqlite database
+    without WAL, the obs_id of every file is read first and each chunk is a
+    separate primary key lookup of the next 'chunk_rows' of them.  The
+    grouped query runs once, and each chunk only reads its own rows.
+    """
+    require_obs_inventory_table()
+
+    if chunk_rows is None:
+        chunk_rows = get_query_chunk_rows()
+
+    oi = itf.ObsInventory
+    obs_ids = get_bufr_files_obs_ids(filenames, start, end)
+    for chunk_start in range(0, len(obs_ids), chunk_rows):
+        chunk_ids = obs_ids[chunk_start:chunk_start + chunk_rows]
+        session = Session()
+        try:
+            # inlined, as a chunk can hold more ids than sqlite accepts
+            # bound parameters
+            query = session.query(
+                *get_bufr_files_columns(oi),
+                oi.inserted_at.label('latest_record')
+            ).filter(
+                oi.obs_id.in_(bindparam(
+                    'chunk_ids', chunk_ids, expanding=True,
+                    literal_execute=True))
+            ).order_by(oi.obs_id)
+            df = get_frame(query.all(), query.column_descriptions)
+        finally:
+            session.close()
+
+        yield df
+
+
+REANALYSES_BUCKET = 'noaa-reanalyses-pds'
+# obs_inventory columns derived from parent_dir
+PARENT_DIR_COLUMNS = ['sensor', 'stream', 'source_dir']
+
+
+def get_daily_counts(
+    meta, key_columns, count_column, s3_bucket, sensors=None
+):
+    """
+    Sum of 'count_column' and number of rows of 'meta', a meta table or a
+    subquery with an obs_id column, per sensor, stream, source_dir,
+    'key_columns' and day of obs_day, for the files in 's3_bucket' and, if
+    given, of one of 'sensors'.  The grouping is done by the database, so
+    only one row per day and key is fetched.
+    """
+    oi = itf.ObsInventory.__table__
+    obs_date = func.date(meta.c.obs_day)
+    group_columns = [
+        oi.c[dir_column] for dir_column in PARENT_DIR_COLUMNS
+    ] + [meta.c[key_column] for key_column in key_columns]
+    statement = select(
+        *group_columns,
+        obs_date.label('obs_day'),
+        func.coalesce(func.sum(meta.c[count_column]), 0).label(count_column),
+        func.count().label('file_count')
+    ).select_from(
+        meta.join(oi, meta.c.obs_id == oi.c.obs_id)
+    ).where(
+        oi.c.s3_bucket == s3_bucket
+    ).group_by(
+        *group_columns, obs_date
+    )
+    if sensors:
+        statement = statement.where(oi.c.sensor.in_(sensors))
+
+    dtypes = get_compact_dtypes(key_columns + ['obs_day'])
+    dtypes[count_column] = 'int64'
+    dtypes['file_count'] = 'int64'
+    return read_frame(statement, dtypes)
+
+
+def get_bufr_daily_counts(s3_bucket=REANALYSES_BUCKET, sensors=None):
+    """
+    Per day obs_count and file count of the latest bufr meta rows, by
+    sensor, stream, source_dir, sat_id and sat_id_name.
+    """
+    return get_daily_counts(
+        itf.ObsMetaNceplibsBufrLatest.__table__,
+        ['sat_id', 'sat_id_name'],
+        'obs_count',
+        s3_bucket,
+        sensors
+    )
+
+
+def get_prepbufr_daily_counts(s3_bucket=REANALYSES_BUCKET):
+    """
+    Per day tot and file count of the latest prepbufr meta rows, by
+    sensor, stream, source_dir, typ and variable.
+    """
+    return get_daily_counts(
+        itf.ObsMetaNceplibsPrepbufrLatest.__table__,
+        ['typ', 'variable'],
+        'tot',
+        s3_bucket
+    )
+
+
+def get_prepbufr_aggregate_daily_counts(s3_bucket=REANALYSES_BUCKET):
+    """
+    Per day tot and file count of the prepbufr aggregate meta rows, by
+    sensor, stream, source_dir and variable.  Rows stored again by a later run of cmpbqm
+    on the same file are counted once.
+    """
+    agg = itf.ObsMetaNceplibsPrepbufrAggregate.__table__
+    distinct_rows = select(
+        agg.c.obs_id, agg.c.filename, agg.c.obs_day, agg.c.variable,
+        agg.c.tot, agg.c.file_size
+    ).distinct().subquery()
+
+    return get_daily_counts(distinct_rows, ['variable'], 'tot', s3_bucket)
@@ -1,3 +1,5 @@
+import os
+
 HERA_HPSS = 'hera_hpss'
 HERA_SCRATCH = 'hera_scratch' 
 AWS_S3 = 'aws_s3'
@@ -7,8 +9,42 @@ DISCOVER = 'discover'
 
 PLATFORMS = [HERA_HPSS, HERA_SCRATCH, AWS_S3, AWS_S3_CLEAN, AZURE_BLOB, DISCOVER]
 
+# maximum number of search commands in flight at once for each platform
+# when the search engine runs in concurrent mode.  Each value can be
+# overridden with an environment variable, e.g. OBS_INV_MAX_WORKERS_AWS_S3=32
+DEFAULT_CONCURRENCY_LIMIT = 1
+CONCURRENCY_LIMITS = {
+    AWS_S3: 16,
+    AWS_S3_CLEAN: 16,
+    HERA_HPSS: 2,
+    DISCOVER: 4
+}
+CONCURRENCY_LIMIT_ENV_PREFIX = 'OBS_INV_MAX_WORKERS_'
+
 def is_valid(storage_location):
     if storage_location in PLATFORMS:
         return True
 
     return False
+
+
+def get_concurrency_limit(storage_location):
+    limit = CONCURRENCY_LIMITS.get(
+        storage_location, DEFAULT_CONCURRENCY_LIMIT)
+
+    env_key = CONCURRENCY_LIMIT_ENV_PREFIX + storage_location.upper()
+    env_limit = os.getenv(env_key)
+    if env_limit is not None:
+        try:
+            limit = int(env_limit)
+        except ValueError as e:
+            msg = f'Invalid value for {env_key}: {env_limit}, must be an ' \
+                  f'integer. error: {e}'
+            raise ValueError(msg)
+
+    if limit < 1:
+        msg = f'Concurrency limit for platform {storage_location} must be ' \
+              f'at least 1, found: {limit}'
+        raise ValueError(msg)
+
+    return limit
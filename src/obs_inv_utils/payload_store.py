@@ -0,0 +1,265 @@
+# Compressed, deduplicated storage for cmd_results.raw_output.  With
+# CMD_RESULTS_PAYLOAD_STORAGE=compressed, each raw output is compressed and
+# stored once in the cmd_result_payloads table, keyed by its sha256, and
+# cmd_results.raw_output holds a short reference to it.  Payloads can later
+# be moved to zip archives outside the database; get_cmd_result_raw_output
+# and resolve_raw_output read any of the three forms transparently.
+
+import hashlib
+import os
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PAYLOAD_STORAGE_ENV = 'CMD_RESULTS_PAYLOAD_STORAGE'
+STORAGE_INLINE = 'inline'
+STORAGE_COMPRESSED = 'compressed'
+STORAGE_MODES = [STORAGE_INLINE, STORAGE_COMPRESSED]
+
+PAYLOAD_CODEC_ENV = 'CMD_RESULTS_PAYLOAD_CODEC'
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+CODECS = [CODEC_ZLIB, CODEC_ZSTD]
+
+PAYLOAD_REF_PREFIX = 'payload:sha256:'
+# outputs shorter than this are cheaper to keep inline than to reference
+MIN_PAYLOAD_SIZE = 128
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def get_storage_mode():
+    storage_mode = os.getenv(PAYLOAD_STORAGE_ENV, STORAGE_INLINE).lower()
+    if storage_mode not in STORAGE_MODES:
+        msg = f'Invalid {PAYLOAD_STORAGE_ENV}: {storage_mode}, must be one ' \
+              f'of {STORAGE_MODES}.'
+        raise ValueError(msg)
+
+    return storage_mode
+
+
+def get_codec():
+    codec = os.getenv(PAYLOAD_CODEC_ENV, CODEC_ZLIB).lower()
+    if codec not in CODECS:
+        msg = f'Invalid {PAYLOAD_CODEC_ENV}: {codec}, must be one of {CODECS}.'
+        raise ValueError(msg)
+
+    if codec == CODEC_ZSTD and zstandard is None:
+        msg = f'{PAYLOAD_CODEC_ENV}={CODEC_ZSTD} requires the zstandard ' \
+              f'package.'
+        raise ValueError(msg)
+
+    return codec
+
+
+def compress_payload(payload, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor().compress(payload)
+    return zlib.compress(payload)
+
+
+def decompress_payload(data, codec):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            msg = 'Reading zstd compressed payloads requires the zstandard ' \
+                  'package.'
+            raise ValueError(msg)
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def is_payload_ref(raw_output):
+    return isinstance(raw_output, str) and \
+        raw_output.startswith(PAYLOAD_REF_PREFIX)
+
+
+def get_payload_row(raw_output, codec):
+    payload = raw_output.encode('utf-8')
+    return {
+        'payload_hash': hashlib.sha256(payload).hexdigest(),
+        'codec': codec,
+        'payload': compress_payload(payload, codec),
+        'raw_size': len(payload),
+        'archive_path': None,
+        'created_at': datetime.utcnow()
+    }
+
+
+def store_raw_output(raw_output):
+    """
+    Return the value to write to cmd_results.raw_output and the
+    cmd_result_payloads row to store with it, or None if the output is
+    kept inline.
+    """
+    if (get_storage_mode() == STORAGE_INLINE or
+            not isinstance(raw_output, str) or
+            len(raw_output) < MIN_PAYLOAD_SIZE):
+        return raw_output, None
+
+    payload_row = get_payload_row(raw_output, get_codec())
+    return f'{PAYLOAD_REF_PREFIX}{payload_row["payload_hash"]}', payload_row
+
+
+def read_archived_payload(archive_path, payload_hash):
+    with zipfile.ZipFile(archive_path) as archive:
+        return archive.read(payload_hash)
+
+
+def resolve_raw_output(raw_output):
+    """
+    Return the original raw output for a cmd_results.raw_output value,
+    whether it is stored inline, in cmd_result_payloads or in an archive.
+    """
+    if not is_payload_ref(raw_output):
+        return raw_output
+
+    payload_hash = raw_output[len(PAYLOAD_REF_PREFIX):]
+    payload = tbl_factory.get_cmd_result_payload(payload_hash)
+    if payload is None:
+        msg = f'No cmd_result_payloads row found for: {payload_hash}'
+        raise ValueError(msg)
+
+    data = payload.payload
+    if data is None:
+        data = read_archived_payload(payload.archive_path, payload_hash)
+
+    return decompress_payload(data, payload.codec).decode('utf-8')
+
+
+def get_cmd_result_raw_output(cmd_result_id):
+    session = tbl_factory.Session()
+    cmd_result = session.query(tbl_factory.CmdResult.raw_output).filter(
+        tbl_factory.CmdResult.cmd_result_id == cmd_result_id
+    ).first()
+    session.close()
+
+    if cmd_result is None:
+        msg = f'No cmd_results row found with cmd_result_id: {cmd_result_id}'
+        raise ValueError(msg)
+
+    return resolve_raw_output(cmd_result.raw_output)
+
+
+def store_inline_raw_outputs(older_than_days=0, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move existing inline raw outputs, inserted more than 'older_than_days'
+    days ago, into cmd_result_payloads.  Returns the number of cmd_results
+    rows updated.
+    """
+    codec = get_codec()
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    cmd_result = tbl_factory.CmdResult
+
+    updated_count = 0
+    last_id = 0
+    while True:
+        session = tbl_factory.Session()
+        try:
+            rows = session.query(
+                cmd_result.cmd_result_id, cmd_result.raw_output
+            ).filter(
+                cmd_result.cmd_result_id > last_id,
+                cmd_result.inserted_at < cutoff
+            ).order_by(
+                cmd_result.cmd_result_id
+            ).limit(batch_size).all()
+
+            if len(rows) == 0:
+                break
+            last_id = rows[-1].cmd_result_id
+
+            payload_rows = {}
+            refs = []
+            for row in rows:
+                if (is_payload_ref(row.raw_output) or
+                        not isinstance(row.raw_output, str) or
+                        len(row.raw_output) < MIN_PAYLOAD_SIZE):
+                    continue
+                payload_row = get_payload_row(row.raw_output, codec)
+                payload_rows[payload_row['payload_hash']] = payload_row
+                refs.append({
+                    'cmd_result_id': row.cmd_result_id,
+                    'raw_output':
+                        f'{PAYLOAD_REF_PREFIX}{payload_row["payload_hash"]}'
+                })
+
+            if len(refs) > 0:
+                tbl_factory.insert_cmd_result_payloads(
+                    list(payload_rows.values()), session)
+                session.bulk_update_mappings(cmd_result, refs)
+                session.commit()
+                updated_count += len(refs)
+        finally:
+            session.close()
+
+        print(f'Stored {updated_count} inline raw outputs as payloads.')
+
+    return updated_count
+
+
+def write_payload_archive(archive_path, payloads):
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED) as archive:
+        for payload in payloads:
+            archive.writestr(payload.payload_hash, payload.payload)
+
+    # the archive must be on disk before the database copies are dropped
+    with open(archive_path, 'rb') as archive_file:
+        os.fsync(archive_file.fileno())
+
+
+def archive_payloads(archive_dir, older_than_days, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move payloads created more than 'older_than_days' days ago out of the
+    database into zip archives in 'archive_dir', one archive per batch.
+    The payloads are already compressed so they are stored in the archives
+    as is, and each archive is complete on disk before its payloads are
+    removed from the database.  Returns the paths of the archives written.
+    """
+    if not os.path.isdir(archive_dir):
+        msg = f'Archive directory does not exist: {archive_dir}'
+        raise ValueError(msg)
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archive_tag = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    payload_tbl = tbl_factory.CmdResultPayload
+
+    archive_paths = []
+    while True:
+        session = tbl_factory.Session()
+        try:
+            payloads = session.query(
+                payload_tbl.payload_hash, payload_tbl.payload
+            ).filter(
+                payload_tbl.payload != None,
+                payload_tbl.created_at < cutoff
+            ).limit(batch_size).all()
+
+            if len(payloads) == 0:
+                break
+
+            archive_name = f'cmd_result_payloads_{archive_tag}_' \
+                           f'{len(archive_paths):05d}.zip'
+            archive_path = os.path.abspath(
+                os.path.join(archive_dir, archive_name))
+            write_payload_archive(archive_path, payloads)
+
+            session.bulk_update_mappings(payload_tbl, [{
+                'payload_hash': payload.payload_hash,
+                'payload': None,
+                'archive_path': archive_path
+            } for payload in payloads])
+            session.commit()
+            archive_paths.append(archive_path)
+        finally:
+            session.close()
+
+        print(f'Archived {len(payloads)} payloads to {archive_path}.')
+
+    return archive_paths
@@ -35,6 +35,7 @@ EXT_OBS_MERA20CR = 'mera20cr'
 @dataclass
 class ObsGroupFilesizeTimeline(object):
     config: ObsGroupFileSizePlotConfig
+    snapshot_dir: str = None
 
     def plot_obsgroups_fs_timeline(self):
 
@@ -66,7 +67,8 @@ class ObsGroupFilesizeTimeline(object):
                     # data from our obs_inventory table.  This is based
                     # on our archive stored on AWS s3 bdp bucket
 
-                    data = oiq.get_family_fs_data(family)
+                    data = oiq.get_family_fs_data(
+                        family, snapshot_dir=self.snapshot_dir)
                     print(f'data: {data}')
                     if data is not None and data.shape[0] > 0:
                         data['generic_fn'] = data['prefix'] + \
@@ -194,112 +196,123 @@ class ObsInvFilesizeTimeline(object):
             raise ValueError(msg)
 
     def plot_timeline(self):
-        data = oiq.get_filesize_timeline_data(self.min_instances)
-
-        # due to duplicate inserts of the same file, we need to select only
-        # the most recent insert.  Mutliple inserts can occur due to
-        # multiple runs of the inventory search tool.  The most recent
-        # insert is considered the current status of that file.  After
-        # this operation, we should have a current and unique set of filenames
-        # spanning the entire date range of interest.
-        uf = data.sort_values(
-            'inserted_at'
-        ).drop_duplicates(
-            ['filename', 'obs_day'],
-            keep='last'
-        ).dropna(subset=['cycle_time'])
-
-        # create a 'cycle_time_datetime' column from the 'cycle_time' column
-        # note the 'cycle_time' column does not contain date information.
-        # this new column will now be in the datetime format but will not
-        # be set to a specific date.  So adding this new column to the
-        # 'obs_day' column will help create a new 'obs_cycle_time' column
-        # which defines a combination of the 'obs_day' and
-        # 'cycle_time_datetime'.
-        # for example: 'cycle_time_datetime' = 01/01/1970T06:00:00
-        # 'obs_day' = 01/01/2014T00:00:00 => 'obs_cycle_time' =
-        # 'obs_day' + 'cycle_time_datetime' = 01/01/2014T06:00:00
-        uf['generic_fn'] = uf['prefix'] + '.tag.' + uf['un']
-        uf['cycle_time'].replace(np.nan, 0)
-        uf['cycle_sec_float'] = uf['cycle_time'].astype('float64')
-        uf['cycle_time_datetime'] = pd.to_timedelta(
-            uf['cycle_sec_float'], unit='s')
-
-        uf['obs_day'] = pd.to_datetime(uf['obs_day'])
-        obs_times = uf[['obs_day', 'cycle_time_datetime', 'cycle_time']]
-
-        uf['obs_cycle_time'] = uf['obs_day'] + uf['cycle_time_datetime']
-
-        # This operation creates a unique list of generic filenames
-        # following the pattern 'prefix.tag.data_type.suffix' where
-        # the tag is 't00z', 't06z', 't12z', and 't18z'.  All records with
-        # the same prefix, data_type, and suffix are considered 1 generic
-        # filename.  Thus only 1 instance of any given generic filename
-        # represents all tags and obs_day records for that generic filename.
-        uf_gn = uf.copy()
-        unique_gn = uf_gn.drop_duplicates(
-            'generic_fn',
-            keep='last'
-        ).sort_values('instances', ascending=False)
-
-        count = 0
-
-        file_count = len(unique_gn.index)
-
-        last_generic_fn = ''
+        # the rows are read a chunk at a time, ordered so that all rows of
+        # a generic filename arrive together, and each generic filename is
+        # plotted as soon as its rows are complete.  Only the rows of one
+        # generic filename are held at once.
+        file_count = oiq.get_filesize_timeline_generic_count(
+            self.min_instances)
+
         plt_cnt = 0
         # iterate through all the generic filenames
         # to produce a time series (including all cycle times) of filename
         # filesizes.  A negative value indicates the file did not exist at
         # that particular obs_day/cycle_time.
-        for unique_fn in unique_gn.itertuples():
-
-            generic_fn = unique_fn.generic_fn
-            if last_generic_fn != generic_fn:
-                last_generic_fn = generic_fn
-                plt_cnt += 1
-            else:
-                continue
-            count += 1
-            file_meta = uf.loc[
-                uf['generic_fn'] == unique_fn.generic_fn
-            ]
-
-            plt.figure(figsize=(11, 8.5), dpi=160)
-            plt.subplot(111)
-
-            xy = file_meta.copy()
-
-            xy.set_index('obs_cycle_time', inplace=True)
-            max_file_size = xy['file_size'].max()
-            xy_new = xy.reindex(
-                OBS_INV_DATERANGE_6H_CYCLE,
-                fill_value=-(max_file_size*0.1)
-            )
-
-            x = xy_new.index
-            y = xy_new['file_size']
-            plt.plot(x, y/1000000, linewidth=0.3)
-
-            plt.gcf().autofmt_xdate()
-
-            figure_title = 'file: ' + generic_fn + \
-                f', {plt_cnt} of {file_count}'
-            plt.title(figure_title)
-            plt.xlabel('Observation Day')
-            plt.ylabel('File Size (Mb)')
-            y_axis = plt.gca()
-            y_axis.ticklabel_format(style='plain', axis='y')
-
-            plt.grid(color='grey', linestyle='--', linewidth=0.5)
-            dest_fn = generic_fn
-            dest_path_png = os.path.join(
-                CALLING_DIR, 'figures', dest_fn + '.png'
-            )
-            parent_dir = pathlib.Path(dest_path_png).parent
-            pathlib.Path(parent_dir).mkdir(parents=True, exist_ok=True)
-            dest_path_html = os.path.join(
-                CALLING_DIR, 'figures', dest_fn + '.html'
-            )
-            print(f'saving figure to {dest_path_png}')
-            plt.savefig(dest_path_png)
+        for generic_fn, data in iter_generic_file_frames(
+                oiq.iter_filesize_timeline_data(self.min_instances)):
+            plt_cnt += 1
+            self.plot_file_timeline(
+                get_timeline_files(data), generic_fn, plt_cnt, file_count)
+
+    def plot_file_timeline(self, file_meta, generic_fn, plt_cnt, file_count):
+        plt.figure(figsize=(11, 8.5), dpi=160)
+        plt.subplot(111)
+
+        xy = file_meta[['obs_cycle_time', 'file_size']].copy()
+
+        xy.set_index('obs_cycle_time', inplace=True)
+        max_file_size = xy['file_size'].max()
+        xy_new = xy.reindex(
+            OBS_INV_DATERANGE_6H_CYCLE,
+            fill_value=-(max_file_size*0.1)
+        )
+
+        x = xy_new.index
+        y = xy_new['file_size']
+        plt.plot(x, y/1000000, linewidth=0.3)
+
+        plt.gcf().autofmt_xdate()
+
+        figure_title = 'file: ' + generic_fn + \
+            f', {plt_cnt} of {file_count}'
+        plt.title(figure_title)
+        plt.xlabel('Observation Day')
+        plt.ylabel('File Size (Mb)')
+        y_axis = plt.gca()
+        y_axis.ticklabel_format(style='plain', axis='y')
+
+        plt.grid(color='grey', linestyle='--', linewidth=0.5)
+        dest_fn = generic_fn
+        dest_path_png = os.path.join(
+            CALLING_DIR, 'figures', dest_fn + '.png'
+        )
+        parent_dir = pathlib.Path(dest_path_png).parent
+        pathlib.Path(parent_dir).mkdir(parents=True, exist_ok=True)
+        dest_path_html = os.path.join(
+            CALLING_DIR, 'figures', dest_fn + '.html'
+        )
+        print(f'saving figure to {dest_path_png}')
+        plt.savefig(dest_path_png)
+        plt.close()
+
+
+def iter_generic_file_frames(chunks):
+    """
+    Regroup DataFrame 'chunks', in which the rows of a generic filename
+    ('prefix.tag.un') follow each other, into one (generic_fn, DataFrame)
+    per generic filename.  A generic filename cut by the end of a chunk is
+    completed with the rows of the next one.
+    """
+    pending = None
+    for chunk in chunks:
+        chunk = chunk.assign(
+            generic_fn=chunk['prefix'] + '.tag.' + chunk['un'])
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        if len(chunk.index) == 0:
+            continue
+
+        is_last = chunk['generic_fn'] == chunk['generic_fn'].iat[-1]
+        pending = chunk[is_last]
+        for generic_fn, data in chunk[~is_last].groupby(
+                'generic_fn', sort=False):
+            yield generic_fn, data
+
+    if pending is not None and len(pending.index) > 0:
+        yield pending['generic_fn'].iat[0], pending
+
+
+def get_timeline_files(data):
+    # due to duplicate inserts of the same file, we need to select only
+    # the most recent insert.  Mutliple inserts can occur due to
+    # multiple runs of the inventory search tool.  The most recent
+    # insert is considered the current status of that file.  After
+    # this operation, we should have a current and unique set of filenames
+    # spanning the entire date range of interest.
+    uf = data.sort_values(
+        'inserted_at'
+    ).drop_duplicates(
+        ['filename', 'obs_day'],
+        keep='last'
+    ).dropna(subset=['cycle_time'])
+
+    # create a 'cycle_time_datetime' column from the 'cycle_time' column
+    # note the 'cycle_time' column does not contain date information.
+    # this new column will now be in the datetime format but will not
+    # be set to a specific date.  So adding this new column to the
+    # 'obs_day' column will help create a new 'obs_cycle_time' column
+    # which defines a combination of the 'obs_day' and
+    # 'cycle_time_datetime'.
+    # for example: 'cycle_time_datetime' = 01/01/1970T06:00:00
+    # 'obs_day' = 01/01/2014T00:00:00 => 'obs_cycle_time' =
+    # 'obs_day' + 'cycle_time_datetime' = 01/01/2014T06:00:00
+    uf['cycle_sec_float'] = uf['cycle_time'].astype('float64')
+    uf['cycle_time_datetime'] = pd.to_timedelta(
+        uf['cycle_sec_float'], unit='s')
+
+    uf['obs_day'] = pd.to_datetime(uf['obs_day'])
+    uf['obs_cycle_time'] = uf['obs_day'] + uf['cycle_time_datetime']
+    # missing obs_cycle_times are filled with a negative float file size
+    uf['file_size'] = uf['file_size'].astype('float64')
+
+    return uf
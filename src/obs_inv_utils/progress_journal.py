@@ -0,0 +1,94 @@
+# Append-only progress journal for long inventory runs.  Every completed
+# unit of work (a searched cycle, a file processed by sinv or cmpbqm) is
+# appended to a local JSON lines file, so a run that is restarted after a
+# crash or preemption can skip the units that already finished.  Appends
+# are serialized with an exclusive lock so the parallel jobs started by
+# auto_inventory.py can share one journal file.
+
+import fcntl
+import json
+import os
+import threading
+from datetime import datetime
+from dataclasses import dataclass, field
+
+
+SEARCH_UNIT = 'search'
+SINV_UNIT = 'sinv'
+CMPBQM_UNIT = 'cmpbqm'
+
+
+def get_unit_key(unit):
+    return tuple(
+        value.isoformat() if isinstance(value, datetime) else str(value)
+        for value in unit
+    )
+
+
+@dataclass
+class ProgressJournal(object):
+    """
+    Set of completed units backed by an append-only file.  A unit is a
+    tuple such as (SEARCH_UNIT, platform, key, cycle_time).  A line cut
+    short by a crash is ignored when the journal is loaded, so at most the
+    units being written at the time of the crash are repeated.
+    """
+
+    path: str
+    completed: set = field(default_factory=set, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def __post_init__(self):
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        skipped_lines = 0
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                    self.completed.add(tuple(entry['unit']))
+                except (ValueError, KeyError, TypeError):
+                    skipped_lines += 1
+
+        print(f'Loaded {len(self.completed)} completed units from progress '
+              f'journal: {self.path}, skipped lines: {skipped_lines}')
+
+    def is_complete(self, unit):
+        return get_unit_key(unit) in self.completed
+
+    def mark_complete(self, units):
+        """
+        Append 'units' to the journal and flush them to disk before
+        returning.
+        """
+        unit_keys = [get_unit_key(unit) for unit in units]
+        if len(unit_keys) == 0:
+            return
+
+        completed_at = datetime.utcnow().isoformat()
+        lines = ''.join(
+            json.dumps({'unit': unit_key, 'completed_at': completed_at}) + '\n'
+            for unit_key in unit_keys
+        )
+
+        with self.lock:
+            with open(self.path, 'a+b') as journal_file:
+                fcntl.flock(journal_file, fcntl.LOCK_EX)
+                try:
+                    # start a new line if a crash cut the last one short
+                    journal_file.seek(0, os.SEEK_END)
+                    if journal_file.tell() > 0:
+                        journal_file.seek(-1, os.SEEK_END)
+                        if journal_file.read(1) != b'\n':
+                            lines = '\n' + lines
+                    journal_file.write(lines.encode('utf-8'))
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+                finally:
+                    fcntl.flock(journal_file, fcntl.LOCK_UN)
+
+            self.completed.update(unit_keys)
@@ -0,0 +1,308 @@
+# On-disk cache of the DataFrames returned by the slow obs_inv_queries
+# queries, which analysts and the plot scripts run again and again with the
+# same arguments while the inventory only changes once per inventory run.
+# An entry is keyed by the query function, its arguments, the database and
+# the freshness of the tables it reads: their max(inserted_at),
+# max(updated_at) and row count.  Once an inventory run inserts or upserts
+# rows the key changes and the query runs again.  The freshness itself is
+# checked at most once every OBS_INV_QUERY_CACHE_FRESHNESS seconds, so a
+# repeat call within that time does not touch the database at all: the
+# engine is only created to check the freshness or run the query.
+# Entries are written as Feather files when pyarrow is installed and as
+# pickles otherwise, and the least recently used ones are removed once they
+# are older than OBS_INV_QUERY_CACHE_MAX_AGE seconds or the cache grows
+# past OBS_INV_QUERY_CACHE_MAX_BYTES.  The cache is off unless
+# OBS_INV_QUERY_CACHE_DIR is set.
+
+import functools
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import date, datetime
+
+import pandas
+from pandas import DataFrame
+from sqlalchemy import func, select
+
+from obs_inv_utils import inventory_table_factory as itf
+from obs_inv_utils.env_utils import get_env_number
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+QUERY_CACHE_DIR_ENV = 'OBS_INV_QUERY_CACHE_DIR'
+QUERY_CACHE_MAX_BYTES_ENV = 'OBS_INV_QUERY_CACHE_MAX_BYTES'
+QUERY_CACHE_MAX_AGE_ENV = 'OBS_INV_QUERY_CACHE_MAX_AGE'
+QUERY_CACHE_FRESHNESS_ENV = 'OBS_INV_QUERY_CACHE_FRESHNESS'
+DEFAULT_MAX_BYTES = 1024 ** 3
+# a week
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+DEFAULT_FRESHNESS = 300
+FRESHNESS_FILENAME = 'freshness.json'
+FEATHER_SUFFIX = '.feather'
+PICKLE_SUFFIX = '.pkl'
+ENTRY_SUFFIXES = (FEATHER_SUFFIX, PICKLE_SUFFIX)
+
+
+def get_cache_dir():
+    # an empty value, as in .env_example, disables the cache like no value
+    return os.getenv(QUERY_CACHE_DIR_ENV) or None
+
+
+def get_max_bytes():
+    return get_env_number(QUERY_CACHE_MAX_BYTES_ENV, DEFAULT_MAX_BYTES, int)
+
+
+def get_max_age():
+    return get_env_number(QUERY_CACHE_MAX_AGE_ENV, DEFAULT_MAX_AGE, float)
+
+
+def get_freshness_seconds():
+    return get_env_number(QUERY_CACHE_FRESHNESS_ENV, DEFAULT_FRESHNESS, float)
+
+
+def get_key_value(value):
+    """
+    JSON friendly form of a query argument, the same for equal arguments:
+    sets are sorted and datetimes written in ISO format.
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted((get_key_value(item) for item in value), key=repr)
+    if isinstance(value, (list, tuple)):
+        return [get_key_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): get_key_value(item)
+                for key, item in sorted(value.items())}
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def get_cache_key(name, args, kwargs, database, freshness):
+    key = json.dumps([
+        name,
+        get_key_value(list(args)),
+        get_key_value(kwargs),
+        database,
+        freshness
+    ], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_freshness_columns(table):
+    columns = [func.max(table.c.inserted_at)]
+    # inserted_at does not change when a row is upserted in place
+    if 'updated_at' in table.c:
+        columns.append(func.max(table.c.updated_at))
+    return columns + [func.count()]
+
+
+def query_table_freshness(engine, table_names):
+    """
+    max(inserted_at), max(updated_at) when the table has it, and row count
+    of each table, in the order given.
+    """
+    freshness = []
+    with engine.connect() as connection:
+        for table_name in table_names:
+            table = itf.Base.metadata.tables[table_name]
+            values = connection.execute(
+                select(get_freshness_columns(table)).select_from(table)
+            ).one()
+            freshness.append([table_name] + [str(value) for value in values])
+    return freshness
+
+
+def load_freshness(cache_dir):
+    freshness_path = os.path.join(cache_dir, FRESHNESS_FILENAME)
+    try:
+        with open(freshness_path, 'r') as freshness_file:
+            return json.load(freshness_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_freshness(cache_dir, checks):
+    freshness_path = os.path.join(cache_dir, FRESHNESS_FILENAME)
+    temp_path = f'{freshness_path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w') as freshness_file:
+        json.dump(checks, freshness_file, indent=2)
+    os.replace(temp_path, freshness_path)
+
+
+def get_table_freshness(cache_dir, database, table_names):
+    """
+    Freshness of 'table_names' in 'database', queried again only when the
+    last check, by this or another process, is older than
+    OBS_INV_QUERY_CACHE_FRESHNESS seconds.
+    """
+    check_key = json.dumps([database, list(table_names)])
+    checks = load_freshness(cache_dir)
+    check = checks.get(check_key)
+    now = time.time()
+    if check is not None and \
+            now - check['checked_at'] < get_freshness_seconds():
+        return check['freshness']
+
+    freshness = query_table_freshness(itf.get_engine(), table_names)
+    checks[check_key] = {'checked_at': now, 'freshness': freshness}
+    save_freshness(cache_dir, checks)
+    return freshness
+
+
+def get_entry_paths(cache_dir):
+    return [
+        os.path.join(cache_dir, filename)
+        for filename in os.listdir(cache_dir)
+        if filename.endswith(ENTRY_SUFFIXES)
+    ]
+
+
+def find_entry(cache_dir, key):
+    for suffix in ENTRY_SUFFIXES:
+        entry_path = os.path.join(cache_dir, key + suffix)
+        if os.path.exists(entry_path):
+            return entry_path
+    return None
+
+
+def read_entry(entry_path):
+    if entry_path.endswith(FEATHER_SUFFIX):
+        df = pandas.read_feather(entry_path)
+    else:
+        df = pandas.read_pickle(entry_path)
+    # the modification time orders the entries for eviction
+    os.utime(entry_path)
+    return df
+
+
+def write_entry(cache_dir, key, df):
+    """
+    Write 'df' as Feather when pyarrow is installed and can store its
+    columns and index, as a pickle otherwise.  Returns the entry path.
+    """
+    temp_path = os.path.join(cache_dir, f'{key}.{uuid.uuid4().hex}.tmp')
+    suffix = PICKLE_SUFFIX
+    try:
+        if pyarrow is not None:
+            try:
+                df.to_feather(temp_path)
+                suffix = FEATHER_SUFFIX
+            except (ValueError, TypeError) as error:
+                print(f'query cache: pickling {key}, not stored as Feather: '
+                      f'{error}')
+        if suffix == PICKLE_SUFFIX:
+            df.to_pickle(temp_path)
+        entry_path = os.path.join(cache_dir, key + suffix)
+        os.replace(temp_path, entry_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return entry_path
+
+
+def evict(cache_dir, max_bytes=None, max_age=None):
+    """
+    Remove the entries not used for 'max_age' seconds, then the least
+    recently used ones until the cache holds at most 'max_bytes'.  Returns
+    the number of entries removed.
+    """
+    if max_bytes is None:
+        max_bytes = get_max_bytes()
+    if max_age is None:
+        max_age = get_max_age()
+
+    entries = []
+    for entry_path in get_entry_paths(cache_dir):
+        try:
+            stat = os.stat(entry_path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+    entries.sort()
+    total_bytes = sum(size for _, size, _ in entries)
+    oldest_allowed = time.time() - max_age
+    removed = 0
+    for modified, size, entry_path in entries:
+        if modified >= oldest_allowed and total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        removed += 1
+
+    return removed
+
+
+def clear_cache(cache_dir=None):
+    """
+    Remove every entry and freshness check, so the next call of each query
+    runs it.  Returns the number of entries removed.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return 0
+
+    entry_paths = get_entry_paths(cache_dir)
+    for entry_path in entry_paths:
+        os.remove(entry_path)
+    freshness_path = os.path.join(cache_dir, FRESHNESS_FILENAME)
+    if os.path.exists(freshness_path):
+        os.remove(freshness_path)
+    return len(entry_paths)
+
+
+def cached_query(table_names):
+    """
+    Cache the DataFrames returned by the decorated query, which reads
+    'table_names', in OBS_INV_QUERY_CACHE_DIR.  The query runs as before
+    when the variable is not set.
+    """
+    def decorator(query_function):
+        name = f'{query_function.__module__}.{query_function.__qualname__}'
+
+        @functools.wraps(query_function)
+        def wrapper(*args, **kwargs):
+            cache_dir = get_cache_dir()
+            if cache_dir is None:
+                return query_function(*args, **kwargs)
+
+            os.makedirs(cache_dir, exist_ok=True)
+            database = itf.get_database_name()
+            key = get_cache_key(
+                name, args, kwargs, database,
+                get_table_freshness(cache_dir, database, table_names)
+            )
+            entry_path = find_entry(cache_dir, key)
+            if entry_path is not None:
+                try:
+                    df = read_entry(entry_path)
+                    print(f'query cache: {query_function.__name__} read '
+                          f'from {entry_path}')
+                    return df
+                except FileNotFoundError:
+                    # evicted by another process since it was found
+                    pass
+
+            df = query_function(*args, **kwargs)
+            if isinstance(df, DataFrame):
+                write_entry(cache_dir, key, df)
+                evict(cache_dir)
+            return df
+
+        return wrapper
+
+    return decorator
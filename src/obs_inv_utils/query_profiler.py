@@ -0,0 +1,324 @@
+# Opt-in profiling of the statements the inventory engine runs, enabled
+# with OBS_INV_QUERY_PROFILE=1.  Every statement is timed with the
+# before/after_cursor_execute events and its latencies are collected per
+# statement text, so the same query run with different values is counted
+# together.  The run count, total and max are exact, the percentiles come
+# from a random sample of at most LATENCY_SAMPLE_SIZE runs so a long
+# inventory run does not keep every latency.  A statement slower than
+# OBS_INV_SLOW_QUERY_SECONDS is printed with the types of its bound
+# parameters, not their values, and the first time a slow SELECT is seen
+# its parameters are kept to capture its plan when the report is made:
+# EXPLAIN on MySQL, EXPLAIN QUERY PLAN on SQLite.  The plan is not captured
+# while the statement runs, as a second connection from a small pool can
+# wait for the one the statement holds.  When the process exits the
+# statements with the most total time are printed with their latency
+# percentiles, and the full report is written as JSON to
+# OBS_INV_QUERY_PROFILE_REPORT when it is set.
+
+import atexit
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+
+from obs_inv_utils.env_utils import get_env_number
+
+
+QUERY_PROFILE_ENV = 'OBS_INV_QUERY_PROFILE'
+SLOW_QUERY_SECONDS_ENV = 'OBS_INV_SLOW_QUERY_SECONDS'
+QUERY_PROFILE_REPORT_ENV = 'OBS_INV_QUERY_PROFILE_REPORT'
+QUERY_PROFILE_TOP_ENV = 'OBS_INV_QUERY_PROFILE_TOP'
+DEFAULT_SLOW_QUERY_SECONDS = 1.0
+DEFAULT_QUERY_PROFILE_TOP = 20
+PERCENTILES = [50, 95, 99]
+LATENCY_SAMPLE_SIZE = 1024
+EXPLAIN_PREFIXES = {
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+# only statements that read are explained, EXPLAIN of a write is not
+# supported everywhere
+EXPLAINABLE_PATTERN = re.compile(r'\s*(SELECT|WITH)\b', re.IGNORECASE)
+START_TIMES_KEY = 'query_profiler_start_times'
+
+
+def is_enabled():
+    value = os.getenv(QUERY_PROFILE_ENV, '')
+    return value.lower() in ['1', 'true', 'yes', 'on']
+
+
+def get_slow_query_seconds():
+    return get_env_number(
+        SLOW_QUERY_SECONDS_ENV, DEFAULT_SLOW_QUERY_SECONDS, float)
+
+
+def get_report_top():
+    return get_env_number(
+        QUERY_PROFILE_TOP_ENV, DEFAULT_QUERY_PROFILE_TOP, int)
+
+
+def get_statement_key(statement):
+    # the same statement built in different places differs in whitespace
+    return ' '.join(statement.split())
+
+
+def get_value_shape(value):
+    if isinstance(value, (list, tuple)):
+        return [get_value_shape(item) for item in value]
+    if isinstance(value, dict):
+        return {key: get_value_shape(item) for key, item in value.items()}
+    return type(value).__name__
+
+
+def get_parameter_shape(parameters, executemany):
+    """
+    Types of the bound parameters, for executemany those of the first row
+    and the number of rows.
+    """
+    if executemany:
+        if len(parameters) == 0:
+            return {'rows': 0}
+        return {'rows': len(parameters),
+                'first_row': get_value_shape(parameters[0])}
+    return get_value_shape(parameters)
+
+
+def get_percentile(sorted_values, percent):
+    """
+    Nearest rank percentile of the ascending 'sorted_values'.
+    """
+    if len(sorted_values) == 0:
+        return None
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+@dataclass
+class StatementStats(object):
+    statement: str
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = None
+    # reservoir sample of the latencies, for the percentiles
+    latencies: list = field(default_factory=list)
+    slow_count: int = 0
+    parameter_shape: object = None
+    explain_claimed: bool = False
+    explain: list = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        if self.max_seconds is None or seconds > self.max_seconds:
+            self.max_seconds = seconds
+        if len(self.latencies) < LATENCY_SAMPLE_SIZE:
+            self.latencies.append(seconds)
+            return
+
+        # every run so far is in the sample with the same probability
+        index = random.randrange(self.count)
+        if index < LATENCY_SAMPLE_SIZE:
+            self.latencies[index] = seconds
+
+    def as_dict(self):
+        latencies = sorted(self.latencies)
+        report = {
+            'statement': self.statement,
+            'count': self.count,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+            'slow_count': self.slow_count,
+        }
+        for percent in PERCENTILES:
+            report[f'p{percent}_seconds'] = get_percentile(latencies, percent)
+        report['parameter_shape'] = self.parameter_shape
+        report['explain'] = self.explain
+        return report
+
+
+@dataclass
+class QueryProfile(object):
+    statements: dict = field(default_factory=dict)
+    # (engine, statement, parameters) of the slow statements to explain
+    pending_explains: list = field(default_factory=list)
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, statement, seconds, slow, parameter_shape):
+        """
+        Add a run of 'statement'.  Returns True when it is slow and has not
+        been queued to be explained yet.
+        """
+        key = get_statement_key(statement)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = StatementStats(key)
+                self.statements[key] = stats
+            stats.add(seconds)
+            if not slow:
+                return False
+
+            stats.slow_count += 1
+            stats.parameter_shape = parameter_shape
+            if stats.explain_claimed:
+                return False
+            # claimed here so concurrent slow runs explain it once
+            stats.explain_claimed = True
+            return True
+
+    def queue_explain(self, engine, statement, parameters):
+        with self.lock:
+            self.pending_explains.append((engine, statement, parameters))
+
+    def explain_pending(self):
+        """
+        Capture the plans of the queued statements, each on a connection of
+        its own taken after the statement has given its connection back.
+        """
+        with self.lock:
+            pending_explains = self.pending_explains
+            self.pending_explains = []
+
+        for engine, statement, parameters in pending_explains:
+            explain = explain_statement(engine, statement, parameters)
+            with self.lock:
+                self.statements[get_statement_key(statement)].explain = \
+                    explain
+
+    def get_report(self):
+        self.explain_pending()
+        with self.lock:
+            report = [stats.as_dict() for stats in self.statements.values()]
+        return sorted(
+            report, key=lambda stats: stats['total_seconds'], reverse=True)
+
+
+query_profile = QueryProfile()
+_report_registered = False
+
+
+def is_explainable(engine, statement):
+    return engine.dialect.name in EXPLAIN_PREFIXES and \
+        EXPLAINABLE_PATTERN.match(statement) is not None
+
+
+def explain_statement(engine, statement, parameters):
+    """
+    Plan of 'statement' from a connection of its own.  Returns the plan
+    rows as strings, None when the database or statement can not be
+    explained.  A failure to connect or explain is returned as the plan,
+    profiling never fails the job.
+    """
+    if not is_explainable(engine, statement):
+        return None
+
+    try:
+        # a DBAPI connection runs the statement without firing the events
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                EXPLAIN_PREFIXES[engine.dialect.name] + statement, parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+    except Exception as error:
+        return [f'EXPLAIN failed: {error}']
+
+    return [' | '.join(str(value) for value in row) for row in rows]
+
+
+def watch_queries(engine):
+    """
+    Time the statements 'engine' runs in query_profile when
+    OBS_INV_QUERY_PROFILE is set.  Returns True when the engine is watched.
+    """
+    global _report_registered
+    if not is_enabled():
+        return False
+
+    slow_query_seconds = get_slow_query_seconds()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_timer(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault(START_TIMES_KEY, []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def stop_timer(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        start_times = conn.info.get(START_TIMES_KEY)
+        if not start_times:
+            return
+        seconds = time.perf_counter() - start_times.pop()
+        slow = seconds >= slow_query_seconds
+        parameter_shape = None
+        if slow:
+            parameter_shape = get_parameter_shape(parameters, executemany)
+            print(f'slow query ({seconds:.3f} s): '
+                  f'{get_statement_key(statement)} '
+                  f'parameters: {parameter_shape}')
+
+        if query_profile.record(statement, seconds, slow, parameter_shape) \
+                and is_explainable(engine, statement):
+            if executemany:
+                parameters = parameters[0] if len(parameters) > 0 else ()
+            query_profile.queue_explain(engine, statement, parameters)
+
+    @event.listens_for(engine, 'handle_error')
+    def drop_timer(exception_context):
+        # a failed statement never reaches after_cursor_execute
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(START_TIMES_KEY):
+            conn.info[START_TIMES_KEY].pop()
+
+    print(f'query profiling on, slow queries: {slow_query_seconds} s')
+    if not _report_registered:
+        atexit.register(report_queries)
+        _report_registered = True
+    return True
+
+
+def get_query_report():
+    return query_profile.get_report()
+
+
+def write_query_report(report_path, report=None):
+    if report is None:
+        report = get_query_report()
+    temp_path = f'{report_path}.tmp'
+    with open(temp_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, default=str)
+    os.replace(temp_path, report_path)
+
+
+def report_queries():
+    report = get_query_report()
+    if len(report) == 0:
+        return
+
+    print(f'query profile: {len(report)} statements, by total time')
+    for stats in report[:get_report_top()]:
+        percentiles = ', '.join(
+            f'p{percent} {1000 * stats[f"p{percent}_seconds"]:.1f} ms'
+            for percent in PERCENTILES)
+        print(f'{stats["count"]:8d} runs, total {stats["total_seconds"]:9.3f}'
+              f' s, {percentiles}, slow: {stats["slow_count"]}: '
+              f'{stats["statement"][:200]}')
+        for line in stats['explain'] or []:
+            print(f'    {line}')
+
+    report_path = os.getenv(QUERY_PROFILE_REPORT_ENV)
+    if report_path:
+        write_query_report(report_path, report)
+        print(f'query profile written to {report_path}')
@@ -1,11 +1,17 @@
 from collections import namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
 import json
 import os
 import pathlib
-from datetime import datetime
+import re
+import threading
+from datetime import datetime, timedelta
 from obs_inv_utils import hpss_io_interface as hpss
 from obs_inv_utils import obs_storage_platforms as platforms
 from config_handlers.obs_search_conf import ObservationsConfig, ObsSearchConfig
+from config_handlers.obs_search_conf import SEARCH_PATH_KEY
 from obs_inv_utils import aws_s3_interface as s3
 from obs_inv_utils import time_utils
 from obs_inv_utils.time_utils import DateRange
@@ -15,6 +21,8 @@ from obs_inv_utils.aws_s3_interface import AwsS3CommandRawResponse
 from typing import Optional
 from dataclasses import dataclass, field
 from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils.ingest_buffer import IngestBuffer
+from obs_inv_utils.progress_journal import ProgressJournal, SEARCH_UNIT
 from obs_inv_utils import discover_interface as discover
 from obs_inv_utils.discover_interface import DiscoverCommandRawResponse
 import hashlib
@@ -126,6 +134,22 @@ OBS_FORMATS = [
 
 ADDITIONAL_GRIB2_FORMAT_EXTENSIONS = ['1536', '576']
 
+# stands in for the date and cycle parts of a filename in its generic form
+GENERIC_CYCLE_PART = '*'
+# date and cycle parts of filenames, e.g. 20200101, t00z, 2020010100
+CYCLE_PART_PATTERN = re.compile(
+    r'\d{6,10}(_?t?\d{2}z?)?|t?\d{1,2}z', re.IGNORECASE)
+# the same parts in the LIKE patterns used by the configs, e.g. %z, t%z
+CYCLE_WILDCARD_PART_PATTERN = re.compile(r't?\d*%\d*z?', re.IGNORECASE)
+
+# parent_dir layout of the reanalysis bucket, e.g.
+# observations/reanalysis/amv/nesdis/2020/01/bufr/: the sensor and stream
+# directories, then the year and month
+REANALYSIS_DIR = 'observations/reanalysis'
+SENSOR_DIR_PART = 2
+STREAM_DIR_PART = 3
+YEAR_MONTH_DIR_PATTERN = re.compile(r'/[12][90][0-9][0-9]/[01][0-9]/')
+
 
 def get_cycle_tag(parts):
     if not isinstance(parts, list) or len(parts) < 2:
@@ -251,10 +275,79 @@ def parse_filename_discover(filename):
 
     return filename_meta
 
-def process_aws_s3_list_objects_v2_resp(cmd_result_id, contents):
-    if not isinstance(contents, s3.AwsS3ObjectsListContents):
+def get_generic_filename(filename):
+    """
+    Return 'filename' with each run of date and cycle parts replaced by
+    GENERIC_CYCLE_PART, so all cycles of a file share one key.  For example
+    gdas.20200101.t00z.airsev.tm00.bufr_d, gdas.t06z.airsev.tm00.bufr_d and
+    the config pattern gdas.%z.airsev.tm00.bufr_d all become
+    gdas.*.airsev.tm00.bufr_d.  Returns None for patterns with wildcards
+    outside of the date and cycle parts.
+    """
+    if not isinstance(filename, str):
+        return None
+
+    generic_parts = []
+    for part in filename.split('.'):
+        if '%' in part:
+            if CYCLE_WILDCARD_PART_PATTERN.fullmatch(part) is None:
+                return None
+            is_cycle_part = True
+        else:
+            is_cycle_part = CYCLE_PART_PATTERN.fullmatch(part) is not None
+
+        if not is_cycle_part:
+            generic_parts.append(part)
+        elif len(generic_parts) == 0 or \
+                generic_parts[-1] != GENERIC_CYCLE_PART:
+            generic_parts.append(GENERIC_CYCLE_PART)
+
+    return '.'.join(generic_parts)
+
+
+def get_dir_part(parent_dir, index):
+    if not isinstance(parent_dir, str):
+        return None
+
+    parts = parent_dir.split('/')
+    if len(parts) <= index or parts[index] == '':
+        return None
+    return parts[index]
+
+
+def get_sensor(parent_dir):
+    """
+    Sensor directory of 'parent_dir', amv for
+    observations/reanalysis/amv/nesdis/2020/01/bufr/.
+    """
+    return get_dir_part(parent_dir, SENSOR_DIR_PART)
+
+
+def get_stream(parent_dir):
+    """
+    Directory under the sensor, nesdis for
+    observations/reanalysis/amv/nesdis/2020/01/bufr/.
+    """
+    return get_dir_part(parent_dir, STREAM_DIR_PART)
+
+
+def get_source_dir(parent_dir):
+    """
+    'parent_dir' up to its year and month directories, without the
+    reanalysis directory: /amv/nesdis for
+    observations/reanalysis/amv/nesdis/2020/01/bufr/.
+    """
+    if not isinstance(parent_dir, str):
         return None
 
+    directory = parent_dir.replace(REANALYSIS_DIR, '')
+    return YEAR_MONTH_DIR_PATTERN.split(directory)[0]
+
+
+def get_aws_s3_list_objects_v2_files_meta(cmd_result_id, contents):
+    if not isinstance(contents, s3.AwsS3ObjectsListContents):
+        return []
+
     listed_objects = contents.listed_objects
 
     files_meta = []
@@ -290,12 +383,19 @@ def process_aws_s3_list_objects_v2_resp(cmd_result_id, contents):
         )
         files_meta.append(file_meta)
 
+    return files_meta
+
+
+def process_aws_s3_list_objects_v2_resp(cmd_result_id, contents):
+    files_meta = get_aws_s3_list_objects_v2_files_meta(
+        cmd_result_id, contents)
     if len(files_meta) > 0:
         tbl_factory.insert_obs_inv_items(files_meta)
 
-def process_aws_s3_clean_resp(cmd_result_id, contents):
+
+def get_aws_s3_clean_files_meta(cmd_result_id, contents):
     if not isinstance(contents, s3.AwsS3ObjectsListContents):
-        return None
+        return []
 
     listed_objects = contents.listed_objects
 
@@ -332,12 +432,18 @@ def process_aws_s3_clean_resp(cmd_result_id, contents):
             listed_object.etag
     ))
 
+    return files_meta
+
+
+def process_aws_s3_clean_resp(cmd_result_id, contents):
+    files_meta = get_aws_s3_clean_files_meta(cmd_result_id, contents)
     if len(files_meta) > 0:
         tbl_factory.insert_obs_inv_items(files_meta)
 
-def process_inspect_tarball_resp(cmd_result_id, contents):
+
+def get_inspect_tarball_files_meta(cmd_result_id, contents):
     if not isinstance(contents, hpss.HpssTarballContents):
-        return None
+        return []
 
     inspected_files = contents.inspected_files
 
@@ -374,13 +480,19 @@ def process_inspect_tarball_resp(cmd_result_id, contents):
         )
         tarball_files_meta.append(tarball_file_meta)
 
-    tbl_factory.insert_obs_inv_items(tarball_files_meta)
+    return tarball_files_meta
 
 
-def process_discover_resp(cmd_result_id, contents):
+def process_inspect_tarball_resp(cmd_result_id, contents):
+    files_meta = get_inspect_tarball_files_meta(cmd_result_id, contents)
+    if len(files_meta) > 0:
+        tbl_factory.insert_obs_inv_items(files_meta)
+
+
+def get_discover_files_meta(cmd_result_id, contents):
     if not isinstance(contents, discover.DiscoverListContents):
         print('Not instance type discover.DiscoverListContents')
-        return None
+        return []
     
     listed_files_meta = contents.files_meta
     listed_files_meta = listed_files_meta[0]
@@ -418,6 +530,11 @@ def process_discover_resp(cmd_result_id, contents):
             etag
     ))
     print(f'files_meta: {files_meta}')
+    return files_meta
+
+
+def process_discover_resp(cmd_result_id, contents):
+    files_meta = get_discover_files_meta(cmd_result_id, contents)
     if len(files_meta) > 0:
         tbl_factory.insert_obs_inv_items(files_meta)
 
@@ -427,7 +544,7 @@ def default_datetime_converter(obj):
       return obj.__str__()
 
 
-def post_aws_s3_cmd_result(raw_response, obs_cycle_time):
+def get_aws_s3_cmd_result_data(raw_response, obs_cycle_time):
     if not isinstance(raw_response, AwsS3CommandRawResponse):
         msg = 'raw_response must be of type AwsS3CommandRawResponse. It is'\
               f' actually of type: {type(raw_response)}'
@@ -447,11 +564,16 @@ def post_aws_s3_cmd_result(raw_response, obs_cycle_time):
         datetime.utcnow()
     )
 
+    return cmd_result_data
+
+
+def post_aws_s3_cmd_result(raw_response, obs_cycle_time):
+    cmd_result_data = get_aws_s3_cmd_result_data(raw_response, obs_cycle_time)
     cmd_result_id = tbl_factory.insert_cmd_result(cmd_result_data)
     return cmd_result_id
 
 
-def post_hpss_cmd_result(raw_response, obs_day):
+def get_hpss_cmd_result_data(raw_response, obs_day):
     if not isinstance(raw_response, HpssCommandRawResponse):
         msg = 'raw_response must be of type HpssCommandRawResponse. It is'\
               f' actually of type: {type(raw_response)}'
@@ -470,13 +592,18 @@ def post_hpss_cmd_result(raw_response, obs_day):
     )
 
     print(f'HPSS cmd_result: {cmd_result_data}')
+    return cmd_result_data
+
+
+def post_hpss_cmd_result(raw_response, obs_day):
+    cmd_result_data = get_hpss_cmd_result_data(raw_response, obs_day)
     cmd_result_id = tbl_factory.insert_cmd_result(cmd_result_data)
 
     return cmd_result_id
 
 
-# post_discover_cmd_result adapted from post_hpss_cmd_result
-def post_discover_cmd_result(raw_response, obs_day):
+# get_discover_cmd_result_data adapted from get_hpss_cmd_result_data
+def get_discover_cmd_result_data(raw_response, obs_day):
     if not isinstance(raw_response, DiscoverCommandRawResponse):
         msg = 'raw_response must be of type DiscoverCommandRawResponse. It is'\
               f' actually of type: {type(raw_response)}'
@@ -495,22 +622,432 @@ def post_discover_cmd_result(raw_response, obs_day):
     )
 
     print(f'Discover cmd_result: {cmd_result_data}')
+    return cmd_result_data
+
+
+def post_discover_cmd_result(raw_response, obs_day):
+    cmd_result_data = get_discover_cmd_result_data(raw_response, obs_day)
     cmd_result_id = tbl_factory.insert_cmd_result(cmd_result_data)
 
     return cmd_result_id
 
 
+def post_search_result(cmd_result_data, files_meta, ingest=None):
+    """
+    Store a search command result and the files it found.  With an
+    ingest_buffer.IngestBuffer the result is queued for the buffer's writer
+    thread and None is returned, otherwise it is written right away and
+    the new cmd_result_id is returned.
+    """
+    if ingest is not None:
+        ingest.add(cmd_result_data, files_meta)
+        return None
+
+    cmd_result_id = tbl_factory.insert_cmd_result(cmd_result_data)
+    print(f'cmd_result_id: {cmd_result_id}')
+    if len(files_meta) > 0:
+        tbl_factory.insert_obs_inv_items([
+            file_meta._replace(cmd_result_id=cmd_result_id)
+            for file_meta in files_meta
+        ])
+
+    return cmd_result_id
+
+
+def is_failed_search(raw_resp):
+    """
+    True when a search command failed.  An aws s3 listing answered with
+    HTTP 200 but no objects searched a cycle with no files, it did not
+    fail.
+    """
+    if raw_resp.success:
+        return False
+    if isinstance(raw_resp, AwsS3CommandRawResponse) and \
+            isinstance(raw_resp.output, dict):
+        resp_meta = raw_resp.output.get('ResponseMetadata') or {}
+        return resp_meta.get('HTTPStatusCode') != 200
+    return True
+
+
+def search_aws_s3_prefix(
+    args, obs_cycle_time, ingest=None, failed_cycles=None
+):
+    """
+    List an aws s3 prefix one page at a time.  Every page is posted as its
+    own command result and its objects are stored before the next page is
+    requested, so prefixes with more than 1000 keys are inventoried
+    completely without holding the whole listing in memory.  If a page
+    fails, 'obs_cycle_time' is appended to 'failed_cycles' when it is
+    given.  Returns the cmd_result_id of the last page posted.
+    """
+    cmd = s3.AwsS3CommandHandler(s3.CMD_GET_S3_OBJ_LIST_PAGES, args)
+    print(f'cmd: {cmd}')
+
+    cmd_result_id = None
+    failed = False
+    for success in cmd.send_pages():
+        raw_resp = cmd.get_raw_response()
+        cmd_result_data = get_aws_s3_cmd_result_data(raw_resp, obs_cycle_time)
+
+        files_meta = []
+        try:
+            if success:
+                contents = cmd.parse_response(obs_cycle_time)
+                files_meta = get_aws_s3_list_objects_v2_files_meta(
+                    None, contents)
+            else:
+                msg = f'Command failed - error code: {raw_resp}.'
+                print(msg)
+                failed = failed or is_failed_search(raw_resp)
+        finally:
+            # the command result is stored even if its output can not be
+            # parsed
+            print('posting command results for aws s3')
+            cmd_result_id = post_search_result(
+                cmd_result_data, files_meta, ingest)
+
+    if failed and failed_cycles is not None:
+        failed_cycles.append(obs_cycle_time)
+    return cmd_result_id
+
+
+def get_listing_prefix(search_path):
+    return os.path.dirname(search_path) + '/'
+
+
+def search_aws_s3_clean_prefix(
+    prefix,
+    cycle_keys,
+    start_after=None,
+    ingest=None,
+    failed_cycles=None
+):
+    """
+    List a clean bucket directory prefix once and match the listed keys to
+    the expected key of each cycle in 'cycle_keys', a list of
+    (cycle_time, key) tuples.  Every cycle is posted as its own command
+    result, just as if its key had been listed on its own, so cycles
+    missing from the bucket are still recorded with a 404 return code.
+    If 'start_after' is given, only keys sorting after it are listed.
+    When a page of the listing fails, the cycles not found are appended
+    to 'failed_cycles' if it is given, as they may be on that page.
+    Returns the cmd_result_id of the last cycle posted.
+    """
+    args = [prefix]
+    if start_after is not None:
+        args.append(start_after)
+    cmd = s3.AwsS3CommandHandler(s3.CMD_GET_S3_OBJ_LIST_PAGES, args)
+    print(f'cmd: {cmd}')
+
+    listed_keys = {}
+    listing_failed = False
+    for success in cmd.send_pages():
+        raw_resp = cmd.get_raw_response()
+        if not success:
+            print(f'No objects found in page, response: {raw_resp}.')
+            listing_failed = listing_failed or is_failed_search(raw_resp)
+            continue
+        contents = cmd.parse_response(None)
+        for listed_object in contents.listed_objects:
+            key = f'{prefix}{listed_object.name}'
+            listed_keys[key] = (listed_object, raw_resp)
+
+    print(f'prefix: {prefix}, listed keys: {len(listed_keys)}, '
+          f'expected cycles: {len(cycle_keys)}')
+
+    cmd_result_id = None
+    for cycle_time, key in cycle_keys:
+        listed_object, page_resp = listed_keys.get(key, (None, raw_resp))
+        found = listed_object is not None
+
+        output = {}
+        if found:
+            output['Contents'] = [
+                content for content in page_resp.output.get('Contents')
+                if content.get('Key') == key
+            ]
+        cycle_resp = AwsS3CommandRawResponse(
+            page_resp.command,
+            200 if found else 404,
+            output,
+            found,
+            key,
+            page_resp.submitted_at,
+            page_resp.latency
+        )
+
+        cmd_result_data = get_aws_s3_cmd_result_data(cycle_resp, cycle_time)
+
+        files_meta = []
+        if found:
+            contents = s3.AwsS3ObjectsListContents(
+                key,
+                1,
+                [listed_object],
+                cycle_time,
+                page_resp.submitted_at,
+                page_resp.latency
+            )
+            files_meta = get_aws_s3_clean_files_meta(None, contents)
+        else:
+            print(f'Key not found in prefix listing: {key}.')
+            if listing_failed and failed_cycles is not None:
+                failed_cycles.append(cycle_time)
+
+        cmd_result_id = post_search_result(
+            cmd_result_data, files_meta, ingest)
+
+    return cmd_result_id
+
+
+def get_cycle_increment(platform):
+    """
+    HPSS tarballs hold a full day of observations, every other platform
+    is searched one 6 hour cycle at a time.
+    """
+    if platform == platforms.HERA_HPSS:
+        return {'days': 1, 'hours': 0}
+
+    return {'days': 0, 'hours': 6}
+
+
+def get_search_cycle_times(date_range, increment):
+    """
+    Return every cycle time the sequential search would visit, starting
+    at the current position of 'date_range' and stopping before its end.
+    The passed in 'date_range' is not modified.
+    """
+    cycle_range = DateRange(date_range.start, date_range.end)
+    cycle_range.set_current(date_range.current)
+
+    cycle_times = []
+    while not cycle_range.at_end():
+        cycle_times.append(cycle_range.current)
+        cycle_range.increment(**increment)
+
+    return cycle_times
+
+
+def get_resume_cycle_time(date_range, last_cycle, increment, lookback_hours=0):
+    """
+    Return the cycle an incremental search should start at: the cycle
+    after 'last_cycle', moved back by 'lookback_hours' so late arriving
+    files are picked up, rounded down onto the date range's cycle grid and
+    clamped to the date range.
+    """
+    step = timedelta(**increment)
+    resume_at = last_cycle + step - timedelta(hours=lookback_hours)
+
+    if resume_at <= date_range.start:
+        return date_range.start
+    if resume_at >= date_range.end:
+        return date_range.end
+
+    steps = (resume_at - date_range.start) // step
+    return date_range.start + steps * step
+
+
+def get_prefix_cycle_times(search_config, increment):
+    """
+    Return the cycle times, starting at the current position of the search
+    config's date range, whose keys share the listing prefix of the current
+    cycle's key.  The search config's date range is not modified.
+    """
+    date_range = search_config.get_date_range()
+    cycle_range = DateRange(date_range.start, date_range.end)
+    cycle_range.set_current(date_range.current)
+
+    prefix = get_listing_prefix(
+        search_config.get_search_path(cycle_range.current))
+    cycle_times = []
+    while not cycle_range.at_end():
+        search_path = search_config.get_search_path(cycle_range.current)
+        if get_listing_prefix(search_path) != prefix:
+            break
+        cycle_times.append(cycle_range.current)
+        cycle_range.increment(**increment)
+
+    return cycle_times
+
+
+def get_start_after_key(search_config, cycle_keys):
+    """
+    Return the key of the cycle before the first of 'cycle_keys' if it
+    shares their listing prefix and sorts before all of them, so a prefix
+    listing can skip the keys of cycles that were already searched.
+    Returns None when the listing has to start at the top of the prefix.
+    """
+    first_cycle, first_key = cycle_keys[0]
+    increment = get_cycle_increment(search_config.get_storage_platform())
+    previous_key = search_config.get_search_path(
+        first_cycle - timedelta(**increment))
+
+    if get_listing_prefix(previous_key) != get_listing_prefix(first_key):
+        return None
+
+    if previous_key >= min(key for cycle_time, key in cycle_keys):
+        return None
+
+    return previous_key
+
+
+def group_cycles_by_prefix(search_config, cycle_times):
+    """
+    Split 'cycle_times' into lists of consecutive cycles whose keys share
+    a listing prefix.
+    """
+    groups = []
+    prefix = None
+    for cycle_time in cycle_times:
+        cycle_prefix = get_listing_prefix(
+            search_config.get_search_path(cycle_time))
+        if cycle_prefix != prefix:
+            groups.append([])
+            prefix = cycle_prefix
+        groups[-1].append(cycle_time)
+
+    return groups
+
+
 @dataclass
 class ObsInventorySearchEngine(object):
     obs_inv_conf: ObservationsConfig
     search_configs: list[ObsSearchConfig] = field(default_factory=list)
     cmd_post_id: int = field(default_factory=int, init=False)
+    concurrent: bool = False
+    incremental: bool = False
+    lookback_hours: int = 0
+    buffered: bool = False
+    watermarks: dict = field(default_factory=dict, init=False)
+    # cycles whose search command failed, by search config watermark key
+    failed_cycles: dict = field(default_factory=dict, init=False)
+    failed_cycles_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False,
+        compare=False)
+    ingest: IngestBuffer = field(default=None, init=False)
+    journal: ProgressJournal = None
 
     def __post_init__(self):
         self.search_configs = self.obs_inv_conf.get_obs_inv_search_configs()
+        if self.lookback_hours < 0:
+            msg = f'lookback_hours must not be negative, actually: ' \
+                  f'{self.lookback_hours}'
+            raise ValueError(msg)
+        if self.incremental:
+            tbl_factory.require_unsharded('Incremental search')
 
     def get_obs_file_info(self):
+        if self.incremental:
+            self.apply_watermarks()
+
+        search_cycles = {}
+        for key, search_config in self.search_configs.items():
+            cycle_times = get_search_cycle_times(
+                search_config.get_date_range(),
+                get_cycle_increment(search_config.get_storage_platform())
+            )
+            if len(cycle_times) > 0:
+                search_cycles[key] = cycle_times
+
+        if self.buffered:
+            self.ingest = IngestBuffer()
+        try:
+            # the buffer is drained even if the search failed, so
+            # everything found before the failure is stored
+            with self.ingest or nullcontext():
+                if self.concurrent:
+                    self.get_obs_file_info_concurrent()
+                else:
+                    self.get_obs_file_info_serial()
+        finally:
+            self.ingest = None
+
+        if self.incremental:
+            self.update_watermarks(search_cycles)
+
+    def apply_watermarks(self):
+        """
+        Move each search config's date range forward to its stored
+        watermark, less the look-back window, so only the recent tail of
+        each stream is searched.
+        """
+        for key, search_config in self.search_configs.items():
+            platform = search_config.get_storage_platform()
+            search_key = search_config.search_config.get(SEARCH_PATH_KEY)
+            last_cycle = tbl_factory.get_inventory_watermark(
+                platform, search_key)
+            self.watermarks[key] = last_cycle
+            if last_cycle is None:
+                print(f'No watermark found for {key}, searching full range.')
+                continue
+
+            date_range = search_config.get_date_range()
+            resume_at = get_resume_cycle_time(
+                date_range,
+                last_cycle,
+                get_cycle_increment(platform),
+                self.lookback_hours
+            )
+            print(f'Watermark for {key}: {last_cycle}, resuming at: '
+                  f'{resume_at}')
+            date_range.set_current(resume_at)
+
+    def get_watermark_key(self, search_config):
+        return (
+            search_config.get_storage_platform(),
+            search_config.search_config.get(SEARCH_PATH_KEY)
+        )
 
+    def record_failed_cycles(self, search_config, cycle_times):
+        if len(cycle_times) == 0:
+            return
+        search_path = search_config.get_search_path(cycle_times[0])
+        print(f'Search failed, path: {search_path}, failed cycles: '
+              f'{len(cycle_times)}')
+        with self.failed_cycles_lock:
+            self.failed_cycles.setdefault(
+                self.get_watermark_key(search_config), set()
+            ).update(cycle_times)
+
+    def is_failed_cycle(self, search_config, cycle_time):
+        with self.failed_cycles_lock:
+            return cycle_time in self.failed_cycles.get(
+                self.get_watermark_key(search_config), ())
+
+    def update_watermarks(self, search_cycles):
+        """
+        Store the last cycle searched for each search config, before its
+        first failed cycle so the next incremental run searches the failed
+        cycles again.  Watermarks only move forward, so searching an older
+        date range does not cause the next incremental run to search the
+        newer cycles again.
+        """
+        for key, cycle_times in search_cycles.items():
+            search_config = self.search_configs[key]
+            failed = self.failed_cycles.get(
+                self.get_watermark_key(search_config))
+            if failed:
+                first_failed = min(failed)
+                cycle_times = [
+                    cycle_time for cycle_time in cycle_times
+                    if cycle_time < first_failed
+                ]
+                print(f'Watermark for {key} held before its first failed '
+                      f'cycle: {first_failed}')
+            if len(cycle_times) == 0:
+                continue
+
+            last_cycle = cycle_times[-1]
+            previous = self.watermarks.get(key)
+            if previous is not None and previous >= last_cycle:
+                continue
+
+            tbl_factory.upsert_inventory_watermark(
+                *self.get_watermark_key(search_config),
+                last_cycle
+            )
+
+    def get_obs_file_info_serial(self):
         date_range = self.obs_inv_conf.get_search_date_range()
         master_list = []
         print(f'search config date range: {date_range}')
@@ -532,82 +1069,252 @@ class ObsInventorySearchEngine(object):
                     print(f'Finished search, path: {search_path}, end: {end}')
                     continue
 
-                args = [search_path]
-                print(f'args: {args}, search_path: {search_path}')
                 platform = search_config.get_storage_platform()
-                n_hours = 6
-                n_days = 0
-                if platform == platforms.AWS_S3 or platform == platforms.AWS_S3_CLEAN:
-                    cmd = s3.AwsS3CommandHandler(s3.CMD_GET_S3_OBJ_LIST, args)
-                elif platform == platforms.HERA_HPSS:
-                    cmd = hpss.HpssCommandHandler(
-                        hpss.CMD_INSPECT_TARBALL, args)
-                    n_hours = 0
-                    n_days = 1
-                elif platform == platforms.DISCOVER:
-                    cmd = discover.DiscoverCommandHandler(
-                        discover.CMD_GET_DISCOVER_OBJ_LIST, args)
-
-                print(f'cmd: {cmd}, finished_count: {finished_count}')
-
-                success = cmd.send()
-
-                raw_resp = cmd.get_raw_response()
-
-                if platform == platforms.AWS_S3 or platform == platforms.AWS_S3_CLEAN:
-                    print('posting command results for aws s3')
-                    self.cmd_post_id = post_aws_s3_cmd_result(
-                        raw_resp,
-                        search_config.get_date_range().current
-                    )
-                elif platform == platforms.HERA_HPSS:
-                    self.cmd_post_id = post_hpss_cmd_result(
-                        raw_resp,
-                        search_config.get_date_range().current
-                    )
-                elif platform == platforms.DISCOVER:
-                    print('posting command results for discover')
-                    self.cmd_post_id = post_discover_cmd_result(
-                        raw_resp,
-                        search_config.get_date_range().current
-                    )   
-
-
-                print(f'self.cmd_post_id: {self.cmd_post_id}')
-
-                if success:
-                    current_time = search_config.get_date_range().current
-                    print(f'current_time: {current_time}')
-                    contents = cmd.parse_response(current_time)
-
-                    if platform == platforms.AWS_S3:
-                        file_meta = process_aws_s3_list_objects_v2_resp(
-                            self.cmd_post_id,
-                            contents
-                        )
-                    elif platform == platforms.AWS_S3_CLEAN:
-                        file_meta = process_aws_s3_clean_resp(
-                            self.cmd_post_id,
-                            contents
-                        )
-                    elif platform == platforms.HERA_HPSS:
-                        file_meta = process_inspect_tarball_resp(
-                            self.cmd_post_id,
-                            contents
-                        )
-                    elif platform == platforms.DISCOVER:
-                        file_meta = process_discover_resp(
-                            self.cmd_post_id,
-                            contents
-                        )
+                increment = get_cycle_increment(platform)
+                if search_config.uses_prefix_listing():
+                    cycle_times = get_prefix_cycle_times(
+                        search_config, increment)
                 else:
-                    msg = f'Command failed!!!!!!!!!!!!!!!!!!!!!!!!!!!!! - error code: {cmd.get_raw_response}.'
-                    print(msg)
-
-                raw_resp = cmd.get_raw_response()
+                    cycle_times = [search_config.get_date_range().current]
+
+                remaining_cycles = self.get_remaining_cycles(
+                    search_config, cycle_times)
+                if len(remaining_cycles) == 0:
+                    print(f'Skipping completed cycles, path: {search_path}')
+                elif search_config.uses_prefix_listing():
+                    self.cmd_post_id = self.search_prefix(
+                        search_config, remaining_cycles)
+                else:
+                    self.cmd_post_id = self.search_cycle(
+                        search_config, remaining_cycles[0])
 
-                search_config.get_date_range().increment(days=n_days, hours=n_hours)
+                for cycle_time in cycle_times:
+                    search_config.get_date_range().increment(**increment)
                 print(f'Current search path: {search_path}')
 
             if finished_count == len(self.search_configs):
                 all_search_paths_finished = True
+
+    def get_obs_file_info_concurrent(self):
+        """
+        Dispatch every (search config, cycle) pair to a bounded thread pool.
+        Each storage platform gets its own pool sized by
+        obs_storage_platforms.get_concurrency_limit so that, for example,
+        HPSS is never hit with as many simultaneous requests as S3.
+        Cycles from different search configs are interleaved so all of the
+        configs progress together.  Search configs using prefix listing are
+        dispatched one listing prefix at a time instead of one cycle at a
+        time.
+        """
+        date_range = self.obs_inv_conf.get_search_date_range()
+        print(f'search config date range: {date_range}, concurrent: True')
+
+        executors = {}
+        pending_cycles = []
+        for key, search_config in self.search_configs.items():
+            platform = search_config.get_storage_platform()
+            if platform not in executors:
+                max_workers = platforms.get_concurrency_limit(platform)
+                print(f'platform: {platform}, max_workers: {max_workers}')
+                executors[platform] = ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix=platform
+                )
+
+            cycle_times = self.get_remaining_cycles(
+                search_config,
+                get_search_cycle_times(
+                    search_config.get_date_range(),
+                    get_cycle_increment(platform)
+                )
+            )
+            if search_config.uses_prefix_listing():
+                pending_cycles.append([
+                    (self.search_prefix, search_config, cycle_group)
+                    for cycle_group in group_cycles_by_prefix(
+                        search_config, cycle_times)
+                ])
+            else:
+                pending_cycles.append([
+                    (self.search_cycle, search_config, cycle_time)
+                    for cycle_time in cycle_times
+                ])
+
+        futures = {}
+        for cycles in zip_longest(*pending_cycles):
+            for cycle in cycles:
+                if cycle is None:
+                    continue
+                search_fn, search_config, cycle_arg = cycle
+                executor = executors[search_config.get_storage_platform()]
+                future = executor.submit(search_fn, search_config, cycle_arg)
+                futures[future] = cycle
+
+        failed_cycles = []
+        try:
+            for future in as_completed(futures):
+                search_fn, search_config, cycle_time = futures[future]
+                if isinstance(cycle_time, list):
+                    cycle_time = cycle_time[0]
+                try:
+                    future.result()
+                except Exception as e:
+                    search_path = search_config.get_search_path(cycle_time)
+                    print(f'Search failed, path: {search_path}, error: {e}')
+                    failed_cycles.append(search_path)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+
+        for key, search_config in self.search_configs.items():
+            search_date_range = search_config.get_date_range()
+            search_date_range.set_current(search_date_range.end)
+
+        if len(failed_cycles) > 0:
+            msg = f'{len(failed_cycles)} of {len(futures)} search cycles ' \
+                  f'failed, first failure: {failed_cycles[0]}'
+            raise ValueError(msg)
+
+    def get_cycle_unit(self, search_config, cycle_time):
+        return (
+            SEARCH_UNIT,
+            search_config.get_storage_platform(),
+            search_config.search_config.get(SEARCH_PATH_KEY),
+            cycle_time
+        )
+
+    def get_remaining_cycles(self, search_config, cycle_times):
+        """
+        Return the cycles in 'cycle_times' not already recorded as complete
+        in the engine's progress journal.
+        """
+        if self.journal is None:
+            return list(cycle_times)
+
+        return [
+            cycle_time for cycle_time in cycle_times
+            if not self.journal.is_complete(
+                self.get_cycle_unit(search_config, cycle_time))
+        ]
+
+    def mark_complete(self, search_config, cycle_times):
+        """
+        Record 'cycle_times' as complete in the progress journal once their
+        search results are stored.  Buffered results are only stored when
+        the ingest writer flushes them, so the journal entry waits for the
+        flush.
+        """
+        if self.journal is None:
+            return
+
+        units = [
+            self.get_cycle_unit(search_config, cycle_time)
+            for cycle_time in cycle_times
+        ]
+        if self.ingest is not None:
+            self.ingest.after_flush(lambda: self.journal.mark_complete(units))
+        else:
+            self.journal.mark_complete(units)
+
+    def search_prefix(self, search_config, cycle_times):
+        """
+        Search every cycle in 'cycle_times' with a single listing of the
+        prefix their keys share.  Like search_cycle, this method does not
+        touch the search config's date range.
+        """
+        cycle_keys = [
+            (cycle_time, search_config.get_search_path(cycle_time))
+            for cycle_time in cycle_times
+        ]
+        prefix = get_listing_prefix(cycle_keys[0][1])
+        start_after = get_start_after_key(search_config, cycle_keys)
+        failed_cycles = []
+        cmd_result_id = search_aws_s3_clean_prefix(
+            prefix, cycle_keys, start_after, self.ingest, failed_cycles)
+        self.record_failed_cycles(search_config, failed_cycles)
+        # failed cycles are searched again when the journal is resumed
+        self.mark_complete(search_config, [
+            cycle_time for cycle_time in cycle_times
+            if cycle_time not in failed_cycles
+        ])
+        return cmd_result_id
+
+    def search_cycle(self, search_config, cycle_time):
+        """
+        Run the search command for a single cycle of a search config, post
+        the command result and store any files found.  Returns the
+        cmd_result_id of the posted command result, or None if the result
+        was queued in the engine's ingest buffer.  This method does not
+        touch the search config's date range so it is safe to call from
+        several threads at once.
+        """
+        cmd_result_id = self.send_search_cycle(search_config, cycle_time)
+        # failed cycles are searched again when the journal is resumed
+        if not self.is_failed_cycle(search_config, cycle_time):
+            self.mark_complete(search_config, [cycle_time])
+        return cmd_result_id
+
+    def send_search_cycle(self, search_config, cycle_time):
+        search_path = search_config.get_search_path(cycle_time)
+        args = [search_path]
+        print(f'args: {args}, search_path: {search_path}')
+        platform = search_config.get_storage_platform()
+        if platform == platforms.AWS_S3:
+            failed_cycles = []
+            cmd_result_id = search_aws_s3_prefix(
+                args, cycle_time, self.ingest, failed_cycles)
+            self.record_failed_cycles(search_config, failed_cycles)
+            return cmd_result_id
+        elif platform == platforms.AWS_S3_CLEAN:
+            cmd = s3.AwsS3CommandHandler(s3.CMD_GET_S3_OBJ_LIST, args)
+        elif platform == platforms.HERA_HPSS:
+            cmd = hpss.HpssCommandHandler(
+                hpss.CMD_INSPECT_TARBALL, args)
+        elif platform == platforms.DISCOVER:
+            cmd = discover.DiscoverCommandHandler(
+                discover.CMD_GET_DISCOVER_OBJ_LIST, args)
+        else:
+            msg = f'Searching platform {platform} is not supported.'
+            raise ValueError(msg)
+
+        print(f'cmd: {cmd}')
+
+        success = cmd.send()
+
+        raw_resp = cmd.get_raw_response()
+
+        if platform == platforms.AWS_S3_CLEAN:
+            print('posting command results for aws s3')
+            cmd_result_data = get_aws_s3_cmd_result_data(raw_resp, cycle_time)
+        elif platform == platforms.HERA_HPSS:
+            cmd_result_data = get_hpss_cmd_result_data(raw_resp, cycle_time)
+        elif platform == platforms.DISCOVER:
+            print('posting command results for discover')
+            cmd_result_data = get_discover_cmd_result_data(
+                raw_resp, cycle_time)
+
+        files_meta = []
+        try:
+            if success:
+                print(f'current_time: {cycle_time}')
+                contents = cmd.parse_response(cycle_time)
+
+                if platform == platforms.AWS_S3_CLEAN:
+                    files_meta = get_aws_s3_clean_files_meta(None, contents)
+                elif platform == platforms.HERA_HPSS:
+                    files_meta = get_inspect_tarball_files_meta(
+                        None, contents)
+                elif platform == platforms.DISCOVER:
+                    files_meta = get_discover_files_meta(None, contents)
+            else:
+                msg = f'Command failed!!!!!!!!!!!!!!!!!!!!!!!!!!!!! - error code: {raw_resp}.'
+                print(msg)
+                if is_failed_search(raw_resp):
+                    self.record_failed_cycles(search_config, [cycle_time])
+        finally:
+            # the command result is stored even if its output can not be
+            # parsed
+            cmd_result_id = post_search_result(
+                cmd_result_data, files_meta, self.ingest)
+
+        return cmd_result_id
@@ -0,0 +1,353 @@
+# Merge of the per-process sqlite shards written when OBS_INV_SHARD_DIR is
+# set.  Each shard has the full inventory schema and its own ids, so the
+# merge gives its command results new cmd_result_ids and maps its
+# obs_inventory rows to the obs_ids of the matching rows in the database,
+# by the unique_obs_inventory key, before adding the meta rows that refer
+# to them.  The rules of the insert functions in inventory_table_factory
+# apply: inventory rows already in the database only get a new valid_at,
+# updated_at and the columns derived from their filename and parent_dir,
+# meta rows already there are left as they are.  A sqlite
+# database ATTACHes each shard and merges it with a few INSERT ... SELECT
+# statements, other databases are sent the shard rows in chunks.  Each
+# shard is merged in one transaction and removed once it is committed, so
+# a failed merge can be run again.
+
+import glob
+import os
+from datetime import datetime
+
+import sqlalchemy as db
+from sqlalchemy import UniqueConstraint, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+
+
+# shard rows sent to the database per statement by merge_shard_rows
+MERGE_CHUNK_SIZE = 1000
+SHARD_ALIAS = 'shard'
+
+# meta tables, with the latest tables kept from them
+META_TABLES = [
+    (tbl_factory.ObsMetaNceplibsBufr,
+     tbl_factory.OBS_META_NCEPLIBS_BUFR_LATEST_TABLE,
+     tbl_factory.BUFR_LATEST_KEY),
+    (tbl_factory.ObsMetaNceplibsPrepbufr,
+     tbl_factory.OBS_META_NCEPLIBS_PREPBUFR_LATEST_TABLE,
+     tbl_factory.PREPBUFR_LATEST_KEY),
+    (tbl_factory.ObsMetaNceplibsPrepbufrAggregate, None, None),
+]
+
+
+def get_shard_paths(shard_dir):
+    return sorted(glob.glob(
+        os.path.join(shard_dir, f'{tbl_factory.SHARD_PREFIX}*.db')))
+
+
+def get_unique_key(table):
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            return [column.name for column in constraint.columns]
+
+    msg = f'Table {table.name} has no unique constraint to merge on.'
+    raise ValueError(msg)
+
+
+def get_data_columns(table):
+    # every column but the ids that change in the merge
+    return [
+        column.name for column in table.columns
+        if column.name not in ['cmd_result_id', 'obs_id', 'meta_id']
+    ]
+
+
+def merge_attached_shard(shard_path, engine):
+    """
+    Merge one shard into a sqlite database with INSERT ... SELECT
+    statements in one transaction.  Returns the rows merged per table.
+    """
+    cmd_results = tbl_factory.CmdResult.__table__
+    obs_inv = tbl_factory.ObsInventory.__table__
+    cmd_columns = ', '.join(get_data_columns(cmd_results))
+    obs_columns = get_data_columns(obs_inv)
+    obs_key = get_unique_key(obs_inv)
+    counts = {}
+
+    with engine.connect() as connection:
+        # sqlite can not ATTACH inside a transaction
+        connection.execute(
+            text(f'ATTACH DATABASE :path AS {SHARD_ALIAS}'),
+            {'path': shard_path}
+        )
+        try:
+            with connection.begin():
+                # the max is computed once, by the statement taking the
+                # write lock, so the new ids can not be taken by other jobs
+                result = connection.execute(text(f"""
+                    INSERT INTO main.cmd_results (cmd_result_id, {cmd_columns})
+                    SELECT cmd_result_id + (
+                        SELECT IFNULL(MAX(cmd_result_id), 0)
+                        FROM main.cmd_results
+                    ), {cmd_columns}
+                    FROM {SHARD_ALIAS}.cmd_results
+                    """))
+                counts[cmd_results.name] = result.rowcount
+                id_offset = connection.execute(text(f"""
+                    SELECT IFNULL((SELECT MAX(cmd_result_id) FROM main.cmd_results), 0)
+                    - IFNULL((SELECT MAX(cmd_result_id) FROM {SHARD_ALIAS}.cmd_results), 0)
+                    """)).scalar()
+
+                columns = ', '.join(
+                    tbl_factory.CmdResultPayload.__table__.columns.keys())
+                result = connection.execute(text(f"""
+                    INSERT OR IGNORE INTO main.cmd_result_payloads ({columns})
+                    SELECT {columns} FROM {SHARD_ALIAS}.cmd_result_payloads
+                    """))
+                counts[tbl_factory.CMD_RESULT_PAYLOADS_TABLE] = result.rowcount
+
+                columns = ', '.join(obs_columns)
+                # the rows are written now, not when written to the shard
+                shard_columns = ', '.join(
+                    ':merged_at' if column == 'updated_at' else column
+                    for column in obs_columns)
+                result = connection.execute(text(f"""
+                    INSERT INTO main.obs_inventory (cmd_result_id, {columns})
+                    SELECT cmd_result_id + :id_offset, {shard_columns}
+                    FROM {SHARD_ALIAS}.obs_inventory WHERE true
+                    ON CONFLICT ({', '.join(obs_key)}) DO UPDATE SET
+                    valid_at = excluded.valid_at,
+                    generic_filename = excluded.generic_filename,
+                    sensor = excluded.sensor,
+                    stream = excluded.stream,
+                    source_dir = excluded.source_dir,
+                    updated_at = excluded.updated_at
+                    """).bindparams(
+                        db.bindparam('merged_at', type_=db.DateTime)),
+                    {'id_offset': id_offset, 'merged_at': datetime.now()})
+                counts[obs_inv.name] = result.rowcount
+
+                connection.execute(text(
+                    'DROP TABLE IF EXISTS temp.shard_obs_ids'))
+                connection.execute(text(f"""
+                    CREATE TEMP TABLE shard_obs_ids AS
+                    SELECT s.obs_id AS shard_obs_id, m.obs_id AS obs_id
+                    FROM {SHARD_ALIAS}.obs_inventory s
+                    JOIN main.obs_inventory m ON {' AND '.join(
+                        f's.{column} IS m.{column}' for column in obs_key)}
+                    """))
+
+                for meta_class, latest_table, latest_key in META_TABLES:
+                    meta_table = meta_class.__table__.name
+                    columns = ', '.join(get_data_columns(meta_class.__table__))
+                    shard_columns = ', '.join(
+                        f's.{column}'
+                        for column in get_data_columns(meta_class.__table__))
+                    result = connection.execute(text(f"""
+                        INSERT OR IGNORE INTO main.{meta_table}
+                        (obs_id, cmd_result_id, {columns})
+                        SELECT ids.obs_id, s.cmd_result_id + :id_offset,
+                        {shard_columns}
+                        FROM {SHARD_ALIAS}.{meta_table} s
+                        JOIN temp.shard_obs_ids ids
+                        ON ids.shard_obs_id = s.obs_id
+                        """), {'id_offset': id_offset})
+                    counts[meta_table] = result.rowcount
+
+                    if latest_table is None:
+                        continue
+
+                    key = ', '.join(latest_key)
+                    shard_key = ', '.join(
+                        'ids.obs_id' if column == 'obs_id' else f's.{column}'
+                        for column in latest_key)
+                    connection.execute(text(f"""
+                        INSERT OR IGNORE INTO main.{latest_table}
+                        ({key}, inserted_at)
+                        SELECT {shard_key}, MAX(s.inserted_at)
+                        FROM {SHARD_ALIAS}.{meta_table} s
+                        JOIN temp.shard_obs_ids ids
+                        ON ids.shard_obs_id = s.obs_id
+                        GROUP BY {shard_key}
+                        """))
+
+                result = connection.execute(text(f"""
+                    INSERT INTO main.inventory_watermarks
+                    (watermark_hash, platform, search_key, last_cycle,
+                    updated_at)
+                    SELECT watermark_hash, platform, search_key, last_cycle,
+                    updated_at
+                    FROM {SHARD_ALIAS}.inventory_watermarks WHERE true
+                    ON CONFLICT (watermark_hash) DO UPDATE SET
+                    last_cycle = MAX(last_cycle, excluded.last_cycle),
+                    updated_at = excluded.updated_at
+                    """))
+                counts[tbl_factory.INVENTORY_WATERMARKS_TABLE] = \
+                    result.rowcount
+                connection.execute(text('DROP TABLE temp.shard_obs_ids'))
+        finally:
+            connection.execute(text(f'DETACH DATABASE {SHARD_ALIAS}'))
+
+    return counts
+
+
+def get_insert_ignore(table, dialect_name):
+    if dialect_name == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def get_watermark_upsert(rows, dialect_name):
+    watermarks = tbl_factory.InventoryWatermark.__table__
+    if dialect_name == 'mysql':
+        statement = mysql_insert(watermarks).values(rows)
+        return statement.on_duplicate_key_update(
+            last_cycle=db.func.greatest(
+                watermarks.c.last_cycle, statement.inserted.last_cycle),
+            updated_at=statement.inserted.updated_at
+        )
+
+    statement = sqlite_insert(watermarks).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=['watermark_hash'],
+        set_={
+            'last_cycle': db.func.max(
+                watermarks.c.last_cycle, statement.excluded.last_cycle),
+            'updated_at': statement.excluded.updated_at
+        }
+    )
+
+
+def iter_chunks(connection, statement):
+    result = connection.execute(statement)
+    while True:
+        rows = result.fetchmany(MERGE_CHUNK_SIZE)
+        if len(rows) == 0:
+            return
+        yield [dict(row._mapping) for row in rows]
+
+
+def merge_shard_rows(shard_path, engine):
+    """
+    Merge one shard by reading its rows and writing them to the database
+    in chunks, in one transaction.  Works with any database, used for
+    MySQL.  Returns the rows merged per table.
+    """
+    dialect_name = engine.dialect.name
+    cmd_results = tbl_factory.CmdResult.__table__
+    obs_inv = tbl_factory.ObsInventory.__table__
+    obs_key = get_unique_key(obs_inv)
+    counts = {}
+    cmd_ids = {}
+    obs_ids = {}
+
+    shard_engine = db.create_engine(f'sqlite:///{shard_path}')
+    try:
+        with shard_engine.connect() as shard, engine.begin() as connection:
+            counts[cmd_results.name] = 0
+            for rows in iter_chunks(shard, select(cmd_results).order_by(
+                    cmd_results.c.cmd_result_id)):
+                # one at a time to get each new id from the database
+                for row in rows:
+                    shard_id = row.pop('cmd_result_id')
+                    result = connection.execute(cmd_results.insert(), row)
+                    cmd_ids[shard_id] = result.inserted_primary_key[0]
+                counts[cmd_results.name] += len(rows)
+
+            payloads = tbl_factory.CmdResultPayload.__table__
+            counts[payloads.name] = 0
+            for rows in iter_chunks(shard, select(payloads)):
+                connection.execute(
+                    get_insert_ignore(payloads, dialect_name), rows)
+                counts[payloads.name] += len(rows)
+
+            counts[obs_inv.name] = 0
+            merged_at = datetime.now()
+            for rows in iter_chunks(shard, select(obs_inv)):
+                shard_keys = {}
+                for row in rows:
+                    shard_keys[tuple(row[column] for column in obs_key)] = \
+                        row.pop('obs_id')
+                    row['cmd_result_id'] = cmd_ids.get(row['cmd_result_id'])
+                    row['updated_at'] = merged_at
+                tbl_factory.insert_obs_inv_rows(connection, rows)
+                counts[obs_inv.name] += len(rows)
+
+                hashes = list({row['unique_hash'] for row in rows})
+                for main_row in connection.execute(
+                    select([obs_inv.c.obs_id] + [
+                        obs_inv.c[column] for column in obs_key
+                    ]).where(obs_inv.c.unique_hash.in_(hashes))
+                ):
+                    shard_id = shard_keys.get(
+                        tuple(main_row[column] for column in obs_key))
+                    if shard_id is not None:
+                        obs_ids[shard_id] = main_row.obs_id
+
+            for meta_class, latest_table, latest_key in META_TABLES:
+                meta_table = meta_class.__table__
+                counts[meta_table.name] = 0
+                for rows in iter_chunks(shard, select(meta_table)):
+                    rows = [
+                        dict(row, obs_id=obs_ids[row['obs_id']],
+                             cmd_result_id=cmd_ids.get(row['cmd_result_id']))
+                        for row in rows if row['obs_id'] in obs_ids
+                    ]
+                    for row in rows:
+                        del row['meta_id']
+                    if len(rows) == 0:
+                        continue
+
+                    connection.execute(
+                        get_insert_ignore(meta_table, dialect_name), rows)
+                    if latest_table is not None:
+                        connection.execute(text(
+                            tbl_factory.get_latest_insert_sql(
+                                latest_table, latest_key)), rows)
+                    counts[meta_table.name] += len(rows)
+
+            watermarks = tbl_factory.InventoryWatermark.__table__
+            counts[watermarks.name] = 0
+            for rows in iter_chunks(shard, select(watermarks)):
+                for row in rows:
+                    del row['watermark_id']
+                connection.execute(get_watermark_upsert(rows, dialect_name))
+                counts[watermarks.name] += len(rows)
+    finally:
+        shard_engine.dispose()
+
+    return counts
+
+
+def remove_shard(shard_path):
+    for path in [shard_path, f'{shard_path}-wal', f'{shard_path}-shm',
+                 f'{shard_path}.lock']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def merge_shards(shard_dir, engine=None, keep=False):
+    """
+    Merge every shard in 'shard_dir' into the database, one at a time.
+    Merged shards are removed unless 'keep' is set.  Returns the total
+    rows merged per table.
+    """
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    shard_paths = get_shard_paths(shard_dir)
+    print(f'Merging {len(shard_paths)} shards from {shard_dir}')
+    totals = {}
+    for shard_path in shard_paths:
+        if engine.dialect.name == 'sqlite':
+            counts = merge_attached_shard(shard_path, engine)
+        else:
+            counts = merge_shard_rows(shard_path, engine)
+        print(f'Merged shard {shard_path}: {counts}')
+
+        for table, count in counts.items():
+            totals[table] = totals.get(table, 0) + count
+        if not keep:
+            remove_shard(shard_path)
+
+    return totals
@@ -0,0 +1,260 @@
+# Parquet snapshots of the inventory tables for analysis and plots.  Each
+# table is written to its own directory of Parquet files partitioned by the
+# year of obs_day (<snapshot_dir>/<table>/year=2020/part-....parquet).  A
+# snapshot is incremental: snapshot_state.json records the largest primary
+# key (obs_id, meta_id) written for each table and the next export only
+# appends the rows with a larger one.  The watermark is not inserted_at,
+# which is stamped when a file is searched rather than when its row is
+# committed, so shard merges, buffered writers and parallel searches commit
+# rows older than rows already exported.  Rows updated in place by an
+# upsert keep their key and are not exported again.  Readers open a table
+# as a pyarrow dataset, so only the columns asked for are read and filters
+# on obs_day skip the partitions and row groups outside the range.
+# Requires the optional pyarrow package.
+
+import json
+import os
+import re
+import uuid
+
+import sqlalchemy as db
+from sqlalchemy import select
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pc = None
+    ds = None
+    pq = None
+
+
+SNAPSHOT_DIR_ENV = 'OBS_INV_SNAPSHOT_DIR'
+SNAPSHOT_TABLES = [
+    tbl_factory.OBS_INVENTORY_TABLE,
+    tbl_factory.OBS_META_NCEPLIBS_BUFR_TABLE,
+    tbl_factory.OBS_META_NCEPLIBS_PREPBUFR_TABLE,
+    tbl_factory.OBS_META_NCEPLIBS_PREPBUFR_AGG_TABLE,
+]
+STATE_FILENAME = 'snapshot_state.json'
+PARTITION_COLUMN = 'year'
+SNAPSHOT_CHUNK_ROWS = 100000
+
+
+def require_pyarrow():
+    if pa is None:
+        msg = 'Parquet snapshots require the pyarrow package.'
+        raise ValueError(msg)
+
+
+def get_snapshot_table(table_name):
+    if table_name not in SNAPSHOT_TABLES:
+        msg = f'Invalid snapshot table: {table_name}, valid tables: ' \
+              f'{SNAPSHOT_TABLES}'
+        raise ValueError(msg)
+    return tbl_factory.Base.metadata.tables[table_name]
+
+
+def get_table_dir(snapshot_dir, table_name):
+    return os.path.join(snapshot_dir, table_name)
+
+
+def has_snapshot(snapshot_dir, table_name):
+    return os.path.isdir(get_table_dir(snapshot_dir, table_name))
+
+
+def load_state(snapshot_dir):
+    """
+    Largest primary key written for each table, by table name.
+    """
+    state_path = os.path.join(snapshot_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return {}
+
+    with open(state_path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def save_state(snapshot_dir, state):
+    state_path = os.path.join(snapshot_dir, STATE_FILENAME)
+    temp_path = f'{state_path}.tmp'
+    with open(temp_path, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temp_path, state_path)
+
+
+def get_key_column(table):
+    return table.primary_key.columns.values()[0]
+
+
+def get_arrow_type(column):
+    if isinstance(column.type, db.Boolean):
+        return pa.bool_()
+    if isinstance(column.type, db.Integer):
+        return pa.int64()
+    if isinstance(column.type, db.Float):
+        return pa.float64()
+    if isinstance(column.type, db.DateTime):
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def get_arrow_schema(table):
+    return pa.schema(
+        [(column.name, get_arrow_type(column)) for column in table.columns]
+    )
+
+
+def get_arrow_table(rows, schema):
+    columns = list(zip(*rows))
+    arrow_table = pa.table(
+        [pa.array(values, type=field.type)
+         for values, field in zip(columns, schema)],
+        schema=schema
+    )
+    years = pc.year(arrow_table.column('obs_day'))
+    return arrow_table.append_column(
+        PARTITION_COLUMN, years.cast(pa.int32()))
+
+
+def remove_run_files(table_dir, run_id):
+    for dir_path, _, filenames in os.walk(table_dir):
+        for filename in filenames:
+            if filename.startswith(f'part-{run_id}-'):
+                os.remove(os.path.join(dir_path, filename))
+
+
+def export_table(connection, table_name, snapshot_dir, last_key=None):
+    """
+    Append the rows of 'table_name' with a primary key larger than
+    'last_key', all rows when it is None, to its snapshot.  Returns the row
+    count and the largest key written.  The files of a failed export are
+    removed.
+    """
+    table = get_snapshot_table(table_name)
+    key_column = get_key_column(table)
+    schema = get_arrow_schema(table)
+    table_dir = get_table_dir(snapshot_dir, table_name)
+    run_id = uuid.uuid4().hex
+
+    statement = select(table).order_by(key_column)
+    if last_key is not None:
+        statement = statement.where(key_column > last_key)
+
+    row_count = 0
+    try:
+        result = connection.execution_options(
+            stream_results=True).execute(statement)
+        for chunk, rows in enumerate(result.partitions(SNAPSHOT_CHUNK_ROWS)):
+            pq.write_to_dataset(
+                get_arrow_table(rows, schema),
+                table_dir,
+                partition_cols=[PARTITION_COLUMN],
+                basename_template=f'part-{run_id}-{chunk}-{{i}}.parquet'
+            )
+            row_count += len(rows)
+            last_key = rows[-1]._mapping[key_column]
+    except Exception:
+        remove_run_files(table_dir, run_id)
+        raise
+
+    return row_count, last_key
+
+
+def export_snapshot(snapshot_dir, table_names=None, engine=None):
+    """
+    Append the rows inserted since the last export of each table to the
+    snapshot in 'snapshot_dir'.  Returns the rows written by table name.
+    """
+    require_pyarrow()
+    if table_names is None:
+        table_names = SNAPSHOT_TABLES
+    if engine is None:
+        engine = tbl_factory.get_engine()
+
+    os.makedirs(snapshot_dir, exist_ok=True)
+    state = load_state(snapshot_dir)
+    counts = {}
+    for table_name in table_names:
+        last_key = state.get(table_name)
+        with engine.connect() as connection:
+            row_count, new_last_key = export_table(
+                connection, table_name, snapshot_dir, last_key)
+
+        counts[table_name] = row_count
+        if new_last_key is not None:
+            state[table_name] = new_last_key
+            save_state(snapshot_dir, state)
+        print(f'snapshot of {table_name}: {row_count} rows after key '
+              f'{last_key}')
+
+    return counts
+
+
+def get_obs_day_filter(start=None, end=None):
+    """
+    Dataset filter on obs_day that also prunes the year partitions.
+    """
+    require_pyarrow()
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field(PARTITION_COLUMN) >= start.year)
+        conditions.append(ds.field('obs_day') >= pa.scalar(
+            start, type=pa.timestamp('us')))
+    if end is not None:
+        conditions.append(ds.field(PARTITION_COLUMN) <= end.year)
+        conditions.append(ds.field('obs_day') <= pa.scalar(
+            end, type=pa.timestamp('us')))
+
+    return combine_filters(conditions)
+
+
+def combine_filters(conditions):
+    conditions = [condition for condition in conditions
+                  if condition is not None]
+    if len(conditions) == 0:
+        return None
+
+    combined = conditions[0]
+    for condition in conditions[1:]:
+        combined = combined & condition
+    return combined
+
+
+def read_snapshot(snapshot_dir, table_name, columns=None, filter=None):
+    """
+    Read 'columns' of the rows of a table snapshot matching 'filter', a
+    pyarrow dataset expression, into a DataFrame.
+    """
+    require_pyarrow()
+    get_snapshot_table(table_name)
+    if not has_snapshot(snapshot_dir, table_name):
+        msg = f'No snapshot of {table_name} in {snapshot_dir}.'
+        raise ValueError(msg)
+
+    # files exported before a column was added read it as null
+    schema = get_arrow_schema(get_snapshot_table(table_name)).append(
+        pa.field(PARTITION_COLUMN, pa.int32()))
+    dataset = ds.dataset(
+        get_table_dir(snapshot_dir, table_name),
+        schema=schema,
+        format='parquet',
+        partitioning='hive'
+    )
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+def get_like_regex(pattern):
+    """
+    Regular expression matching the same strings as the SQL LIKE 'pattern'.
+    """
+    regex = ''.join(
+        '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+        for char in pattern
+    )
+    return f'^{regex}$'
@@ -0,0 +1,143 @@
+# SQLite settings for many inventory jobs writing to one database file.
+# Every new connection is switched to write-ahead logging, so readers do not
+# block the writer, and waits up to busy_timeout for the write lock.  Writes
+# that still fail with "database is locked", e.g. a transaction that read
+# before another job committed, are retried with jittered exponential
+# back-off by 'retry_when_busy'.  Each setting can be changed in the .env
+# file.
+
+import functools
+import os
+import random
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from obs_inv_utils.env_utils import get_env_number
+
+
+SqlitePragma = namedtuple(
+    'SqlitePragma',
+    [
+        'name',
+        'env',
+        'default',
+        'choices'
+    ]
+)
+
+# busy_timeout is set first so switching the journal mode waits for the
+# other connections
+SQLITE_PRAGMAS = [
+    SqlitePragma('busy_timeout', 'SQLITE_BUSY_TIMEOUT', 30000, None),
+    SqlitePragma('journal_mode', 'SQLITE_JOURNAL_MODE', 'WAL',
+                 ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']),
+    SqlitePragma('synchronous', 'SQLITE_SYNCHRONOUS', 'NORMAL',
+                 ['OFF', 'NORMAL', 'FULL', 'EXTRA']),
+    SqlitePragma('mmap_size', 'SQLITE_MMAP_SIZE', 268435456, None),
+    # negative sizes are in KiB, i.e. 64 MiB
+    SqlitePragma('cache_size', 'SQLITE_CACHE_SIZE', -65536, None),
+]
+
+BUSY_RETRIES_ENV = 'SQLITE_BUSY_RETRIES'
+DEFAULT_BUSY_RETRIES = 8
+# seconds, the back-off doubles after each retry up to the maximum
+BUSY_BACKOFF_ENV = 'SQLITE_BUSY_BACKOFF'
+DEFAULT_BUSY_BACKOFF = 0.05
+BUSY_MAX_BACKOFF_ENV = 'SQLITE_BUSY_MAX_BACKOFF'
+DEFAULT_BUSY_MAX_BACKOFF = 5.0
+
+BUSY_ERRORS = [
+    'database is locked',
+    'database is busy',
+    'database table is locked',
+]
+
+
+def get_pragma_value(pragma):
+    value = os.getenv(pragma.env)
+    if value is None:
+        return pragma.default
+
+    if pragma.choices is not None:
+        if value.upper() not in pragma.choices:
+            msg = f'{pragma.env} must be one of {pragma.choices}, ' \
+                  f'actually: {value}'
+            raise ValueError(msg)
+        return value.upper()
+
+    try:
+        return int(value)
+    except ValueError:
+        msg = f'{pragma.env} must be an integer, actually: {value}'
+        raise ValueError(msg)
+
+
+def get_sqlite_pragmas():
+    return {pragma.name: get_pragma_value(pragma) for pragma in SQLITE_PRAGMAS}
+
+
+def apply_sqlite_pragmas(engine):
+    """
+    Set the pragmas from get_sqlite_pragmas on every connection 'engine'
+    opens.  Returns the pragmas.
+    """
+    pragmas = get_sqlite_pragmas()
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    print(f'sqlite pragmas: {pragmas}')
+    return pragmas
+
+
+def is_busy_error(error):
+    return isinstance(error, OperationalError) and any(
+        busy_error in str(error.orig).lower() for busy_error in BUSY_ERRORS
+    )
+
+
+def get_busy_delay(attempt, backoff, max_backoff):
+    # full jitter, so jobs that collided do not retry in step
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def retry_when_busy(func):
+    """
+    Decorator that calls 'func' again when it fails because the SQLite
+    database is locked by another connection.  'func' has to run its whole
+    transaction, it is called from the start on every retry.  Other errors,
+    including all MySQL errors, are raised straight away.
+    """
+
+    @functools.wraps(func)
+    def retry(*args, **kwargs):
+        retries = get_env_number(BUSY_RETRIES_ENV, DEFAULT_BUSY_RETRIES, int)
+        backoff = get_env_number(
+            BUSY_BACKOFF_ENV, DEFAULT_BUSY_BACKOFF, float)
+        max_backoff = get_env_number(
+            BUSY_MAX_BACKOFF_ENV, DEFAULT_BUSY_MAX_BACKOFF, float)
+
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_busy_error(e) or attempt >= retries:
+                    raise
+
+                delay = get_busy_delay(attempt, backoff, max_backoff)
+                attempt += 1
+                print(f'Database busy in {func.__name__}, retry {attempt} '
+                      f'of {retries} in {delay:.2f} s')
+                time.sleep(delay)
+
+    return retry
@@ -9,6 +9,8 @@ import matplotlib.dates as mdates
 import os
 import argparse
 import obs_inv_utils.inventory_table_factory as itf
+import obs_inv_utils.obs_inv_queries as oiq
+from obs_inv_utils import connection_pools
 
 #argparse section
 parser = argparse.ArgumentParser()
@@ -16,6 +18,9 @@ parser.add_argument("-o", dest='out_dir', help="output directory for figures",de
 parser.add_argument("-dev", dest='dev', help='Use this flag to add a timestamp to the filename for development', default=False, type=bool)
 args = parser.parse_args()
 
+#the plot scripts read with a single connection
+connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
+
 #parameters
 daterange=[date(1975,1,1), date(2025,1,1)]
 
@@ -26,25 +31,14 @@ def select_variable(variable, db_frame):
     dftmp = db_frame.loc[db_frame['variable']==variable]
     return dftmp
 
-def get_sensor(row):
-    directory = row['parent_dir']
-    sensor = directory.split("/")[2]
-    return sensor
-
-
 #read data from sql database of obs counts
-print('connecting to mysql db')
-mysql_conn = itf.engine.connect()
-
-#PREPBUFR FILE INFO 
-sql2 = f"""select m.*, o.parent_dir from obs_meta_nceplibs_prepbufr_aggregate as m inner join obs_inventory as o on m.obs_id = o.obs_id where o.s3_bucket = \'noaa-reanalyses-pds\'"""
-data2 = pandas.read_sql(sql2, mysql_conn)
-db_frame = data2.sort_values('inserted_at').drop_duplicates(['filename', 'obs_day', 'variable', 'tot', 'file_size', 'typ'], keep='last')
+print('getting per day prepbufr counts from database')
+db_frame = oiq.get_prepbufr_aggregate_daily_counts()
 
 # db_frame = pandas.concat([db_frame1, db_frame2], axis=0, ignore_index=True)
 
 db_frame['datetime'] = pandas.to_datetime(db_frame.obs_day)
-db_frame['sensor'] = db_frame.apply(get_sensor, axis=1)
+#sensor, stream and source_dir are derived from parent_dir at ingest
 
 #loop and plot typ
 unique_var = db_frame.sort_values('variable', ascending=False).drop_duplicates('variable')
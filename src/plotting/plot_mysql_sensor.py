@@ -10,6 +10,8 @@ import os
 import argparse
 import plot_utils as utils
 import obs_inv_utils.inventory_table_factory as itf
+import obs_inv_utils.obs_inv_queries as oiq
+from obs_inv_utils import connection_pools
 
 #argparse section
 parser = argparse.ArgumentParser()
@@ -17,6 +19,9 @@ parser.add_argument("-o", dest='out_dir', help="output directory for figures",de
 parser.add_argument("-dev", dest='dev', help='Use this flag to add a timestamp to the filename for development', default=False, type=bool)
 args = parser.parse_args()
 
+#the plot scripts read with a single connection
+connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
+
 #parameters
 daterange=[date(1975,1,1), date(2025,1,1)]
 
@@ -27,24 +32,18 @@ def select_sensor(sensor, db_frame):
     dftmp = db_frame.loc[db_frame['sensor']==sensor]
     return dftmp
 
-def get_sensor(row):
-    directory = row['parent_dir']
-    sensor = directory.split("/")[2]
-    return sensor
-
-
 #read data from sql database of obs counts
 print('getting data from database')
-db_frame1 = utils.get_distinct_bufr()
+db_frame1 = oiq.get_bufr_daily_counts()
 print('bufr done, getting prepbufr')
-db_frame2 = utils.get_distinct_prepbufr()
+db_frame2 = oiq.get_prepbufr_daily_counts()
 print('prepbufr done')
 
 db_frame = pandas.concat([db_frame1, db_frame2], axis=0, ignore_index=True)
 print('concat done')
 
 db_frame['datetime'] = pandas.to_datetime(db_frame.obs_day)
-db_frame['sensor'] = db_frame.apply(get_sensor, axis=1)
+#sensor, stream and source_dir are derived from parent_dir at ingest
 
 #loop and plot sensors
 unique_sensor = db_frame.sort_values('sensor', ascending=False).drop_duplicates('sensor')
@@ -10,7 +10,8 @@ import os
 from scipy import interpolate
 import argparse
 import obs_inv_utils.inventory_table_factory as itf
-import re
+import obs_inv_utils.obs_inv_queries as oiq
+from obs_inv_utils import connection_pools
 import plot_utils as utils
 
 #argparse section
@@ -20,6 +21,9 @@ parser.add_argument("--sidb", dest='satinfo_db_root', help="root for sat info db
 parser.add_argument("-dev", dest='dev', help='Use this flag to add a timestamp to the filename for development', default=False, type=bool)
 args = parser.parse_args()
 
+#the plot scripts read with a single connection
+connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
+
 #parameters
 satinfo_db_root=args.satinfo_db_root
 daterange=[date(1975,1,1), date(2025,1,1)]
@@ -49,30 +53,13 @@ def select_sensor(sensor, db_frame):
     dftmp = db_frame.loc[db_frame['sensor']==sensor]
     return dftmp
 
-def get_sensor(row):
-    directory = row['parent_dir']
-    sensor = directory.split("/")[2]
-    return sensor
-
-def get_subsensor(row):
-    directory = row['parent_dir']
-    subsensor = directory.split("/")[3]
-    return subsensor
-
-def get_source_dir(row):
-    directory = row['parent_dir']
-    directory = directory.replace("observations/reanalysis", "")
-    source_dir = re.split("/[12][90][0-9][0-9]/[01][0-9]/", directory)[0]
-    return source_dir
-
 #read data from sql database of obs counts
-db_frame = utils.get_distinct_bufr_by_sensors(['observations/reanalysis/geo/'])
+db_frame = oiq.get_bufr_daily_counts(sensors=['geo'])
 
 db_frame['datetime'] = pandas.to_datetime(db_frame.obs_day)
-db_frame['sensor'] = db_frame.apply(get_sensor, axis=1)
+#sensor, stream and source_dir are derived from parent_dir at ingest
 
-db_frame['subsensor'] = db_frame.apply(get_subsensor, axis=1)
-db_frame['source_dir'] = db_frame.apply(get_source_dir, axis=1)
+db_frame['subsensor'] = db_frame['stream']
 
 #loop and plot sensors/sat_ids
 unique_sensor_sats = db_frame[['sensor', 'subsensor', 'sat_id', 'sat_id_name']].value_counts().reset_index(name='count').sort_values(by = ['subsensor', 'sat_id', 'sat_id_name'], ascending=[False, False, False])
@@ -9,6 +9,8 @@ import matplotlib.dates as mdates
 import os
 import argparse
 import obs_inv_utils.inventory_table_factory as itf
+import obs_inv_utils.obs_inv_queries as oiq
+from obs_inv_utils import connection_pools
 import plot_utils as utils
 
 #argparse section
@@ -17,6 +19,9 @@ parser.add_argument("-o", dest='out_dir', help="output directory for figures",de
 parser.add_argument("-dev", dest='dev', help='Use this flag to add a timestamp to the filename for development', default=False, type=bool)
 args = parser.parse_args()
 
+#the plot scripts read with a single connection
+connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
+
 #parameters
 daterange=[date(1975,1,1), date(2025,1,1)]
 
@@ -27,17 +32,11 @@ def select_typ(typ, db_frame):
     dftmp = db_frame.loc[db_frame['typ']==typ]
     return dftmp
 
-def get_sensor(row):
-    directory = row['parent_dir']
-    sensor = directory.split("/")[2]
-    return sensor
-
-
 #read data from sql database of obs counts
-db_frame = utils.get_distinct_prepbufr()
+db_frame = oiq.get_prepbufr_daily_counts()
 
 db_frame['datetime'] = pandas.to_datetime(db_frame.obs_day)
-db_frame['sensor'] = db_frame.apply(get_sensor, axis=1)
+#sensor, stream and source_dir are derived from parent_dir at ingest
 
 #loop and plot typ
 unique_typ = db_frame.drop_duplicates('typ').sort_values('typ', ascending=False)
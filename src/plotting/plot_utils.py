@@ -8,11 +8,13 @@ import os
 from datetime import datetime, date
 import glob
 import numpy as np
-from obs_inv_utils.inventory_table_factory import ObsMetaNceplibsBufr as omnb
-from obs_inv_utils.inventory_table_factory import ObsMetaNceplibsPrepbufr as omnp 
+from obs_inv_utils.inventory_table_factory import ObsMetaNceplibsBufrLatest as omnbl
+from obs_inv_utils.inventory_table_factory import ObsMetaNceplibsPrepbufrLatest as omnpl
 from obs_inv_utils.inventory_table_factory import ObsInventory as oi
 import obs_inv_utils.inventory_table_factory as itf
-from sqlalchemy.sql import func, or_
+import obs_inv_utils.obs_inv_queries as oiq
+from sqlalchemy import select
+from sqlalchemy.sql import or_
 
 #Dictionary of satellite names used for getting sat info files
 #For scripts to run successfully, they expect every sat we have data for to have a dictionary entry
@@ -128,122 +130,34 @@ def read_ozinfo_files(ozinfo_db_root,ozinfo_string):
     ozinfo.datetime = pandas.to_datetime(ozinfo.datetime)
     return ozinfo
 
-def get_distinct_bufr():
-    session = itf.Session()
-    # Subquery to get the most recent inserted_at for each combination of other columns
-    subquery = session.query(
-        omnb.obs_id,
-        omnb.sat_id,
-        omnb.sat_id_name,
-        omnb.obs_count,
-        omnb.sat_inst_id,
-        omnb.sat_inst_desc,
-        omnb.filename,
-        omnb.file_size,
-        omnb.obs_day,
-        func.max(omnb.inserted_at).label('max_inserted_at')
-    ).group_by(
-        omnb.obs_id,
-        omnb.sat_id,
-        omnb.sat_id_name,
-        omnb.obs_count,
-        omnb.sat_inst_id,
-        omnb.sat_inst_desc,
-        omnb.filename,
-        omnb.file_size,
-        omnb.obs_day
-    ).subquery()
+def read_plot_frame(statement):
+    #build the frame from the fetched rows with compact dtypes (categoricals for
+    #filename, parent_dir, s3_bucket and sat_id_name, 32 bit counts)
+    column_names = [selected.name for selected in statement.selected_columns]
+    return oiq.read_frame(statement, oiq.get_compact_dtypes(column_names))
 
-    # Join the subquery with the main table to get the full records
-    query = session.query(omnb.obs_id, omnb.filename, omnb.sat_id, omnb.sat_id_name, omnb.obs_count, omnb.obs_day, omnb.file_size, oi.parent_dir, oi.s3_bucket).join(
-        subquery,
-        (omnb.obs_id == subquery.c.obs_id) &
-        (omnb.sat_id == subquery.c.sat_id) &
-        (omnb.obs_count == subquery.c.obs_count) &
-        (omnb.sat_inst_id == subquery.c.sat_inst_id) &
-        (omnb.filename == subquery.c.filename) &
-        (omnb.file_size == subquery.c.file_size) &
-        (omnb.obs_day == subquery.c.obs_day) &
-        (omnb.inserted_at == subquery.c.max_inserted_at)
-    ).join(
+def get_distinct_bufr():
+    # Latest record of each bufr meta row, kept up to date by
+    # itf.insert_obs_meta_nceplibs_bufr_item
+    statement = select(omnbl.obs_id, omnbl.filename, omnbl.sat_id, omnbl.sat_id_name, omnbl.obs_count, omnbl.obs_day, omnbl.file_size, oi.parent_dir, oi.s3_bucket).join(
         oi,
-        omnb.obs_id == oi.obs_id
+        omnbl.obs_id == oi.obs_id
     ).filter(
         oi.s3_bucket == 'noaa-reanalyses-pds'
     )
 
-    # Execute the query
-    results = query.all()
-
-    # Convert results to a list of dictionaries
-    result_dicts = [
-        {
-            'obs_id': result.obs_id,
-            'filename': result.filename,
-            'sat_id': result.sat_id,
-            'sat_id_name': result.sat_id_name,
-            'obs_count': result.obs_count,
-            'obs_day': result.obs_day,
-            'file_size': result.file_size,
-            'parent_dir': result.parent_dir,
-            's3_bucket': result.s3_bucket
-        }
-        for result in results
-    ]
-
-    # Convert the list of dictionaries to a pandas DataFrame
-    df = pandas.DataFrame(result_dicts)
-
-    # Close the session
-    session.close()
-
-    return df
+    return read_plot_frame(statement)
 
 def get_distinct_bufr_by_sensors(sensor_list):
-    session = itf.Session()
-
-    # Subquery to get the most recent inserted_at for each combination of other columns
-    subquery = session.query(
-        omnb.obs_id,
-        omnb.sat_id,
-        omnb.sat_id_name,
-        omnb.obs_count,
-        omnb.sat_inst_id,
-        omnb.sat_inst_desc,
-        omnb.filename,
-        omnb.file_size,
-        omnb.obs_day,
-        func.max(omnb.inserted_at).label('max_inserted_at')
-    ).group_by(
-        omnb.obs_id,
-        omnb.sat_id,
-        omnb.sat_id_name,
-        omnb.obs_count,
-        omnb.sat_inst_id,
-        omnb.sat_inst_desc,
-        omnb.filename,
-        omnb.file_size,
-        omnb.obs_day
-    ).subquery()
-
-    # Join the subquery with the main table to get the full records
-    query = session.query(
-        omnb.obs_id, omnb.filename, omnb.sat_id, omnb.sat_id_name,
-        omnb.obs_count, omnb.obs_day, omnb.file_size, 
+    # Latest record of each bufr meta row, kept up to date by
+    # itf.insert_obs_meta_nceplibs_bufr_item
+    statement = select(
+        omnbl.obs_id, omnbl.filename, omnbl.sat_id, omnbl.sat_id_name,
+        omnbl.obs_count, omnbl.obs_day, omnbl.file_size, 
         oi.parent_dir, oi.s3_bucket
-    ).join(
-        subquery,
-        (omnb.obs_id == subquery.c.obs_id) &
-        (omnb.sat_id == subquery.c.sat_id) &
-        (omnb.obs_count == subquery.c.obs_count) &
-        (omnb.sat_inst_id == subquery.c.sat_inst_id) &
-        (omnb.filename == subquery.c.filename) &
-        (omnb.file_size == subquery.c.file_size) &
-        (omnb.obs_day == subquery.c.obs_day) &
-        (omnb.inserted_at == subquery.c.max_inserted_at)
     ).join(
         oi,
-        omnb.obs_id == oi.obs_id
+        omnbl.obs_id == oi.obs_id
     ).filter(
         oi.s3_bucket == 'noaa-reanalyses-pds'
     )
@@ -251,103 +165,19 @@ def get_distinct_bufr_by_sensors(sensor_list):
     # Add filter for parent_dir using LIKE with the sensor_list
     if sensor_list:
         sensor_filters = [oi.parent_dir.like(f"{sensor}%") for sensor in sensor_list]
-        query = query.filter(or_(*sensor_filters))
+        statement = statement.filter(or_(*sensor_filters))
 
-    # Execute the query
-    results = query.all()
-
-    # Convert results to a list of dictionaries
-    result_dicts = [
-        {
-            'obs_id': result.obs_id,
-            'filename': result.filename,
-            'sat_id': result.sat_id,
-            'sat_id_name': result.sat_id_name,
-            'obs_count': result.obs_count,
-            'obs_day': result.obs_day,
-            'file_size': result.file_size,
-            'parent_dir': result.parent_dir,
-            's3_bucket': result.s3_bucket
-        }
-        for result in results
-    ]
-
-    # Convert the list of dictionaries to a pandas DataFrame
-    df = pandas.DataFrame(result_dicts)
-
-    # Close the session
-    session.close()
-
-    return df
+    return read_plot_frame(statement)
 
 
 def get_distinct_prepbufr():
-    session = itf.Session()
-    # Subquery to get the most recent inserted_at for each combination of other columns
-    subquery = session.query(
-        omnp.obs_id,
-        omnp.variable,
-        omnp.typ,
-        omnp.tot,
-        omnp.qm0thru3,
-        omnp.filename,
-        omnp.file_size,
-        omnp.obs_day,
-        func.max(omnp.inserted_at).label('max_inserted_at')
-    ).group_by(
-        omnp.obs_id,
-        omnp.variable,
-        omnp.typ,
-        omnp.tot,
-        omnp.qm0thru3,
-        omnp.filename,
-        omnp.file_size,
-        omnp.obs_day
-    ).subquery()
-
-    # Join the subquery with the main table to get the full records
-    query = session.query(omnp.obs_id, omnp.variable, omnp.typ, omnp.tot, omnp.qm0thru3, omnp.filename, omnp.file_size, omnp.obs_day, oi.parent_dir, oi.s3_bucket).join(
-        subquery,
-        (omnp.obs_id == subquery.c.obs_id) &
-        (omnp.variable == subquery.c.variable) &
-        (omnp.typ == subquery.c.typ) &
-        (omnp.tot == subquery.c.tot) &
-        (omnp.qm0thru3 == subquery.c.qm0thru3) &
-        (omnp.filename == subquery.c.filename) &
-        (omnp.file_size == subquery.c.file_size) &
-        (omnp.obs_day == subquery.c.obs_day) &
-        (omnp.inserted_at == subquery.c.max_inserted_at)
-    ).join(
+    # Latest record of each prepbufr meta row, kept up to date by
+    # itf.insert_obs_meta_nceplibs_prepbufr_item
+    statement = select(omnpl.obs_id, omnpl.variable, omnpl.typ, omnpl.tot, omnpl.qm0thru3, omnpl.filename, omnpl.file_size, omnpl.obs_day, oi.parent_dir, oi.s3_bucket).join(
         oi,
-        omnp.obs_id == oi.obs_id
+        omnpl.obs_id == oi.obs_id
     ).filter(
         oi.s3_bucket == 'noaa-reanalyses-pds'
     )
 
-    # Execute the query
-    results = query.all()
-
-    # Convert results to a list of dictionaries
-    result_dicts = [
-        {
-            'obs_id': result.obs_id,
-            'variable': result.variable,
-            'typ': result.typ,
-            'tot': result.tot,
-            'qm0thru3': result.qm0thru3,
-            'filename': result.filename,
-            'file_size': result.file_size,
-            'obs_day': result.obs_day,
-            'parent_dir': result.parent_dir,
-            's3_bucket': result.s3_bucket
-        }
-        for result in results
-    ]
-
-    # Convert the list of dictionaries to a pandas DataFrame
-    df = pandas.DataFrame(result_dicts)
-
-    # Close the session
-    session.close()
-
-    return df
\ No newline at end of file
+    return read_plot_frame(statement)
@@ -5,6 +5,8 @@ All rights reserved.
 Unit tests for io_utils
 
 """
+import hashlib
+import io
 import os
 import pathlib
 import pytest
@@ -66,3 +68,173 @@ def test_search_engine__init():
     inv_search = se.ObsInventorySearchEngine(obs_conf)
 
     inv_search.get_obs_file_info()
+
+
+class StubPaginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages)
+
+
+class StubS3Client(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return StubPaginator(self.pages)
+
+
+def get_list_page(keys):
+    page = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+    if len(keys) > 0:
+        page['Contents'] = [{
+            'Key': key,
+            'LastModified': datetime(2022, 1, 1),
+            'ETag': '"abc"',
+            'Size': 10,
+            'StorageClass': 'STANDARD'
+        } for key in keys]
+    return page
+
+
+def test_send_pages__yields_every_page():
+    pages = [
+        get_list_page([f'{VALID_PREFIX_1}gdas.t00z.1bamua.tm00.bufr_d']),
+        get_list_page([f'{VALID_PREFIX_1}gdas.t00z.1bamub.tm00.bufr_d']),
+        get_list_page([])
+    ]
+    cmd = s3.AwsS3CommandHandler(
+        s3.CMD_GET_S3_OBJ_LIST_PAGES, [VALID_PREFIX_1])
+    cmd.client = StubS3Client(pages)
+
+    obs_cycle_time = datetime(2019, 8, 19)
+    results = []
+    for success in cmd.send_pages():
+        contents = cmd.parse_response(obs_cycle_time)
+        results.append((success, contents))
+
+    assert [success for success, _ in results] == [True, True, False]
+    assert results[0][1].listed_objects[0].name == 'gdas.t00z.1bamua.tm00.bufr_d'
+    assert results[1][1].listed_objects[0].name == 'gdas.t00z.1bamub.tm00.bufr_d'
+    assert results[2][1].files_count == 0
+
+
+def test_get_s3_client__shared_across_commands():
+    s3.clear_s3_clients()
+    client = s3.get_s3_client(BDP_BUCKET)
+    assert s3.get_bdp_s3_client() is client
+    assert client.meta.config.max_pool_connections == \
+        s3.DEFAULT_MAX_POOL_CONNECTIONS
+
+    cmd = s3.AwsS3CommandHandler(s3.CMD_GET_S3_OBJ_LIST, [VALID_PREFIX_1])
+    assert cmd.client is client
+
+    s3.clear_s3_clients()
+    with patch.dict(os.environ, {s3.MAX_POOL_CONNECTIONS_ENV: '4'}):
+        client = s3.get_s3_client(BDP_BUCKET)
+        assert client.meta.config.max_pool_connections == 4
+
+    s3.clear_s3_clients()
+    with patch.dict(os.environ, {s3.MAX_POOL_CONNECTIONS_ENV: 'foo'}):
+        with pytest.raises(ValueError):
+            s3.get_s3_client(BDP_BUCKET)
+    s3.clear_s3_clients()
+
+
+class StubDownloadClient(object):
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.ranges = []
+
+    def head_object(self, Bucket=None, Key=None):
+        return {'ContentLength': len(self.data), 'ETag': f'"{self.etag}"'}
+
+    def get_object(self, Bucket=None, Key=None, Range=None, IfMatch=None):
+        assert IfMatch == f'"{self.etag}"'
+        start, end = Range[len('bytes='):].split('-')
+        self.ranges.append((int(start), int(end)))
+        return {'Body': io.BytesIO(self.data[int(start):int(end) + 1])}
+
+
+def download(client, dest_path, part_size='7'):
+    with patch.dict(os.environ, {s3.DOWNLOAD_PART_SIZE_ENV: part_size,
+                                 s3.DOWNLOAD_CONCURRENCY_ENV: '3'}):
+        return s3.download_s3_object(
+            client, BDP_BUCKET, 'foo/bar.bufr_d', str(dest_path), 100)
+
+
+def test_download_s3_object__ranged_parts(tmp_path):
+    data = bytes(range(100))
+    client = StubDownloadClient(data)
+    dest_path = tmp_path / 'bar.bufr_d'
+
+    response = download(client, dest_path)
+
+    assert response['success']
+    assert dest_path.read_bytes() == data
+    assert len(client.ranges) == 15
+    assert client.ranges[-1] == (98, 99)
+    assert not os.path.exists(f'{dest_path}{s3.PARTIAL_DOWNLOAD_SUFFIX}')
+
+
+def test_download_s3_object__resumes_partial_file(tmp_path):
+    data = bytes(range(100))
+    client = StubDownloadClient(data)
+    dest_path = tmp_path / 'bar.bufr_d'
+    partial_path = tmp_path / f'bar.bufr_d{s3.PARTIAL_DOWNLOAD_SUFFIX}'
+    partial_path.write_bytes(data[:40])
+    etag_path = tmp_path / f'bar.bufr_d{s3.PARTIAL_DOWNLOAD_SUFFIX}' \
+                           f'{s3.PARTIAL_ETAG_SUFFIX}'
+    etag_path.write_text(client.etag)
+
+    response = download(client, dest_path, part_size='30')
+
+    assert response['success']
+    assert response['ResponseMetadata']['resumed_from'] == 40
+    assert client.ranges == [(40, 69), (70, 99)]
+    assert dest_path.read_bytes() == data
+    assert not os.path.exists(etag_path)
+
+
+def test_download_s3_object__partial_file_of_replaced_object(tmp_path):
+    data = bytes(range(100))
+    client = StubDownloadClient(data)
+    dest_path = tmp_path / 'bar.bufr_d'
+    partial_path = tmp_path / f'bar.bufr_d{s3.PARTIAL_DOWNLOAD_SUFFIX}'
+    etag_path = tmp_path / f'bar.bufr_d{s3.PARTIAL_DOWNLOAD_SUFFIX}' \
+                           f'{s3.PARTIAL_ETAG_SUFFIX}'
+    partial_path.write_bytes(bytes(40))
+    etag_path.write_text('f' * 32)
+
+    response = download(client, dest_path, part_size='50')
+
+    # the stale bytes are not reused, the object is downloaded again
+    assert response['success']
+    assert response['ResponseMetadata']['resumed_from'] == 0
+    assert client.ranges == [(0, 49), (50, 99)]
+    assert dest_path.read_bytes() == data
+
+    # a partial file without a recorded etag can not be trusted either
+    client.ranges = []
+    partial_path.write_bytes(bytes(40))
+    assert download(client, dest_path, part_size='50')['success']
+    assert client.ranges == [(0, 49), (50, 99)]
+
+
+def test_download_s3_object__etag_mismatch(tmp_path):
+    client = StubDownloadClient(bytes(range(100)), etag='0' * 32)
+    dest_path = tmp_path / 'bar.bufr_d'
+
+    response = download(client, dest_path)
+
+    assert not response['success']
+    assert not os.path.exists(dest_path)
+    assert not os.path.exists(f'{dest_path}{s3.PARTIAL_DOWNLOAD_SUFFIX}')
+
+    # multipart etags are not an md5, only the size is checked
+    client = StubDownloadClient(bytes(range(100)), etag='abc-2')
+    assert download(client, dest_path)['success']
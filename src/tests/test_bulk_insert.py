@@ -0,0 +1,82 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for bulk_insert
+
+"""
+from datetime import datetime
+
+from obs_inv_utils import bulk_insert
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+
+
+class RecordingConnection(object):
+
+    def __init__(self):
+        self.chunk_sizes = []
+
+    def execute(self, statement, rows):
+        self.chunk_sizes.append(len(rows))
+
+
+def test_adaptive_chunker__follows_rate():
+    chunker = bulk_insert.AdaptiveChunker(
+        max_rows=2000, target_seconds=1.0, rows=100)
+    # 1000 rows/s moves half way to 1000 rows
+    chunker.record(100, 0.1)
+    assert chunker.rows == 550
+    chunker.record(550, 0.01)
+    assert chunker.rows == 2000
+    # short chunks are ignored
+    chunker.record(10, 10.0)
+    assert chunker.rows == 2000
+    chunker.record(2000, 100.0)
+    assert chunker.rows == 1010
+
+    slow = bulk_insert.AdaptiveChunker(max_rows=2000, target_seconds=0.1)
+    slow.record(slow.rows, 60.0)
+    assert slow.rows == 250
+    for _ in range(5):
+        slow.record(slow.rows, 60.0)
+    assert slow.rows == bulk_insert.MIN_CHUNK_ROWS
+
+
+def test_get_chunker__capped_by_parameter_limit():
+    chunker = bulk_insert.get_chunker('test_table', 'mysql', 1000)
+    assert chunker.max_rows == 65
+    assert chunker.rows == 65
+    assert bulk_insert.get_chunker('test_table', 'mysql', 1000) is chunker
+
+
+def test_execute_in_chunks():
+    connection = RecordingConnection()
+    chunker = bulk_insert.AdaptiveChunker(max_rows=300, rows=120)
+    rows = [{'value': i} for i in range(1000)]
+    bulk_insert.execute_in_chunks(connection, None, rows, chunker)
+    assert sum(connection.chunk_sizes) == 1000
+    assert max(connection.chunk_sizes) <= 300
+
+
+def test_insert_obs_inv_items__above_parameter_limit():
+    run_tag = str(datetime.utcnow().timestamp())
+    now = datetime.utcnow()
+    files_meta = [
+        se.TarballFileMeta(
+            1, f'{run_tag}.{i}.bufr_d', 'test/bulk_insert/', platforms.AWS_S3,
+            'test-bucket', 'gdas', 't00z', 'test', 0, datetime(2020, 1, 1),
+            'bufr_d', 'tm00.bufr_d', False, i, '', now, now, 0.1, now, now,
+            'abc'
+        ) for i in range(3000)
+    ]
+    # 3000 rows of 22 columns is more values than sqlite binds at once
+    tbl_factory.insert_obs_inv_items(files_meta)
+    tbl_factory.insert_obs_inv_items(files_meta)
+
+    session = tbl_factory.Session()
+    count = session.query(tbl_factory.ObsInventory).filter(
+        tbl_factory.ObsInventory.filename.like(f'{run_tag}.%')).count()
+    session.close()
+    assert count == 3000
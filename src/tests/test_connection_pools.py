@@ -0,0 +1,108 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for connection_pools
+
+"""
+import threading
+import time
+
+import pytest
+import sqlalchemy as db
+from sqlalchemy.pool import NullPool
+
+from obs_inv_utils import connection_pools
+from obs_inv_utils import obs_storage_platforms as platforms
+
+
+def test_get_pool_options__profiles(monkeypatch):
+    monkeypatch.delenv(connection_pools.POOL_PROFILE_ENV, raising=False)
+    monkeypatch.setenv(
+        platforms.CONCURRENCY_LIMIT_ENV_PREFIX + 'AWS_S3', '32')
+    options = connection_pools.get_pool_options(
+        connection_pools.THREADED_PROFILE)
+    assert options['pool_size'] == 32
+    assert options['max_overflow'] == 16 + 2 + 4 + 1 + 1
+    assert options['pool_pre_ping']
+    assert options['pool_recycle'] == connection_pools.DEFAULT_POOL_RECYCLE
+
+    options = connection_pools.get_pool_options(
+        connection_pools.WORKER_PROFILE)
+    assert (options['pool_size'], options['max_overflow']) == (1, 1)
+
+    options = connection_pools.get_pool_options(
+        connection_pools.SHARED_PROFILE)
+    assert options['poolclass'] is NullPool
+
+    monkeypatch.setenv(connection_pools.POOL_SIZE_ENV, '5')
+    monkeypatch.setenv(connection_pools.POOL_RECYCLE_ENV, '60')
+    options = connection_pools.get_pool_options(
+        connection_pools.WORKER_PROFILE)
+    assert (options['pool_size'], options['pool_recycle']) == (5, 60)
+
+
+def test_get_pool_profile_name(monkeypatch):
+    monkeypatch.delenv(connection_pools.POOL_PROFILE_ENV, raising=False)
+    monkeypatch.setattr(connection_pools, '_run_mode',
+                        connection_pools.CLI_PROFILE)
+    connection_pools.set_run_mode(connection_pools.PLOTTING_PROFILE)
+    assert connection_pools.get_pool_profile_name() == \
+        connection_pools.PLOTTING_PROFILE
+
+    # the environment wins over the run mode
+    monkeypatch.setenv(connection_pools.POOL_PROFILE_ENV,
+                       connection_pools.WORKER_PROFILE)
+    assert connection_pools.get_pool_profile_name() == \
+        connection_pools.WORKER_PROFILE
+
+    monkeypatch.setenv(connection_pools.POOL_PROFILE_ENV, 'huge')
+    with pytest.raises(ValueError, match='huge'):
+        connection_pools.get_pool_profile_name()
+    with pytest.raises(ValueError, match='huge'):
+        connection_pools.set_run_mode('huge')
+
+
+def test_get_pool_host(monkeypatch):
+    monkeypatch.delenv(connection_pools.POOL_HOST_ENV, raising=False)
+    assert connection_pools.get_pool_host() is None
+    # an empty value, as in .env_example, is the same as unset
+    monkeypatch.setenv(connection_pools.POOL_HOST_ENV, '')
+    assert connection_pools.get_pool_host() is None
+    monkeypatch.setenv(connection_pools.POOL_HOST_ENV, 'proxy.example.com')
+    assert connection_pools.get_pool_host() == 'proxy.example.com'
+
+
+def test_metered_pool__counts_overflows_and_waits(tmp_path, monkeypatch):
+    monkeypatch.setenv(connection_pools.POOL_SIZE_ENV, '1')
+    monkeypatch.setenv(connection_pools.POOL_MAX_OVERFLOW_ENV, '1')
+    # metrics of their own, and no report at exit
+    monkeypatch.setattr(
+        connection_pools, 'pool_metrics', connection_pools.PoolMetrics())
+    monkeypatch.setattr(connection_pools, '_report_registered', True)
+    engine = db.create_engine(
+        f'sqlite:///{tmp_path / "pool.db"}',
+        connect_args={'check_same_thread': False},
+        **connection_pools.get_pool_options(connection_pools.CLI_PROFILE)
+    )
+    connection_pools.watch_pool(engine, 'test')
+
+    first = engine.connect()
+    second = engine.connect()
+    # the third checkout waits for a connection to be returned
+    waiter = threading.Thread(target=lambda: engine.connect().close())
+    waiter.start()
+    time.sleep(0.2)
+    first.close()
+    waiter.join()
+    second.close()
+    engine.dispose()
+
+    metrics = connection_pools.get_pool_metrics()
+    assert metrics['profile'] == 'test'
+    assert metrics['checkouts'] == 3
+    assert metrics['connects'] == 2
+    assert metrics['overflows'] == 1
+    assert metrics['waits'] == 1
+    assert metrics['max_wait_seconds'] >= 0.1
+    assert metrics['max_checked_out'] == 2
@@ -0,0 +1,177 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for db_migrations
+
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+import sqlalchemy as db
+from sqlalchemy import inspect, text
+from obs_inv_utils import db_migrations
+from obs_inv_utils import inventory_table_factory as tbl_factory
+
+
+def get_index_names(engine, table):
+    return {index['name'] for index in inspect(engine).get_indexes(table)}
+
+
+def test_orm_tables_include_indexes(tmp_path):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "orm.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+
+    assert db_migrations.get_missing_indexes(engine) == []
+    assert 'ix_obs_inventory_obs_day_filename' in \
+        get_index_names(engine, tbl_factory.OBS_INVENTORY_TABLE)
+
+
+def test_migrate__adds_missing_indexes(tmp_path):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE obs_inventory (obs_id INTEGER PRIMARY KEY, '
+            'filename VARCHAR, obs_day DATETIME, s3_bucket VARCHAR, '
+            'data_type VARCHAR, suffix VARCHAR)'
+        ))
+
+    expected = [
+        spec.name for spec in tbl_factory.INVENTORY_INDEXES
+        if spec.table == tbl_factory.OBS_INVENTORY_TABLE
+    ]
+    assert db_migrations.migrate(engine, dry_run=True) == expected
+    assert get_index_names(engine, tbl_factory.OBS_INVENTORY_TABLE) == set()
+
+    assert db_migrations.migrate(engine) == expected
+    assert get_index_names(
+        engine, tbl_factory.OBS_INVENTORY_TABLE) == set(expected)
+    assert db_migrations.migrate(engine) == []
+
+
+def test_get_create_index_sql__mysql_is_online():
+    spec = tbl_factory.INVENTORY_INDEXES[0]
+    sql = db_migrations.get_create_index_sql(spec, 'mysql')
+    assert sql.startswith(f'CREATE INDEX {spec.name} ON {spec.table}')
+    assert 'LOCK=NONE' in sql
+
+
+def test_backfill_generic_filenames(tmp_path):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "backfill.db"}')
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE obs_inventory (obs_id INTEGER PRIMARY KEY, '
+            'filename VARCHAR, obs_day DATETIME)'
+        ))
+        connection.execute(text(
+            "INSERT INTO obs_inventory (filename) VALUES "
+            "('gdas.20200101.t00z.airsev.tm00.bufr_d'), "
+            "('gdas.t06z.1bamua.tm00.bufr_d'), (NULL)"
+        ))
+
+    assert db_migrations.backfill_generic_filenames(engine, batch_size=2) == 2
+    with engine.begin() as connection:
+        generic_filenames = [row[0] for row in connection.execute(text(
+            'SELECT generic_filename FROM obs_inventory ORDER BY obs_id'))]
+    assert generic_filenames == [
+        'gdas.*.airsev.tm00.bufr_d', 'gdas.*.1bamua.tm00.bufr_d', None]
+
+
+def test_backfill_parent_dir_columns(tmp_path):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "backfill.db"}')
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE obs_inventory (obs_id INTEGER PRIMARY KEY, '
+            'parent_dir VARCHAR, obs_day DATETIME)'
+        ))
+        connection.execute(text(
+            "INSERT INTO obs_inventory (parent_dir) VALUES "
+            "('observations/reanalysis/amv/nesdis/2020/01/bufr/'), "
+            "('observations/reanalysis/gps/2020/01/bufr/'), (NULL)"
+        ))
+
+    assert db_migrations.backfill_parent_dir_columns(
+        engine, batch_size=2) == 2
+    with engine.begin() as connection:
+        rows = [tuple(row) for row in connection.execute(text(
+            'SELECT sensor, stream, source_dir FROM obs_inventory '
+            'ORDER BY obs_id'))]
+    assert rows == [
+        ('amv', 'nesdis', '/amv/nesdis'),
+        ('gps', '2020', '/gps'),
+        (None, None, None)
+    ]
+    # neither the rows filled in nor the NULL parent_dir row are selected
+    # again
+    assert db_migrations.backfill_parent_dir_columns(engine) == 0
+
+
+def test_engine_is_created_on_first_use(tmp_path):
+    database = tmp_path / 'lazy.db'
+    script = (
+        'import os\n'
+        'from obs_inv_utils import inventory_table_factory as itf\n'
+        'from obs_inv_utils import obs_inv_queries\n'
+        f'assert not os.path.exists({str(database)!r})\n'
+        'assert itf._engine is None\n'
+        'engine = itf.get_engine()\n'
+        'assert itf.engine is engine and itf.get_engine() is engine\n'
+        'assert itf.Session().bind is engine\n'
+        f'assert os.path.exists({str(database)!r})\n'
+    )
+    env = dict(os.environ, DATABASE_TYPE='sqlite', SQLITE_DATABASE=str(database))
+    result = subprocess.run(
+        [sys.executable, '-c', script], env=env, capture_output=True,
+        text=True, cwd=Path(__file__).resolve().parents[1]
+    )
+    assert result.returncode == 0, result.stderr
+    assert tbl_factory.OBS_INVENTORY_TABLE in inspect(
+        db.create_engine(f'sqlite:///{database}')).get_table_names()
+
+
+class StubLockConnection(object):
+    def __init__(self, locked):
+        self.locked = locked
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def execute(self, statement, params=None):
+        self.statements.append(str(statement))
+        locked = self.locked
+
+        class Result(object):
+            def scalar(self):
+                return locked
+        return Result()
+
+
+class StubMysqlEngine(object):
+    def __init__(self, locked):
+        self.dialect = type('Dialect', (), {'name': 'mysql'})()
+        self.connection = StubLockConnection(locked)
+
+    def connect(self):
+        return self.connection
+
+
+def test_schema_lock__mysql_lock_not_granted():
+    for locked in [0, None]:
+        engine = StubMysqlEngine(locked)
+        with pytest.raises(ValueError, match='schema lock'):
+            with tbl_factory.schema_lock(engine):
+                assert False, 'the schema must not be created unlocked'
+        assert not any('RELEASE_LOCK' in statement
+                       for statement in engine.connection.statements)
+
+    engine = StubMysqlEngine(1)
+    with tbl_factory.schema_lock(engine):
+        pass
+    assert 'RELEASE_LOCK' in engine.connection.statements[-1]
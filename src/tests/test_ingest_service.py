@@ -0,0 +1,89 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for ingest_service
+
+"""
+import threading
+from datetime import datetime
+
+import pytest
+
+from obs_inv_utils import ingest_service
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+
+
+def get_test_files_meta(filename, obs_day):
+    now = datetime.utcnow()
+    return se.TarballFileMeta(
+        None, filename, 'test/ingest_service/', platforms.AWS_S3,
+        'test-bucket', 'gdas', 't00z', 'test', 0, obs_day, 'bufr_d',
+        'tm00.bufr_d', False, 10, '', now, now, 0.1, now, now, 'abc'
+    )
+
+
+@pytest.fixture
+def ingest_writer(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'ingest.sock')
+    writer = ingest_service.IngestWriter(batch_size=100, linger=0.2)
+    server = ingest_service.IngestServer(socket_path, writer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv(ingest_service.INGEST_SOCKET_ENV, socket_path)
+    yield writer
+    server.shutdown()
+    server.server_close()
+
+
+def test_ingest_writer__merges_requests(ingest_writer):
+    run_tag = str(datetime.utcnow().timestamp())
+    obs_day = datetime(2020, 1, 1)
+    cmd_ids = {}
+
+    def post_result(i):
+        cmd_result_data = tbl_factory.CmdResultData(
+            'list_objects', f'{run_tag}/{i}', '{}', '', 200, obs_day,
+            datetime.utcnow(), 0.1, datetime.utcnow())
+        files_meta = [
+            get_test_files_meta(f'{run_tag}.{i}.{j}.bufr_d', obs_day)
+            for j in range(i)
+        ]
+        cmd_ids[i] = se.post_search_result(cmd_result_data, files_meta)
+
+    threads = [threading.Thread(target=post_result, args=(i,))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(cmd_ids.values())) == 6
+    assert all(isinstance(cmd_id, int) for cmd_id in cmd_ids.values())
+    # 6 cmd results and 5 lists of files, written in fewer transactions
+    assert ingest_writer.request_count == 11
+    assert ingest_writer.batch_count < 11
+
+    session = tbl_factory.Session()
+    rows = session.query(
+        tbl_factory.ObsInventory.filename,
+        tbl_factory.ObsInventory.cmd_result_id
+    ).filter(
+        tbl_factory.ObsInventory.filename.like(f'{run_tag}.%')
+    ).all()
+    session.close()
+    assert len(rows) == 15
+    for filename, cmd_result_id in rows:
+        assert cmd_result_id == cmd_ids[int(filename.split('.')[-3])]
+
+
+def test_ingest_writer__returns_errors(ingest_writer):
+    with pytest.raises(ValueError, match='TypeError'):
+        tbl_factory.insert_obs_inv_items('not a list')
+
+    client = ingest_service.get_ingest_client(
+        ingest_service.get_ingest_socket())
+    with pytest.raises(ValueError, match='can not be run'):
+        client.call('populate_latest_tables', None)
@@ -8,6 +8,7 @@ Unit tests for io_utils
 import os
 import pathlib
 import pytest
+import pandas
 from datetime import datetime, timedelta
 from collections import namedtuple, OrderedDict
 import obs_inv_utils
@@ -15,6 +16,7 @@ import config_handlers
 from config_handlers.obs_search_conf import ObservationsConfig
 from obs_inv_utils import time_utils
 from obs_inv_utils import search_engine as se
+from obs_inv_utils import obs_storage_platforms as platforms
 from tests.cmd_outputs import hpss_cmd_helpers as hpss_helpers
 from unittest.mock import patch
 import subprocess
@@ -155,3 +157,784 @@ def test_get_combined_suffix():
 
     parts = str('gdas.t18z.adpsfc').split('.')
     assert se.get_combined_suffix(parts) == None
+
+
+def test_get_generic_filename():
+    generic_filename = 'gdas.*.airsev.tm00.bufr_d'
+    assert se.get_generic_filename(
+        'gdas.20200101.t00z.airsev.tm00.bufr_d') == generic_filename
+    assert se.get_generic_filename(
+        'gdas.t06z.airsev.tm00.bufr_d') == generic_filename
+    assert se.get_generic_filename(
+        'gdas.%z.airsev.tm00.bufr_d') == generic_filename
+    assert se.get_generic_filename(
+        'gdas.t%z.airsev.tm00.bufr_d') == generic_filename
+    assert se.get_generic_filename('gmao.amsr2_gw1.20200101_00z.bufr') == \
+        se.get_generic_filename('gmao.amsr2_gw1.%z.bufr')
+    assert se.get_generic_filename('gdas.%z.air%.tm00.bufr_d') is None
+    assert se.get_generic_filename(None) is None
+
+
+def test_get_parent_dir_columns():
+    parent_dir = 'observations/reanalysis/ozone/nasa/omi/2020/01/bufr/'
+    assert se.get_sensor(parent_dir) == 'ozone'
+    assert se.get_stream(parent_dir) == 'nasa'
+    assert se.get_source_dir(parent_dir) == '/ozone/nasa/omi'
+    assert se.get_sensor('gdas.20200101/') is None
+    assert se.get_source_dir(None) is None
+    row = se.tbl_factory.get_obs_inv_rows([get_test_files_meta(
+        'gdas.t00z.1bamua.tm00.bufr_d', datetime(2020, 1, 1)
+    )._replace(parent_dir=parent_dir)])[0]
+    assert (row['sensor'], row['stream'], row['source_dir']) == \
+        ('ozone', 'nasa', '/ozone/nasa/omi')
+
+
+def test_get_search_cycle_times():
+    date_range = time_utils.DateRange(
+        datetime(2020, 1, 1, 0), datetime(2020, 1, 2, 0))
+    cycle_times = se.get_search_cycle_times(
+        date_range, se.get_cycle_increment(platforms.AWS_S3))
+    assert cycle_times == [
+        datetime(2020, 1, 1, 0),
+        datetime(2020, 1, 1, 6),
+        datetime(2020, 1, 1, 12),
+        datetime(2020, 1, 1, 18)
+    ]
+    # the date range itself must not be advanced
+    assert date_range.current == datetime(2020, 1, 1, 0)
+
+    cycle_times = se.get_search_cycle_times(
+        date_range, se.get_cycle_increment(platforms.HERA_HPSS))
+    assert cycle_times == [datetime(2020, 1, 1, 0)]
+
+
+def test_get_concurrency_limit():
+    assert platforms.get_concurrency_limit(platforms.AWS_S3) == \
+        platforms.CONCURRENCY_LIMITS[platforms.AWS_S3]
+
+    with patch.dict(os.environ, {'OBS_INV_MAX_WORKERS_HERA_HPSS': '5'}):
+        assert platforms.get_concurrency_limit(platforms.HERA_HPSS) == 5
+
+    with patch.dict(os.environ, {'OBS_INV_MAX_WORKERS_DISCOVER': '0'}):
+        with pytest.raises(ValueError):
+            platforms.get_concurrency_limit(platforms.DISCOVER)
+
+
+def test_search_engine__concurrent_visits_every_cycle():
+    conf_filepath = os.path.join(
+        PYTEST_CALLING_DIR,
+        CONFIGS_DIR,
+        OBS_INV_YAML_CONFIG__VALID
+    )
+
+    obs_conf = ObservationsConfig(conf_filepath)
+    obs_conf.load()
+    inv_search = se.ObsInventorySearchEngine(obs_conf, concurrent=True)
+
+    expected = set()
+    for key, search_config in inv_search.search_configs.items():
+        cycle_times = se.get_search_cycle_times(
+            search_config.get_date_range(),
+            se.get_cycle_increment(search_config.get_storage_platform())
+        )
+        expected.update((key, cycle_time) for cycle_time in cycle_times)
+
+    visited = set()
+    def fake_search_cycle(self, search_config, cycle_time):
+        key = f'{search_config.get_storage_platform()}-' \
+              f'{search_config.search_config["key"]}'
+        visited.add((key, cycle_time))
+
+    with patch.object(
+        se.ObsInventorySearchEngine, 'search_cycle', fake_search_cycle
+    ):
+        inv_search.get_obs_file_info()
+
+    assert len(expected) > 0
+    assert visited == expected
+    for search_config in inv_search.search_configs.values():
+        assert search_config.get_date_range().at_end()
+
+
+CLEAN_KEY = 'observations/reanalysis/airs/airsev/%Y/%m/bufr/' \
+            'gdas.%Y%m%d.t%Hz.airsev.tm00.bufr_d'
+
+
+def get_clean_search_config(start, end):
+    date_range = time_utils.DateRange(start, end)
+    return config_handlers.obs_search_conf.ObsSearchConfig(
+        platforms.AWS_S3_CLEAN,
+        {'platform': platforms.AWS_S3_CLEAN, 'key': CLEAN_KEY,
+         'listing': 'prefix'},
+        date_range
+    )
+
+
+def test_obs_search_config__listing_mode():
+    search_config = get_clean_search_config(
+        datetime(2020, 1, 1), datetime(2020, 1, 2))
+    assert search_config.uses_prefix_listing()
+
+    with pytest.raises(ValueError):
+        config_handlers.obs_search_conf.ObsSearchConfig(
+            platforms.HERA_HPSS,
+            {'key': '/foo/%Y/bar.tar', 'listing': 'prefix'},
+            time_utils.DateRange(datetime(2020, 1, 1), datetime(2020, 1, 2))
+        )
+
+
+def test_group_cycles_by_prefix():
+    search_config = get_clean_search_config(
+        datetime(2020, 1, 31, 12), datetime(2020, 2, 1, 12))
+    increment = se.get_cycle_increment(platforms.AWS_S3_CLEAN)
+    cycle_times = se.get_search_cycle_times(
+        search_config.get_date_range(), increment)
+
+    groups = se.group_cycles_by_prefix(search_config, cycle_times)
+    assert groups == [
+        [datetime(2020, 1, 31, 12), datetime(2020, 1, 31, 18)],
+        [datetime(2020, 2, 1, 0), datetime(2020, 2, 1, 6)]
+    ]
+    assert se.get_prefix_cycle_times(search_config, increment) == groups[0]
+
+
+def test_search_aws_s3_clean_prefix__matches_cycles():
+    search_config = get_clean_search_config(
+        datetime(2020, 1, 1, 0), datetime(2020, 1, 1, 18))
+    cycle_times = se.get_search_cycle_times(
+        search_config.get_date_range(),
+        se.get_cycle_increment(platforms.AWS_S3_CLEAN)
+    )
+    cycle_keys = [(t, search_config.get_search_path(t)) for t in cycle_times]
+    prefix = se.get_listing_prefix(cycle_keys[0][1])
+    assert prefix == 'observations/reanalysis/airs/airsev/2020/01/bufr/'
+
+    # only the 00z and 12z cycles exist in the bucket
+    page = {
+        'ResponseMetadata': {'HTTPStatusCode': 200},
+        'Contents': [{
+            'Key': cycle_keys[i][1],
+            'LastModified': datetime(2022, 1, 1),
+            'ETag': '"abc"',
+            'Size': 10,
+            'StorageClass': 'STANDARD'
+        } for i in (0, 2)]
+    }
+
+    class StubPaginator(object):
+        def paginate(self, **kwargs):
+            assert kwargs['Prefix'] == prefix
+            return iter([page])
+
+    class StubS3Client(object):
+        def get_paginator(self, operation_name):
+            return StubPaginator()
+
+    posted = []
+    def fake_post(cmd_result_data, files_meta, ingest=None):
+        posted.append((
+            cmd_result_data.arg0,
+            cmd_result_data.error_code,
+            [file_meta.filename for file_meta in files_meta]
+        ))
+        return len(posted)
+
+    def get_stub_client(*args, **kwargs):
+        return StubS3Client()
+
+    with patch.object(se.s3, 'get_s3_client', get_stub_client), \
+            patch.object(se, 'post_search_result', fake_post):
+        se.search_aws_s3_clean_prefix(prefix, cycle_keys)
+
+    assert posted == [
+        (cycle_keys[0][1], 200, [os.path.basename(cycle_keys[0][1])]),
+        (cycle_keys[1][1], 404, []),
+        (cycle_keys[2][1], 200, [os.path.basename(cycle_keys[2][1])])
+    ]
+
+
+def test_search_aws_s3_clean_prefix__failed_page(monkeypatch):
+    search_config = get_clean_search_config(
+        datetime(2020, 1, 1, 0), datetime(2020, 1, 1, 12))
+    cycle_times = se.get_search_cycle_times(
+        search_config.get_date_range(),
+        se.get_cycle_increment(platforms.AWS_S3_CLEAN)
+    )
+    cycle_keys = [(t, search_config.get_search_path(t)) for t in cycle_times]
+    prefix = se.get_listing_prefix(cycle_keys[0][1])
+
+    class StubPaginator(object):
+        def paginate(self, **kwargs):
+            return iter([{'ResponseMetadata': {'HTTPStatusCode': 503}}])
+
+    class StubS3Client(object):
+        def get_paginator(self, operation_name):
+            return StubPaginator()
+
+    monkeypatch.setattr(
+        se.s3, 'get_s3_client', lambda *args, **kwargs: StubS3Client())
+    monkeypatch.setattr(
+        se, 'post_search_result', lambda *args, **kwargs: None)
+    failed_cycles = []
+    se.search_aws_s3_clean_prefix(
+        prefix, cycle_keys, failed_cycles=failed_cycles)
+    assert failed_cycles == cycle_times
+
+
+def test_get_resume_cycle_time():
+    date_range = time_utils.DateRange(
+        datetime(2020, 1, 1, 0), datetime(2020, 1, 10, 0))
+    increment = se.get_cycle_increment(platforms.AWS_S3_CLEAN)
+
+    assert se.get_resume_cycle_time(
+        date_range, datetime(2020, 1, 5, 6), increment) == \
+        datetime(2020, 1, 5, 12)
+    # the look-back window is rounded down onto the cycle grid
+    assert se.get_resume_cycle_time(
+        date_range, datetime(2020, 1, 5, 6), increment, 9) == \
+        datetime(2020, 1, 5, 0)
+    assert se.get_resume_cycle_time(
+        date_range, datetime(2019, 1, 1), increment) == date_range.start
+    assert se.get_resume_cycle_time(
+        date_range, datetime(2021, 1, 1), increment) == date_range.end
+
+
+def test_search_engine__incremental_watermarks():
+    conf_filepath = os.path.join(
+        PYTEST_CALLING_DIR,
+        CONFIGS_DIR,
+        OBS_INV_YAML_CONFIG__VALID
+    )
+
+    watermarks = {}
+    def fake_get_watermark(platform, search_key):
+        return watermarks.get((platform, search_key))
+
+    def fake_upsert_watermark(platform, search_key, last_cycle):
+        watermarks[(platform, search_key)] = last_cycle
+
+    visited = []
+    def fake_search_cycle(self, search_config, cycle_time):
+        visited.append(cycle_time)
+
+    with patch.object(se.tbl_factory, 'get_inventory_watermark',
+                      fake_get_watermark), \
+            patch.object(se.tbl_factory, 'upsert_inventory_watermark',
+                         fake_upsert_watermark), \
+            patch.object(se.ObsInventorySearchEngine, 'search_cycle',
+                         fake_search_cycle):
+        obs_conf = ObservationsConfig(conf_filepath)
+        obs_conf.load()
+        se.ObsInventorySearchEngine(obs_conf, incremental=True)\
+            .get_obs_file_info()
+        full_run = list(visited)
+        assert len(full_run) > 1
+        assert list(watermarks.values()) == [max(full_run)]
+
+        # nothing new since the watermark, only the look-back is searched
+        visited.clear()
+        obs_conf = ObservationsConfig(conf_filepath)
+        obs_conf.load()
+        se.ObsInventorySearchEngine(
+            obs_conf, incremental=True, lookback_hours=6
+        ).get_obs_file_info()
+        assert visited == [max(full_run)]
+        assert list(watermarks.values()) == [max(full_run)]
+
+
+def test_search_engine__watermark_held_before_failed_cycle(tmp_path):
+    conf_filepath = os.path.join(
+        PYTEST_CALLING_DIR,
+        CONFIGS_DIR,
+        OBS_INV_YAML_CONFIG__VALID
+    )
+
+    watermarks = {}
+    def fake_get_watermark(platform, search_key):
+        return watermarks.get((platform, search_key))
+
+    def fake_upsert_watermark(platform, search_key, last_cycle):
+        watermarks[(platform, search_key)] = last_cycle
+
+    visited = []
+    def failing_send_search_cycle(self, search_config, cycle_time):
+        visited.append(cycle_time)
+        if len(visited) == 2:
+            self.record_failed_cycles(search_config, [cycle_time])
+
+    journal_path = str(tmp_path / 'progress.jsonl')
+    with patch.object(se.tbl_factory, 'get_inventory_watermark',
+                      fake_get_watermark), \
+            patch.object(se.tbl_factory, 'upsert_inventory_watermark',
+                         fake_upsert_watermark), \
+            patch.object(se.ObsInventorySearchEngine, 'send_search_cycle',
+                         failing_send_search_cycle):
+        obs_conf = ObservationsConfig(conf_filepath)
+        obs_conf.load()
+        inv_search = se.ObsInventorySearchEngine(
+            obs_conf, incremental=True,
+            journal=se.ProgressJournal(journal_path))
+        inv_search.get_obs_file_info()
+
+    assert len(visited) > 2
+    # the failed cycle and the ones after it are searched again
+    assert list(watermarks.values()) == [visited[0]]
+    search_config = list(inv_search.search_configs.values())[0]
+    journal = se.ProgressJournal(journal_path)
+    assert journal.is_complete(
+        inv_search.get_cycle_unit(search_config, visited[0]))
+    assert not journal.is_complete(
+        inv_search.get_cycle_unit(search_config, visited[1]))
+
+
+def test_is_failed_search():
+    def get_raw_resp(status_code, success):
+        return se.AwsS3CommandRawResponse(
+            'list', 404, {'ResponseMetadata': {'HTTPStatusCode': status_code}},
+            success, 'key', datetime(2020, 1, 1), 0.1)
+
+    assert not se.is_failed_search(get_raw_resp(200, True))
+    # listed, but no objects
+    assert not se.is_failed_search(get_raw_resp(200, False))
+    assert se.is_failed_search(get_raw_resp(503, False))
+
+
+@pytest.fixture
+def sqlite_database(tmp_path, monkeypatch):
+    tbl_factory = se.tbl_factory
+    database = tmp_path / 'inventory.db'
+    monkeypatch.setenv('DATABASE_TYPE', 'sqlite')
+    monkeypatch.setenv('SQLITE_DATABASE', str(database))
+    monkeypatch.delenv(tbl_factory.SHARD_DIR_ENV, raising=False)
+    tbl_factory.dispose_engine()
+    yield database
+    tbl_factory.dispose_engine()
+
+
+def test_inventory_watermark__upsert(sqlite_database):
+    tbl_factory = se.tbl_factory
+    # longer than a MySQL unique index on the key itself allows
+    search_key = 'test/%Y/%m/' + 'x' * 1000
+    assert tbl_factory.get_inventory_watermark(
+        platforms.AWS_S3_CLEAN, search_key) is None
+
+    tbl_factory.upsert_inventory_watermark(
+        platforms.AWS_S3_CLEAN, search_key, datetime(2020, 1, 1, 6))
+    tbl_factory.upsert_inventory_watermark(
+        platforms.AWS_S3_CLEAN, search_key, datetime(2020, 1, 2, 18))
+    assert tbl_factory.get_inventory_watermark(
+        platforms.AWS_S3_CLEAN, search_key) == datetime(2020, 1, 2, 18)
+    assert tbl_factory.get_inventory_watermark(
+        platforms.AWS_S3, search_key) is None
+
+
+def test_get_start_after_key():
+    search_config = get_clean_search_config(
+        datetime(2020, 1, 1, 0), datetime(2020, 1, 31, 0))
+    cycle_keys = [
+        (t, search_config.get_search_path(t))
+        for t in [datetime(2020, 1, 5, 12), datetime(2020, 1, 5, 18)]
+    ]
+    assert se.get_start_after_key(search_config, cycle_keys) == \
+        search_config.get_search_path(datetime(2020, 1, 5, 6))
+
+    # the previous cycle is in the prior month's prefix
+    cycle_keys = [(datetime(2020, 1, 1, 0),
+                   search_config.get_search_path(datetime(2020, 1, 1, 0)))]
+    assert se.get_start_after_key(search_config, cycle_keys) is None
+
+
+def get_test_files_meta(filename, obs_day):
+    now = datetime.utcnow()
+    return se.TarballFileMeta(
+        None, filename, 'test/ingest/', platforms.AWS_S3, 'test-bucket',
+        'gdas', 't00z', 'test', 0, obs_day, 'bufr_d', 'tm00.bufr_d', False,
+        10, '', now, now, 0.1, now, now, 'abc'
+    )
+
+
+def test_ingest_buffer__assigns_cmd_result_ids():
+    tbl_factory = se.tbl_factory
+    run_tag = str(datetime.utcnow().timestamp())
+    obs_day = datetime(2020, 1, 1)
+
+    with se.IngestBuffer(batch_size=2, flush_interval=0.1) as ingest:
+        for i in range(3):
+            cmd_result_data = tbl_factory.CmdResultData(
+                'list_objects', f'{run_tag}/{i}', '{}', '', 200, obs_day,
+                datetime.utcnow(), 0.1, datetime.utcnow())
+            files_meta = [
+                get_test_files_meta(f'{run_tag}.{i}.{j}.bufr_d', obs_day)
+                for j in range(i)
+            ]
+            assert se.post_search_result(
+                cmd_result_data, files_meta, ingest) is None
+
+    assert ingest.flushed_count == 3
+
+    session = tbl_factory.Session()
+    cmd_ids = dict(session.query(
+        tbl_factory.CmdResult.arg0, tbl_factory.CmdResult.cmd_result_id
+    ).filter(tbl_factory.CmdResult.arg0.like(f'{run_tag}/%')).all())
+    obs_items = session.query(
+        tbl_factory.ObsInventory.filename,
+        tbl_factory.ObsInventory.cmd_result_id
+    ).filter(tbl_factory.ObsInventory.filename.like(f'{run_tag}.%')).all()
+    session.close()
+
+    assert len(cmd_ids) == 3
+    assert len(obs_items) == 3
+    for filename, cmd_result_id in obs_items:
+        i = filename.split('.')[-3]
+        assert cmd_result_id == cmd_ids[f'{run_tag}/{i}']
+
+
+def test_ingest_buffer__write_error_raised_on_close():
+    def failing_insert(cmd_results):
+        raise RuntimeError('database is gone')
+
+    with patch.object(se.tbl_factory, 'insert_cmd_results_with_obs_inv_items',
+                      failing_insert):
+        ingest = se.IngestBuffer(batch_size=1, flush_interval=0.1)
+        ingest.add(None, [])
+        with pytest.raises(ValueError):
+            ingest.close()
+
+
+def test_ingest_buffer__error_in_block_not_masked():
+    def failing_insert(cmd_results):
+        raise RuntimeError('database is gone')
+
+    with patch.object(se.tbl_factory, 'insert_cmd_results_with_obs_inv_items',
+                      failing_insert):
+        with pytest.raises(KeyError):
+            with se.IngestBuffer(batch_size=1, flush_interval=0.1) as ingest:
+                assert ingest.pending.maxsize == \
+                    obs_inv_utils.ingest_buffer.QUEUED_BATCHES
+                ingest.add(None, [])
+                raise KeyError('search failed')
+        assert ingest.error is not None
+
+
+class FailingParseHandler(object):
+    def __init__(self, command, args):
+        self.args = args
+
+    def send_pages(self):
+        yield True
+
+    def get_raw_response(self):
+        return None
+
+    def parse_response(self, obs_cycle_time):
+        raise ValueError('unexpected listing')
+
+
+def test_search_aws_s3_prefix__posts_result_when_parse_fails():
+    posted = []
+    def fake_post(cmd_result_data, files_meta, ingest=None):
+        posted.append((cmd_result_data, files_meta))
+        return len(posted)
+
+    with patch.object(se.s3, 'AwsS3CommandHandler', FailingParseHandler), \
+            patch.object(se, 'get_aws_s3_cmd_result_data',
+                         lambda raw_resp, obs_cycle_time: 'cmd_result'), \
+            patch.object(se, 'post_search_result', fake_post):
+        with pytest.raises(ValueError):
+            se.search_aws_s3_prefix(['prefix/'], datetime(2020, 1, 1))
+
+    assert posted == [('cmd_result', [])]
+
+
+def test_progress_journal__truncated_line(tmp_path):
+    journal_path = str(tmp_path / 'progress.jsonl')
+    first = ('search', platforms.AWS_S3, 'key', datetime(2020, 1, 1, 0))
+    second = ('search', platforms.AWS_S3, 'key', datetime(2020, 1, 1, 6))
+
+    se.ProgressJournal(journal_path).mark_complete([first])
+    # simulate a crash part way through writing a line
+    with open(journal_path, 'a') as journal_file:
+        journal_file.write('{"unit": ["search", "aws')
+
+    journal = se.ProgressJournal(journal_path)
+    assert journal.is_complete(first)
+    assert not journal.is_complete(second)
+
+    journal.mark_complete([second])
+    journal = se.ProgressJournal(journal_path)
+    assert journal.is_complete(first)
+    assert journal.is_complete(second)
+
+
+def test_search_engine__journal_restart_skips_completed(tmp_path):
+    conf_filepath = os.path.join(
+        PYTEST_CALLING_DIR,
+        CONFIGS_DIR,
+        OBS_INV_YAML_CONFIG__VALID
+    )
+    journal_path = str(tmp_path / 'progress.jsonl')
+
+    visited = []
+    def crashing_send_search_cycle(self, search_config, cycle_time):
+        if len(visited) == 2:
+            raise RuntimeError('preempted')
+        visited.append(cycle_time)
+
+    obs_conf = ObservationsConfig(conf_filepath)
+    obs_conf.load()
+    inv_search = se.ObsInventorySearchEngine(
+        obs_conf, journal=se.ProgressJournal(journal_path))
+    with patch.object(se.ObsInventorySearchEngine, 'send_search_cycle',
+                      crashing_send_search_cycle):
+        with pytest.raises(RuntimeError):
+            inv_search.get_obs_file_info()
+    completed = list(visited)
+
+    visited.clear()
+    def send_search_cycle(self, search_config, cycle_time):
+        visited.append(cycle_time)
+
+    obs_conf = ObservationsConfig(conf_filepath)
+    obs_conf.load()
+    inv_search = se.ObsInventorySearchEngine(
+        obs_conf, journal=se.ProgressJournal(journal_path))
+    with patch.object(se.ObsInventorySearchEngine, 'send_search_cycle',
+                      send_search_cycle):
+        inv_search.get_obs_file_info()
+
+    assert len(completed) == 2
+    assert len(visited) > 0
+    assert set(completed).isdisjoint(visited)
+
+
+def test_get_bufr_files_data__generic_filename():
+    from obs_inv_utils import obs_inv_queries as oiq
+    data_type = f'q{int(datetime.utcnow().timestamp() * 1000)}'
+    obs_inv_items = [
+        get_test_files_meta(
+            f'gdas.t{hour:02d}z.{data_type}.tm00.bufr_d',
+            datetime(2020, 1, day)
+        )._replace(cmd_result_id=1, parent_dir=f'test/202001{day:02d}/')
+        for day in [1, 2, 3] for hour in [0, 6]
+    ]
+    se.tbl_factory.insert_obs_inv_items(obs_inv_items)
+
+    files = oiq.get_bufr_files_data(
+        [f'gdas.t%z.{data_type}.tm00.bufr_d'],
+        datetime(2020, 1, 2), datetime(2020, 1, 3)
+    )
+    assert len(files) == 4
+    assert set(files.obs_day) == {datetime(2020, 1, 2), datetime(2020, 1, 3)}
+
+    files = oiq.get_bufr_files_data(
+        [f'gdas.t06z.{data_type}.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2020, 1, 3)
+    )
+    assert list(files.filename) == \
+        [f'gdas.t06z.{data_type}.tm00.bufr_d'] * 3
+
+
+
+def test_get_bufr_files_data__several_variable_parts(sqlite_database):
+    from obs_inv_utils import db_migrations
+    from obs_inv_utils import obs_inv_queries as oiq
+    tbl_factory = se.tbl_factory
+    data_type = 'multipart'
+    filenames = [
+        f'gdas.20200101.t00z.{data_type}.tm00.bufr_d',
+        # more than the date and cycle between the prefix and the type
+        f'gdas.20200101.v2.t00z.{data_type}.tm00.bufr_d',
+        f'gdas.20200101.nr.t00z.{data_type}.tm00.bufr_d',
+    ]
+    tbl_factory.insert_obs_inv_items([
+        get_test_files_meta(filename, datetime(2020, 1, 1))._replace(
+            cmd_result_id=1)
+        for filename in filenames
+    ])
+    # inserted before generic_filename was added and not backfilled yet
+    oi = tbl_factory.ObsInventory.__table__
+    with tbl_factory.get_engine().begin() as connection:
+        connection.execute(oi.update().where(
+            oi.c.filename == filenames[1]).values(generic_filename=None))
+
+    files = oiq.get_bufr_files_data(
+        [f'gdas.%.t00z.{data_type}.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2020, 1, 1)
+    )
+    assert list(files.filename) == [filenames[0]]
+
+    files = oiq.get_bufr_files_data(
+        [f'gdas.%.v2.t00z.{data_type}.tm00.bufr_d',
+         f'gdas.%.nr.t00z.{data_type}.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2020, 1, 1)
+    )
+    assert list(files.filename) == [filenames[2]]
+
+    db_migrations.backfill_generic_filenames()
+    files = oiq.get_bufr_files_data(
+        [f'gdas.%.v2.t00z.{data_type}.tm00.bufr_d',
+         f'gdas.%.nr.t00z.{data_type}.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2020, 1, 1)
+    )
+    assert sorted(files.filename) == sorted(filenames[1:])
+
+
+def test_get_filename_filter__generic_filename_index(sqlite_database):
+    from sqlalchemy import and_, select
+    from obs_inv_utils import obs_inv_queries as oiq
+    tbl_factory = se.tbl_factory
+    oi = tbl_factory.ObsInventory
+    query = select(oi.obs_id).where(and_(
+        oiq.get_filename_filter(oi, ['gdas.t%z.airsev.tm00.bufr_d']),
+        oi.obs_day >= datetime(2020, 1, 1),
+        oi.obs_day <= datetime(2020, 1, 2)
+    ))
+    engine = tbl_factory.get_engine()
+    compiled = query.compile(
+        engine, compile_kwargs={'render_postcompile': True})
+    params = [str(compiled.params[name]) for name in compiled.positiontup]
+    with engine.connect() as connection:
+        plan = ' '.join(row[-1] for row in connection.exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {compiled}', tuple(params)))
+    assert 'ix_obs_inventory_generic_filename_obs_day' in plan
+    assert 'SCAN' not in plan
+
+
+def test_iter_bufr_files_data__chunks():
+    from obs_inv_utils import obs_inv_queries as oiq
+    data_type = f'i{int(datetime.utcnow().timestamp() * 1000)}'
+    obs_inv_items = [
+        get_test_files_meta(
+            f'gdas.t{hour:02d}z.{data_type}.tm00.bufr_d',
+            datetime(2020, 1, day)
+        )._replace(cmd_result_id=1, parent_dir=f'test/202001{day:02d}/')
+        for day in [1, 2, 3] for hour in [0, 6]
+    ]
+    se.tbl_factory.insert_obs_inv_items(obs_inv_items)
+    filenames = [f'gdas.t%z.{data_type}.tm00.bufr_d']
+
+    chunks = list(oiq.iter_bufr_files_data(
+        filenames, datetime(2020, 1, 1), datetime(2020, 1, 3), chunk_rows=4))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    assert all(list(chunk.columns) == list(chunks[0].columns)
+               for chunk in chunks)
+    assert str(chunks[1].obs_id.dtype) == 'Int64'
+    assert str(chunks[1].obs_day.dtype) == 'datetime64[ns]'
+
+    files = oiq.get_bufr_files_data(
+        filenames, datetime(2020, 1, 1), datetime(2020, 1, 3))
+    streamed = pandas.concat(chunks)
+    assert list(streamed.obs_id) == sorted(streamed.obs_id)
+    assert sorted(streamed.full_path) == sorted(files.full_path)
+    assert sorted(streamed.obs_id) == sorted(files.obs_id)
+
+
+def test_iter_generic_file_frames():
+    from obs_inv_utils import plot_generator as pg
+    rows = pandas.DataFrame({
+        'prefix': ['gdas', 'gdas', 'gdas', 'gfs', 'gfs'],
+        'un': ['1bamua.bufr_d'] * 5,
+        'filename': ['a', 'b', 'c', 'd', 'e'],
+    })
+    chunks = [rows.iloc[0:2], rows.iloc[2:4], rows.iloc[4:5]]
+    frames = list(pg.iter_generic_file_frames(iter(chunks)))
+    assert [(generic_fn, list(data.filename)) for generic_fn, data in frames] \
+        == [('gdas.tag.1bamua.bufr_d', ['a', 'b', 'c']),
+            ('gfs.tag.1bamua.bufr_d', ['d', 'e'])]
+
+
+def test_get_frame__dtypes():
+    from obs_inv_utils import obs_inv_queries as oiq
+    oi = se.tbl_factory.ObsInventory.__table__
+    column_descriptions = [
+        {'name': name, 'type': oi.c[name].type}
+        for name in ['parent_dir', 'file_size', 'obs_day', 'nr_tag']
+    ]
+    rows = [('a/', 10, datetime(2020, 1, 1), False),
+            ('a/', None, None, True)]
+    df = oiq.get_frame(rows, column_descriptions,
+                       oiq.get_compact_dtypes(['parent_dir', 'obs_day']))
+    assert [str(dtype) for dtype in df.dtypes] == \
+        ['category', 'Int64', 'datetime64[ns]', 'boolean']
+    assert list(df.parent_dir.cat.categories) == ['a/']
+    assert df.file_size.isna().tolist() == [False, True]
+
+    empty = oiq.get_frame([], column_descriptions)
+    assert list(empty.columns) == ['parent_dir', 'file_size', 'obs_day',
+                                   'nr_tag']
+    assert str(empty.obs_day.dtype) == 'datetime64[ns]'
+
+
+def test_bufr_meta_latest_table():
+    from obs_inv_utils.nceplibs_cmd_sinv import ObsMetaNceplibsBufrData
+    from plotting import plot_utils
+    tbl_factory = se.tbl_factory
+    filename = f'gdas.t00z.l{int(datetime.utcnow().timestamp() * 1000)}' \
+               f'.tm00.bufr_d'
+    obs_day = datetime(2020, 1, 1)
+    tbl_factory.insert_obs_inv_items([
+        get_test_files_meta(filename, obs_day)._replace(
+            cmd_result_id=1, s3_bucket='noaa-reanalyses-pds')
+    ])
+    session = tbl_factory.Session()
+    obs_id = session.query(tbl_factory.ObsInventory.obs_id).filter(
+        tbl_factory.ObsInventory.filename == filename).scalar()
+    session.close()
+
+    meta_items = [
+        ObsMetaNceplibsBufrData(
+            obs_id, 1, 'sinv', sat_id, f'sat{sat_id}', 100 + sat_id, 3,
+            'inst', filename, 10, obs_day)
+        for sat_id in [1, 2]
+    ]
+    tbl_factory.insert_obs_meta_nceplibs_bufr_item(meta_items)
+    # rows already in the meta table are ignored by both tables
+    tbl_factory.insert_obs_meta_nceplibs_bufr_item(meta_items)
+    assert tbl_factory.populate_latest_tables() == 0
+
+    bufr = plot_utils.get_distinct_bufr()
+    bufr = bufr[bufr.filename == filename]
+    assert sorted(bufr.obs_count) == [101, 102]
+    assert set(bufr.parent_dir) == {'test/ingest/'}
+    assert str(bufr.sat_id_name.dtype) == 'category'
+
+
+def test_get_bufr_daily_counts():
+    from obs_inv_utils import obs_inv_queries as oiq
+    from obs_inv_utils.nceplibs_cmd_sinv import ObsMetaNceplibsBufrData
+    tbl_factory = se.tbl_factory
+    parent_dir = f'test/daily/{int(datetime.utcnow().timestamp() * 1000)}/'
+    obs_day = datetime(2020, 1, 1, 6)
+    filenames = [f'gdas.t{hour:02d}z.1bamua.tm00.bufr_d' for hour in [0, 6]]
+    tbl_factory.insert_obs_inv_items([
+        get_test_files_meta(filename, obs_day)._replace(
+            cmd_result_id=1, parent_dir=parent_dir,
+            s3_bucket=oiq.REANALYSES_BUCKET)
+        for filename in filenames
+    ])
+    session = tbl_factory.Session()
+    obs_ids = session.query(tbl_factory.ObsInventory.obs_id).filter(
+        tbl_factory.ObsInventory.parent_dir == parent_dir).all()
+    session.close()
+
+    tbl_factory.insert_obs_meta_nceplibs_bufr_item([
+        ObsMetaNceplibsBufrData(
+            obs_id, 1, 'sinv', sat_id, f'sat{sat_id}', 100, 3, 'inst',
+            filename, 10, obs_day)
+        for (obs_id,), filename in zip(obs_ids, filenames)
+        for sat_id in [1, 2]
+    ])
+
+    sensor = parent_dir.split('/')[2]
+    counts = oiq.get_bufr_daily_counts(sensors=[sensor])
+    assert len(counts) == 2
+    assert list(counts.columns) == [
+        'sensor', 'stream', 'source_dir', 'sat_id', 'sat_id_name', 'obs_day',
+        'obs_count', 'file_count']
+    assert set(counts.sensor) == {sensor}
+    assert set(counts.obs_day) == {datetime(2020, 1, 1)}
+    assert list(counts.sort_values('sat_id').obs_count) == [200, 200]
+    assert list(counts.file_count) == [2, 2]
+    assert str(counts.sat_id_name.dtype) == 'category'
+    assert str(counts.sat_id.dtype) == 'Int32'
+    assert str(counts.obs_count.dtype) == 'int64'
@@ -0,0 +1,75 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for payload_store
+
+"""
+import os
+import json
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from obs_inv_utils import payload_store
+from obs_inv_utils import inventory_table_factory as tbl_factory
+
+
+def get_cmd_result_data(raw_output):
+    return tbl_factory.CmdResultData(
+        'list_objects', 'test/payload/', raw_output, '', 200,
+        datetime(2020, 1, 1), datetime.utcnow(), 0.1, datetime.utcnow()
+    )
+
+
+def get_raw_output():
+    contents = [{'Key': f'test/payload/{i}', 'Size': i} for i in range(50)]
+    return json.dumps({
+        'Contents': contents,
+        'run': datetime.utcnow().timestamp()
+    })
+
+
+def test_store_raw_output__inline_by_default():
+    raw_output = get_raw_output()
+    with patch.dict(os.environ, {}, clear=False):
+        os.environ.pop(payload_store.PAYLOAD_STORAGE_ENV, None)
+        assert payload_store.store_raw_output(raw_output) == (raw_output, None)
+
+    with patch.dict(os.environ, {payload_store.PAYLOAD_STORAGE_ENV: 'foo'}):
+        with pytest.raises(ValueError):
+            payload_store.store_raw_output(raw_output)
+
+
+def test_compressed_payloads__deduplicated_and_resolved(tmp_path):
+    raw_output = get_raw_output()
+    env = {payload_store.PAYLOAD_STORAGE_ENV: payload_store.STORAGE_COMPRESSED}
+    with patch.dict(os.environ, env):
+        first_id = tbl_factory.insert_cmd_result(
+            get_cmd_result_data(raw_output))
+        second_id = tbl_factory.insert_cmd_result(
+            get_cmd_result_data(raw_output))
+        short_id = tbl_factory.insert_cmd_result(get_cmd_result_data('{}'))
+
+    session = tbl_factory.Session()
+    stored = dict(session.query(
+        tbl_factory.CmdResult.cmd_result_id, tbl_factory.CmdResult.raw_output
+    ).filter(
+        tbl_factory.CmdResult.cmd_result_id.in_([first_id, second_id])
+    ).all())
+    session.close()
+
+    assert stored[first_id] == stored[second_id]
+    assert payload_store.is_payload_ref(stored[first_id])
+    payload_hash = stored[first_id][len(payload_store.PAYLOAD_REF_PREFIX):]
+    payload = tbl_factory.get_cmd_result_payload(payload_hash)
+    assert len(payload.payload) < len(raw_output)
+
+    assert payload_store.get_cmd_result_raw_output(first_id) == raw_output
+    assert payload_store.get_cmd_result_raw_output(short_id) == '{}'
+
+    # a negative age archives everything, including the payload just stored
+    archive_paths = payload_store.archive_payloads(str(tmp_path), -1)
+    assert len(archive_paths) > 0
+    payload = tbl_factory.get_cmd_result_payload(payload_hash)
+    assert payload.payload is None
+    assert payload_store.get_cmd_result_raw_output(second_id) == raw_output
@@ -0,0 +1,156 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for query_cache
+
+"""
+import os
+import time
+from datetime import datetime
+
+import sqlalchemy as db
+from pandas import DataFrame
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import query_cache
+from obs_inv_utils import search_engine as se
+
+
+def insert_obs_inv_row(engine, filename, inserted_at):
+    files_meta = se.TarballFileMeta(
+        1, filename, 'test/query_cache/', platforms.AWS_S3, 'test-bucket',
+        'gdas', 't00z', '1bamua', 0, datetime(2020, 1, 1), 'bufr_d',
+        'tm00.bufr_d', False, 10, '', datetime(2020, 1, 1), inserted_at, 0.1,
+        inserted_at, inserted_at, 'abc'
+    )
+    with engine.begin() as connection:
+        connection.execute(
+            tbl_factory.ObsInventory.__table__.insert(),
+            tbl_factory.get_obs_inv_rows([files_meta])
+        )
+
+
+def test_get_key_value__sets_are_sorted():
+    assert query_cache.get_key_value({'b', 'a'}) == ['a', 'b']
+    assert query_cache.get_key_value(
+        (datetime(2020, 1, 1), None)) == ['2020-01-01T00:00:00', None]
+    assert query_cache.get_cache_key('f', ({'b', 'a'},), {}, 'db', []) == \
+        query_cache.get_cache_key('f', ({'a', 'b'},), {}, 'db', [])
+
+
+def test_cached_query__empty_dir_disables_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv(query_cache.QUERY_CACHE_DIR_ENV, '')
+    calls = []
+
+    @query_cache.cached_query([tbl_factory.OBS_INVENTORY_TABLE])
+    def list_files(prefix):
+        calls.append(prefix)
+        return DataFrame({'prefix': [prefix]})
+
+    list_files('gdas')
+    list_files('gdas')
+    assert calls == ['gdas', 'gdas']
+    assert os.listdir(tmp_path) == []
+
+
+def test_cached_query__runs_again_after_ingest(tmp_path, monkeypatch):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    monkeypatch.setattr(tbl_factory, 'get_engine', lambda: engine)
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv(query_cache.QUERY_CACHE_DIR_ENV, str(cache_dir))
+    monkeypatch.setenv(query_cache.QUERY_CACHE_FRESHNESS_ENV, '3600')
+    insert_obs_inv_row(
+        engine, 'gdas.20200101.t00z.1bamua.tm00.bufr_d', datetime(2021, 1, 1))
+
+    calls = []
+
+    @query_cache.cached_query([tbl_factory.OBS_INVENTORY_TABLE])
+    def count_files(prefix):
+        calls.append(prefix)
+        with engine.connect() as connection:
+            count = connection.execute(
+                db.select(db.func.count()).select_from(
+                    tbl_factory.ObsInventory.__table__)).scalar()
+        return DataFrame({'prefix': [prefix], 'files': [count]})
+
+    assert list(count_files('gdas')['files']) == [1]
+    assert list(count_files('gdas')['files']) == [1]
+    assert calls == ['gdas']
+    assert len(query_cache.get_entry_paths(str(cache_dir))) == 1
+    assert list(count_files('gfs')['files']) == [1]
+    assert calls == ['gdas', 'gfs']
+
+    # the freshness is not checked again within the freshness window
+    insert_obs_inv_row(
+        engine, 'gdas.20200102.t00z.1bamua.tm00.bufr_d', datetime(2021, 1, 2))
+    assert list(count_files('gdas')['files']) == [1]
+    assert calls == ['gdas', 'gfs']
+
+    monkeypatch.setenv(query_cache.QUERY_CACHE_FRESHNESS_ENV, '0')
+    assert list(count_files('gdas')['files']) == [2]
+    assert calls == ['gdas', 'gfs', 'gdas']
+
+    assert query_cache.clear_cache() == 3
+    assert query_cache.get_entry_paths(str(cache_dir)) == []
+
+
+def test_cached_query__hit_does_not_create_engine(tmp_path, monkeypatch):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    engine_calls = []
+
+    def get_engine():
+        engine_calls.append(engine)
+        return engine
+
+    monkeypatch.setattr(tbl_factory, 'get_engine', get_engine)
+    monkeypatch.setenv(query_cache.QUERY_CACHE_DIR_ENV, str(tmp_path / 'c'))
+    monkeypatch.setenv(query_cache.QUERY_CACHE_FRESHNESS_ENV, '3600')
+    filename = 'gdas.20200101.t00z.1bamua.tm00.bufr_d'
+    insert_obs_inv_row(engine, filename, datetime(2021, 1, 1))
+
+    @query_cache.cached_query([tbl_factory.OBS_INVENTORY_TABLE])
+    def read_valid_at(prefix):
+        with tbl_factory.get_engine().connect() as connection:
+            valid_at = connection.execute(db.select(
+                tbl_factory.ObsInventory.__table__.c.valid_at)).scalar()
+        return DataFrame({'prefix': [prefix], 'valid_at': [valid_at]})
+
+    # the freshness check and the query
+    assert list(read_valid_at('gdas')['valid_at']) == [datetime(2021, 1, 1)]
+    assert len(engine_calls) == 2
+    assert list(read_valid_at('gdas')['valid_at']) == [datetime(2021, 1, 1)]
+    assert len(engine_calls) == 2
+
+    # an upsert keeps inserted_at and the row count but moves updated_at
+    files_meta = se.TarballFileMeta(
+        1, filename, 'test/query_cache/', platforms.AWS_S3, 'test-bucket',
+        'gdas', 't00z', '1bamua', 0, datetime(2020, 1, 1), 'bufr_d',
+        'tm00.bufr_d', False, 10, '', datetime(2020, 1, 1),
+        datetime(2021, 1, 1), 0.1, datetime(2021, 1, 1), datetime(2021, 2, 1),
+        'abc'
+    )
+    with engine.begin() as connection:
+        tbl_factory.insert_obs_inv_rows(
+            connection, tbl_factory.get_obs_inv_rows([files_meta]))
+    monkeypatch.setenv(query_cache.QUERY_CACHE_FRESHNESS_ENV, '0')
+    assert list(read_valid_at('gdas')['valid_at']) == [datetime(2021, 2, 1)]
+
+
+def test_evict__by_age_then_size(tmp_path):
+    cache_dir = str(tmp_path)
+    now = time.time()
+    for name, age in [('old', 100), ('older', 200), ('recent', 10),
+                      ('newest', 0)]:
+        entry_path = os.path.join(cache_dir, name + query_cache.PICKLE_SUFFIX)
+        with open(entry_path, 'wb') as entry_file:
+            entry_file.write(b'x' * 100)
+        os.utime(entry_path, (now - age, now - age))
+
+    assert query_cache.evict(cache_dir, max_bytes=1000, max_age=150) == 1
+    assert query_cache.evict(cache_dir, max_bytes=200, max_age=150) == 1
+    assert sorted(os.listdir(cache_dir)) == ['newest.pkl', 'recent.pkl']
@@ -0,0 +1,133 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for query_profiler
+
+"""
+import json
+from datetime import datetime
+
+import pytest
+import sqlalchemy as db
+from sqlalchemy import text
+
+from obs_inv_utils import query_profiler
+
+
+def test_get_percentile():
+    values = [0.1, 0.2, 0.3, 0.4, 1.0]
+    assert query_profiler.get_percentile(values, 50) == 0.3
+    assert query_profiler.get_percentile(values, 95) == 1.0
+    assert query_profiler.get_percentile(values, 0) == 0.1
+    assert query_profiler.get_percentile([], 50) is None
+
+
+def test_statement_stats__latency_sample_is_bounded():
+    stats = query_profiler.StatementStats('SELECT 1')
+    run_count = 3 * query_profiler.LATENCY_SAMPLE_SIZE
+    for run in range(run_count):
+        stats.add(run / run_count)
+
+    assert len(stats.latencies) == query_profiler.LATENCY_SAMPLE_SIZE
+    report = stats.as_dict()
+    assert report['count'] == run_count
+    assert report['total_seconds'] == pytest.approx((run_count - 1) / 2)
+    assert report['max_seconds'] == (run_count - 1) / run_count
+    assert 0.3 < report['p50_seconds'] < 0.7
+
+
+def test_get_parameter_shape():
+    assert query_profiler.get_parameter_shape(
+        ('gdas', datetime(2020, 1, 1), 3), False) == \
+        ['str', 'datetime', 'int']
+    assert query_profiler.get_parameter_shape(
+        [{'a': 1}, {'a': 2}], True) == {'rows': 2, 'first_row': {'a': 'int'}}
+
+
+def test_watch_queries__disabled(tmp_path, monkeypatch):
+    monkeypatch.delenv(query_profiler.QUERY_PROFILE_ENV, raising=False)
+    engine = db.create_engine(f'sqlite:///{tmp_path / "profile.db"}')
+    assert not query_profiler.watch_queries(engine)
+
+
+def test_watch_queries__reports_slow_statements(tmp_path, monkeypatch):
+    monkeypatch.setenv(query_profiler.QUERY_PROFILE_ENV, '1')
+    # every statement counts as slow
+    monkeypatch.setenv(query_profiler.SLOW_QUERY_SECONDS_ENV, '0')
+    monkeypatch.setattr(
+        query_profiler, 'query_profile', query_profiler.QueryProfile())
+    engine = db.create_engine(f'sqlite:///{tmp_path / "profile.db"}')
+    assert query_profiler.watch_queries(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE files (file_id INTEGER PRIMARY KEY, name VARCHAR)'))
+        connection.execute(
+            text('INSERT INTO files (name) VALUES (:name)'),
+            [{'name': 'a'}, {'name': 'b'}]
+        )
+        for name in ['a', 'b', 'c']:
+            connection.execute(
+                text('SELECT file_id FROM files WHERE name = :name'),
+                {'name': name}
+            )
+        with pytest.raises(db.exc.OperationalError):
+            connection.execute(text('SELECT missing FROM files'))
+
+    report = {stats['statement']: stats
+              for stats in query_profiler.get_query_report()}
+    select_stats = report['SELECT file_id FROM files WHERE name = ?']
+    assert select_stats['count'] == 3
+    assert select_stats['slow_count'] == 3
+    assert select_stats['parameter_shape'] == ['str']
+    assert select_stats['p50_seconds'] <= select_stats['max_seconds']
+    assert any('SCAN' in line for line in select_stats['explain'])
+
+    insert_stats = report['INSERT INTO files (name) VALUES (?)']
+    assert insert_stats['parameter_shape'] == \
+        {'rows': 2, 'first_row': ['str']}
+    # only reads are explained
+    assert insert_stats['explain'] is None
+
+    report_path = tmp_path / 'report.json'
+    query_profiler.write_query_report(str(report_path))
+    with open(report_path) as report_file:
+        assert len(json.load(report_file)) == len(report)
+
+
+def test_watch_queries__explains_after_checkin(tmp_path, monkeypatch):
+    monkeypatch.setenv(query_profiler.QUERY_PROFILE_ENV, '1')
+    monkeypatch.setenv(query_profiler.SLOW_QUERY_SECONDS_ENV, '0')
+    monkeypatch.setattr(
+        query_profiler, 'query_profile', query_profiler.QueryProfile())
+    # one connection, as the worker and plotting pools can have
+    engine = db.create_engine(
+        f'sqlite:///{tmp_path / "profile.db"}', poolclass=db.pool.QueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=0.1)
+    assert query_profiler.watch_queries(engine)
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE files (file_id INTEGER PRIMARY KEY, name VARCHAR)'))
+        connection.execute(
+            text('SELECT file_id FROM files WHERE name = :name'),
+            {'name': 'a'})
+
+    report = {stats['statement']: stats
+              for stats in query_profiler.get_query_report()}
+    select_stats = report['SELECT file_id FROM files WHERE name = ?']
+    assert any('SCAN' in line for line in select_stats['explain'])
+
+
+def test_explain_statement__failure_is_returned(tmp_path, monkeypatch):
+    engine = db.create_engine(f'sqlite:///{tmp_path / "profile.db"}')
+
+    def raw_connection():
+        raise TimeoutError('QueuePool limit reached')
+
+    monkeypatch.setattr(engine, 'raw_connection', raw_connection)
+    assert query_profiler.explain_statement(engine, 'SELECT 1', ()) == \
+        ['EXPLAIN failed: QueuePool limit reached']
+    assert query_profiler.explain_statement(
+        engine, 'DELETE FROM files', ()) is None
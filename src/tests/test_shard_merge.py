@@ -0,0 +1,155 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for shard_merge
+
+"""
+import os
+from datetime import datetime
+
+import pytest
+import sqlalchemy as db
+from sqlalchemy import select
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+from obs_inv_utils import shard_merge
+
+
+OBS_DAY = datetime(2020, 1, 1)
+
+
+def create_database(path):
+    engine = db.create_engine(f'sqlite:///{path}')
+    tbl_factory.Base.metadata.create_all(engine)
+    return engine
+
+
+def get_obs_inv_row(filename, cmd_result_id, valid_at):
+    files_meta = se.TarballFileMeta(
+        cmd_result_id, filename, 'test/shard/', platforms.AWS_S3,
+        'test-bucket', 'gdas', 't00z', 'test', 0, OBS_DAY, 'bufr_d',
+        'tm00.bufr_d', False, 10, '', OBS_DAY, OBS_DAY, 0.1, OBS_DAY,
+        valid_at, 'abc'
+    )
+    return tbl_factory.get_obs_inv_rows([files_meta])[0]
+
+
+def get_bufr_meta_row(obs_id, cmd_result_id, filename, sat_id):
+    return {
+        'obs_id': obs_id, 'cmd_result_id': cmd_result_id, 'cmd_str': 'sinv',
+        'sat_id': sat_id, 'sat_id_name': f'sat{sat_id}', 'obs_count': 100,
+        'sat_inst_id': 1, 'sat_inst_desc': 'inst', 'filename': filename,
+        'file_size': 10, 'obs_day': OBS_DAY, 'inserted_at': OBS_DAY
+    }
+
+
+def insert_cmd_results(connection, cmd_result_ids):
+    connection.execute(tbl_factory.CmdResult.__table__.insert(), [
+        {'cmd_result_id': cmd_result_id, 'command': 'list_objects',
+         'arg0': str(cmd_result_id), 'obs_day': OBS_DAY}
+        for cmd_result_id in cmd_result_ids
+    ])
+
+
+@pytest.fixture
+def databases(tmp_path):
+    main_engine = create_database(tmp_path / 'main.db')
+    with main_engine.begin() as connection:
+        insert_cmd_results(connection, [1])
+        connection.execute(tbl_factory.ObsInventory.__table__.insert(), [
+            dict(get_obs_inv_row('shared.bufr_d', 1, OBS_DAY), obs_id=5)
+        ])
+        connection.execute(
+            tbl_factory.InventoryWatermark.__table__.insert(), [{
+                'platform': platforms.AWS_S3, 'search_key': 'gdas',
+                'last_cycle': datetime(2020, 1, 3), 'updated_at': OBS_DAY
+            }])
+
+    shard_dir = tmp_path / 'shards'
+    shard_dir.mkdir()
+    shard_engine = create_database(
+        shard_dir / f'{tbl_factory.SHARD_PREFIX}test-1.db')
+    valid_at = datetime(2021, 1, 1)
+    with shard_engine.begin() as connection:
+        insert_cmd_results(connection, [1, 2])
+        connection.execute(tbl_factory.ObsInventory.__table__.insert(), [
+            dict(get_obs_inv_row('shared.bufr_d', 1, valid_at), obs_id=1),
+            dict(get_obs_inv_row('new.bufr_d', 2, valid_at), obs_id=2),
+        ])
+        connection.execute(tbl_factory.ObsMetaNceplibsBufr.__table__.insert(), [
+            get_bufr_meta_row(1, 1, 'shared.bufr_d', 3),
+            get_bufr_meta_row(2, 2, 'new.bufr_d', 3),
+            get_bufr_meta_row(2, 2, 'new.bufr_d', 4),
+        ])
+        connection.execute(
+            tbl_factory.InventoryWatermark.__table__.insert(), [{
+                'platform': platforms.AWS_S3, 'search_key': 'gdas',
+                'last_cycle': datetime(2020, 1, 2), 'updated_at': valid_at
+            }])
+    shard_engine.dispose()
+
+    return main_engine, str(shard_dir)
+
+
+@pytest.mark.parametrize('merge', [
+    shard_merge.merge_attached_shard,
+    shard_merge.merge_shard_rows,
+])
+def test_merge_shard__remaps_ids(databases, merge):
+    main_engine, shard_dir = databases
+    [shard_path] = shard_merge.get_shard_paths(shard_dir)
+    counts = merge(shard_path, main_engine)
+    assert counts[tbl_factory.CMD_RESULTS_TABLE] == 2
+    assert counts[tbl_factory.OBS_META_NCEPLIBS_BUFR_TABLE] == 3
+
+    obs_inv = tbl_factory.ObsInventory.__table__
+    bufr_meta = tbl_factory.ObsMetaNceplibsBufr.__table__
+    with main_engine.connect() as connection:
+        cmd_result_ids = connection.execute(select(
+            [tbl_factory.CmdResult.__table__.c.cmd_result_id])).scalars().all()
+        obs_rows = {row.filename: row for row in connection.execute(
+            select([obs_inv.c.obs_id, obs_inv.c.filename,
+                    obs_inv.c.cmd_result_id, obs_inv.c.valid_at]))}
+        meta_rows = connection.execute(select(
+            [bufr_meta.c.obs_id, bufr_meta.c.cmd_result_id,
+             bufr_meta.c.filename])).fetchall()
+        latest_count = connection.execute(
+            select([db.func.count()]).select_from(
+                tbl_factory.ObsMetaNceplibsBufrLatest.__table__)).scalar()
+        last_cycle = connection.execute(select(
+            [tbl_factory.InventoryWatermark.__table__.c.last_cycle])).scalar()
+
+    assert sorted(cmd_result_ids) == [1, 2, 3]
+    # the existing row keeps its obs_id and cmd_result_id
+    assert obs_rows['shared.bufr_d'].obs_id == 5
+    assert obs_rows['shared.bufr_d'].cmd_result_id == 1
+    assert obs_rows['shared.bufr_d'].valid_at == datetime(2021, 1, 1)
+    assert obs_rows['new.bufr_d'].cmd_result_id == 3
+    for obs_id, cmd_result_id, filename in meta_rows:
+        assert obs_id == obs_rows[filename].obs_id
+        assert cmd_result_id in [2, 3]
+    assert latest_count == 3
+    assert last_cycle == datetime(2020, 1, 3)
+
+
+def test_merge_shards__removes_merged_shards(databases):
+    main_engine, shard_dir = databases
+    totals = shard_merge.merge_shards(shard_dir, main_engine)
+    assert totals[tbl_factory.OBS_INVENTORY_TABLE] == 2
+    assert shard_merge.get_shard_paths(shard_dir) == []
+
+    # nothing is left to merge
+    assert shard_merge.merge_shards(shard_dir, main_engine) == {}
+    assert os.listdir(shard_dir) == []
+
+
+def test_require_unsharded(tmp_path, monkeypatch):
+    monkeypatch.delenv(tbl_factory.SHARD_DIR_ENV, raising=False)
+    tbl_factory.require_unsharded('Incremental search')
+
+    monkeypatch.setenv(tbl_factory.SHARD_DIR_ENV, str(tmp_path))
+    with pytest.raises(ValueError, match='Incremental search'):
+        tbl_factory.require_unsharded('Incremental search')
@@ -0,0 +1,195 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for snapshots
+
+"""
+import re
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as db
+
+from obs_inv_utils import inventory_table_factory as tbl_factory
+from obs_inv_utils import obs_inv_queries as oiq
+from obs_inv_utils import obs_storage_platforms as platforms
+from obs_inv_utils import search_engine as se
+from obs_inv_utils import snapshots
+
+
+def test_get_like_regex():
+    regex = snapshots.get_like_regex('gdas.%.t00z.1bamua.tm00.bufr_d')
+    assert re.match(regex, 'gdas.20200101.t00z.1bamua.tm00.bufr_d')
+    assert not re.match(regex, 'gdas.20200101.t00z.1bamuaXtm00.bufr_d')
+    assert re.match(snapshots.get_like_regex('a_c'), 'abc')
+    assert not re.match(snapshots.get_like_regex('a_c'), 'abbc')
+
+
+def test_state__round_trip(tmp_path):
+    assert snapshots.load_state(str(tmp_path)) == {}
+    state = {tbl_factory.OBS_INVENTORY_TABLE: 1234}
+    snapshots.save_state(str(tmp_path), state)
+    assert snapshots.load_state(str(tmp_path)) == state
+
+
+def test_export_snapshot__requires_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, 'pa', None)
+    with pytest.raises(ValueError, match='pyarrow'):
+        snapshots.export_snapshot(str(tmp_path))
+
+
+def insert_obs_inv_rows(engine, filenames, obs_day, inserted_at):
+    rows = []
+    for filename in filenames:
+        files_meta = se.TarballFileMeta(
+            1, filename, 'test/snapshot/', platforms.AWS_S3, 'test-bucket',
+            'gdas', 't00z', '1bamua', 0, obs_day, 'bufr_d', 'tm00.bufr_d',
+            False, 10, '', obs_day, inserted_at, 0.1, inserted_at,
+            inserted_at, 'abc'
+        )
+        rows.extend(tbl_factory.get_obs_inv_rows([files_meta]))
+    with engine.begin() as connection:
+        connection.execute(tbl_factory.ObsInventory.__table__.insert(), rows)
+
+
+def test_export_snapshot__appends_new_rows(tmp_path):
+    pytest.importorskip('pyarrow')
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(tbl_factory.CmdResult.__table__.insert(), [
+            {'cmd_result_id': 1, 'command': 'list_objects', 'arg0': 'test'}])
+
+    snapshot_dir = str(tmp_path / 'snapshot')
+    table_names = [tbl_factory.OBS_INVENTORY_TABLE]
+    insert_obs_inv_rows(
+        engine, ['gdas.20191231.t00z.1bamua.tm00.bufr_d'],
+        datetime(2019, 12, 31), datetime(2021, 1, 1))
+    insert_obs_inv_rows(
+        engine, ['gdas.20200101.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2021, 1, 1))
+    counts = snapshots.export_snapshot(snapshot_dir, table_names, engine)
+    assert counts == {tbl_factory.OBS_INVENTORY_TABLE: 2}
+
+    # only the rows inserted since the last export are appended
+    insert_obs_inv_rows(
+        engine, ['gdas.20200102.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 2), datetime(2021, 1, 2))
+    counts = snapshots.export_snapshot(snapshot_dir, table_names, engine)
+    assert counts == {tbl_factory.OBS_INVENTORY_TABLE: 1}
+    assert snapshots.export_snapshot(snapshot_dir, table_names, engine) == \
+        {tbl_factory.OBS_INVENTORY_TABLE: 0}
+
+    df = snapshots.read_snapshot(
+        snapshot_dir, tbl_factory.OBS_INVENTORY_TABLE,
+        columns=['filename', 'obs_day'],
+        filter=snapshots.get_obs_day_filter(datetime(2020, 1, 1), None))
+    assert list(df.columns) == ['filename', 'obs_day']
+    assert sorted(df['filename']) == [
+        'gdas.20200101.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200102.t00z.1bamua.tm00.bufr_d'
+    ]
+
+    files = oiq.get_bufr_files_data(
+        ['gdas.%.t00z.1bamua.tm00.bufr_d'], datetime(2019, 12, 31),
+        datetime(2020, 1, 1), snapshot_dir=snapshot_dir)
+    assert list(files['filename']) == [
+        'gdas.20191231.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200101.t00z.1bamua.tm00.bufr_d'
+    ]
+    assert list(files['full_path']) == [
+        'test/snapshot/' + filename for filename in files['filename']]
+
+
+def test_export_snapshot__rows_committed_with_older_inserted_at(tmp_path):
+    pytest.importorskip('pyarrow')
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    snapshot_dir = str(tmp_path / 'snapshot')
+    table_names = [tbl_factory.OBS_INVENTORY_TABLE]
+    insert_obs_inv_rows(
+        engine, ['gdas.20200101.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2021, 1, 2))
+    assert snapshots.export_snapshot(snapshot_dir, table_names, engine) == \
+        {tbl_factory.OBS_INVENTORY_TABLE: 1}
+
+    # searched before the last export, and at the same time, but committed
+    # after it, like the rows of a shard merge
+    insert_obs_inv_rows(
+        engine, ['gdas.20200102.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 2), datetime(2021, 1, 1))
+    insert_obs_inv_rows(
+        engine, ['gdas.20200103.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 3), datetime(2021, 1, 2))
+    assert snapshots.export_snapshot(snapshot_dir, table_names, engine) == \
+        {tbl_factory.OBS_INVENTORY_TABLE: 2}
+
+    df = snapshots.read_snapshot(
+        snapshot_dir, tbl_factory.OBS_INVENTORY_TABLE, columns=['filename'])
+    assert sorted(df['filename']) == [
+        'gdas.20200101.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200102.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200103.t00z.1bamua.tm00.bufr_d'
+    ]
+
+
+def test_get_bufr_files_data__snapshot_generic_filenames(tmp_path):
+    pytest.importorskip('pyarrow')
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    filenames = [
+        'gdas.20200101.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200101.v2.t00z.1bamua.tm00.bufr_d',
+        'gdas.20200101.nr.t00z.1bamua.tm00.bufr_d',
+    ]
+    insert_obs_inv_rows(
+        engine, filenames, datetime(2020, 1, 1), datetime(2021, 1, 1))
+    oi = tbl_factory.ObsInventory.__table__
+    with engine.begin() as connection:
+        connection.execute(oi.update().where(
+            oi.c.filename == filenames[2]).values(generic_filename=None))
+
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshots.export_snapshot(
+        snapshot_dir, [tbl_factory.OBS_INVENTORY_TABLE], engine)
+    files = oiq.get_bufr_files_data(
+        ['gdas.%.t00z.1bamua.tm00.bufr_d'], datetime(2020, 1, 1),
+        datetime(2020, 1, 1), snapshot_dir=snapshot_dir)
+    assert list(files['filename']) == [filenames[0]]
+
+    # the rows without a generic filename are only found by plain patterns
+    files = oiq.get_bufr_files_data(
+        ['gdas.%.v2.t00z.1bamua.tm00.bufr_d',
+         'gdas.%.nr.t00z.1bamua.tm%.bufr_d'],
+        datetime(2020, 1, 1), datetime(2020, 1, 1),
+        snapshot_dir=snapshot_dir)
+    assert sorted(files['filename']) == sorted(filenames[1:])
+
+
+def test_get_family_fs_data__snapshot_dir(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    engine = db.create_engine(f'sqlite:///{tmp_path / "inventory.db"}')
+    tbl_factory.Base.metadata.create_all(engine)
+    insert_obs_inv_rows(
+        engine, ['gdas.20200101.t00z.1bamua.tm00.bufr_d'],
+        datetime(2020, 1, 1), datetime(2021, 1, 1))
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshots.export_snapshot(
+        snapshot_dir, [tbl_factory.OBS_INVENTORY_TABLE], engine)
+
+    def get_members():
+        return [{'prefix': 'gdas', 'cycle_tag': 't00z.',
+                 'data_type': '1bamua', 'suffix': '.tm00.bufr_d'}]
+    family = SimpleNamespace(get_members=get_members)
+
+    # snapshots are only read when asked for, not from the environment
+    monkeypatch.setenv(snapshots.SNAPSHOT_DIR_ENV, snapshot_dir)
+    monkeypatch.setattr(
+        oiq, 'query_family_fs_data', lambda filenames: 'database')
+    assert oiq.get_family_fs_data(family) == 'database'
+
+    files = oiq.get_family_fs_data(family, snapshot_dir=snapshot_dir)
+    assert list(files['filename']) == \
+        ['gdas.20200101.t00z.1bamua.tm00.bufr_d']
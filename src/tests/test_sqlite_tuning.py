@@ -0,0 +1,69 @@
+"""
+Copyright 2022 NOAA
+All rights reserved.
+
+Unit tests for sqlite_tuning
+
+"""
+import sqlite3
+
+import pytest
+import sqlalchemy as db
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from obs_inv_utils import sqlite_tuning
+
+
+def test_apply_sqlite_pragmas(tmp_path, monkeypatch):
+    monkeypatch.setenv('SQLITE_BUSY_TIMEOUT', '1234')
+    monkeypatch.setenv('SQLITE_SYNCHRONOUS', 'normal')
+    engine = db.create_engine(f'sqlite:///{tmp_path / "tuned.db"}')
+    pragmas = sqlite_tuning.apply_sqlite_pragmas(engine)
+    assert pragmas['synchronous'] == 'NORMAL'
+
+    with engine.connect() as connection:
+        assert connection.execute(
+            text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert connection.execute(
+            text('PRAGMA busy_timeout')).scalar() == 1234
+        # NORMAL
+        assert connection.execute(
+            text('PRAGMA synchronous')).scalar() == 1
+
+
+def test_get_sqlite_pragmas__bad_values(monkeypatch):
+    monkeypatch.setenv('SQLITE_JOURNAL_MODE', 'fast')
+    with pytest.raises(ValueError):
+        sqlite_tuning.get_sqlite_pragmas()
+
+    monkeypatch.delenv('SQLITE_JOURNAL_MODE')
+    monkeypatch.setenv('SQLITE_MMAP_SIZE', 'lots')
+    with pytest.raises(ValueError):
+        sqlite_tuning.get_sqlite_pragmas()
+
+
+def test_retry_when_busy(monkeypatch):
+    monkeypatch.setenv('SQLITE_BUSY_BACKOFF', '0')
+    monkeypatch.setenv('SQLITE_BUSY_RETRIES', '2')
+    calls = []
+
+    @sqlite_tuning.retry_when_busy
+    def write(error):
+        calls.append(error)
+        if len(calls) < 3:
+            raise OperationalError('INSERT', {}, sqlite3.OperationalError(error))
+        return len(calls)
+
+    assert write('database is locked') == 3
+
+    calls.clear()
+    with pytest.raises(OperationalError):
+        write('no such table: obs_inventory')
+    assert len(calls) == 1
+
+    calls.clear()
+    monkeypatch.setenv('SQLITE_BUSY_RETRIES', '1')
+    with pytest.raises(OperationalError):
+        write('database is locked')
+    assert len(calls) == 2